@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import argparse
+import fileinput
+import sys
+import textwrap
+from pathlib import Path
+
+from line_align.pylib import align_stream as stream
+
+
+def main():
+    args = parse_args()
+
+    settings = stream.Settings(
+        impl=args.impl,
+        char_set=args.char_set,
+        gap=args.gap,
+        skew=args.skew,
+        gap_char=args.gap_char,
+        band=args.band,
+        tree=args.tree,
+        consensus=args.consensus,
+        distances=args.distances,
+        max_dist=args.max_dist,
+    )
+
+    files = [str(f) for f in args.jsonl] or ["-"]
+    with fileinput.input(files, encoding="utf-8") as records:
+        results = stream.align_stream(
+            records,
+            settings,
+            workers=args.workers,
+            threads=args.pool == "thread",
+            chunk_size=args.chunk_size,
+        )
+        if args.output:
+            with args.output.open("w", encoding="utf-8") as out:
+                write(results, out)
+        else:
+            write(results, sys.stdout)
+
+
+def write(results, out):
+    for result in results:
+        out.write(result)
+        out.write("\n")
+
+
+def parse_args() -> argparse.Namespace:
+    description = """Align groups of lines from JSONL files and write the alignments
+        as JSONL. Each input record is a JSON array of lines, or an object with the
+        lines in its "lines" key. Other keys in the object are copied to the output,
+        which has the aligned lines in "aligned". Records that cannot be aligned get
+        an "error" key instead. The records are streamed through a pool of workers
+        so the input can be larger than memory, and the output is in input order."""
+
+    arg_parser = argparse.ArgumentParser(
+        description=textwrap.dedent(description), fromfile_prefix_chars="@"
+    )
+
+    defaults = stream.Settings()
+
+    arg_parser.add_argument(
+        "jsonl",
+        type=Path,
+        nargs="*",
+        metavar="PATH",
+        help="""Read records from these JSONL files. Read stdin when there are none,
+            or for a path of "-".""",
+    )
+
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        metavar="PATH",
+        help="""Write the results to this file instead of stdout.""",
+    )
+
+    arg_parser.add_argument(
+        "--impl",
+        choices=stream.IMPLS,
+        default=defaults.impl,
+        help="""Align with the native extension or the Python version.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--char-set",
+        default=defaults.char_set,
+        metavar="NAME",
+        help="""Use this character substitution matrix. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--gap",
+        type=float,
+        default=defaults.gap,
+        help="""The gap open penalty. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--skew",
+        type=float,
+        default=defaults.skew,
+        help="""The gap extension penalty. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--gap-char",
+        default=defaults.gap_char,
+        metavar="CHAR",
+        help="""The character used for gaps in the alignments.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--band",
+        type=int,
+        default=0,
+        metavar="N",
+        help="""The starting band width for the native extension. Zero fills the
+            full matrix. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--tree",
+        action="store_true",
+        help="""Align the lines by following a guide tree instead of in order.""",
+    )
+
+    arg_parser.add_argument(
+        "--consensus",
+        action="store_true",
+        help="""Add the consensus line of each alignment, in "consensus", and the
+            confidence in each of its characters, in "confidence".""",
+    )
+
+    arg_parser.add_argument(
+        "--distances",
+        action="store_true",
+        help="""Add the Levenshtein distances of every pair of lines, in
+            "distances", as [distance, index1, index2] sorted by distance.""",
+    )
+
+    arg_parser.add_argument(
+        "--max-dist",
+        type=int,
+        metavar="N",
+        help="""Only add --distances of at most this.""",
+    )
+
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        default=1,
+        help="""Align records in this many workers. Zero means one per core.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--pool",
+        choices=("process", "thread"),
+        default="process",
+        help="""The kind of worker pool. Threads only help the native extension,
+            which lets go of the GIL while aligning. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        metavar="N",
+        default=64,
+        help="""Send this many records to a worker at a time. At most two chunks
+            per worker are in memory at once. (default: %(default)s)""",
+    )
+
+    args = arg_parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import platform
+import resource
+import sys
+import textwrap
+import time
+import timeit
+import tracemalloc
+from collections.abc import Callable
+from itertools import combinations, pairwise
+from pathlib import Path
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib import levenshtein as py_levenshtein
+from line_align.pylib.align import LineAlign
+from line_align.pylib.ocr_noise import OcrNoise
+
+try:
+    import line_align_py
+except ImportError:
+    line_align_py = None
+
+OPS = ("align", "levenshtein", "levenshtein_all")
+IMPLS = ("py", "cpp")
+
+Groups = list[list[str]]
+
+
+def main():
+    args = parse_args()
+
+    noise = OcrNoise(seed=args.seed)
+    funcs = {"py": py_funcs(), "cpp": cpp_funcs()}
+    impls = [i for i in args.impl if funcs[i]]
+    if len(impls) < len(args.impl):
+        print("The line_align_py extension is not built, skipping cpp.")
+
+    results = []
+    for length in args.lengths:
+        for size in args.sizes:
+            groups = [noise.group(length, size) for _ in range(args.groups)]
+            for op in args.op:
+                for impl in impls:
+                    result = measure(
+                        funcs[impl][op], groups, args.repeat, native=impl == "cpp"
+                    )
+                    result = {
+                        "op": op,
+                        "impl": impl,
+                        "length": length,
+                        "size": size,
+                        "cells": count_cells(op, groups),
+                        **result,
+                    }
+                    result["cells_per_sec"] = result["cells"] / result["seconds"]
+                    results.append(result)
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    regressions = compare(results, baseline, args.tolerance) if baseline else []
+
+    report(results)
+
+    if args.save:
+        run = {"meta": meta(args), "results": results}
+        args.save.write_text(json.dumps(run, indent=2) + "\n")
+
+    if regressions:
+        print(f"{len(regressions)} cases are slower than the baseline.")
+        sys.exit(1)
+
+
+def py_funcs() -> dict[str, Callable[[Groups], object]]:
+    line = LineAlign(char_sub_matrix.get())
+    return {
+        "align": lambda groups: [line.align(g) for g in groups],
+        "levenshtein": lambda groups: [
+            py_levenshtein.levenshtein(s1, s2) for g in groups for s1, s2 in pairwise(g)
+        ],
+        "levenshtein_all": lambda groups: [
+            py_levenshtein.levenshtein_all(g) for g in groups
+        ],
+    }
+
+
+def cpp_funcs() -> dict[str, Callable[[Groups], object]]:
+    if not line_align_py:
+        return {}
+    pylib = LineAlign()
+    line = line_align_py.LineAlign(
+        char_sub_matrix.get(), gap=pylib.gap, skew=pylib.skew
+    )
+    return {
+        "align": lambda groups: [line.align(g) for g in groups],
+        "levenshtein": lambda groups: [
+            line.levenshtein(s1, s2) for g in groups for s1, s2 in pairwise(g)
+        ],
+        "levenshtein_all": lambda groups: [line.levenshtein_all(g) for g in groups],
+    }
+
+
+def count_cells(op: str, groups: Groups) -> int:
+    """
+    Count the DP matrix cells for an operation.
+
+    The align count is for the smallest matrices a progressive alignment could use,
+    the alignment so far is at least as wide as its longest line. It is the same for
+    every implementation, so it is fine for comparing them.
+    """
+    cells = 0
+    for group in groups:
+        match op:
+            case "align":
+                widest = 0
+                for first, line in pairwise(group):
+                    widest = max(widest, len(first))
+                    cells += (widest + 1) * (len(line) + 1)
+            case "levenshtein":
+                cells += sum(len(s1) * len(s2) for s1, s2 in pairwise(group))
+            case "levenshtein_all":
+                cells += sum(len(s1) * len(s2) for s1, s2 in combinations(group, 2))
+    return cells
+
+
+def measure(
+    func: Callable[[Groups], object], groups: Groups, repeat: int, *, native: bool
+) -> dict:
+    """Time the best of several runs and then get the peak memory of one more."""
+    # Fast cases are called enough times per run for the timer to resolve them
+    timer = timeit.Timer(lambda: func(groups))
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, number)) / number
+
+    # The native extension's memory does not show up in tracemalloc, so watch the
+    # process' resident set size instead, if the OS lets us reset its high-water mark
+    if native:
+        rss = reset_peak_rss()
+        func(groups)
+        peak = peak_rss() - rss if rss else 0
+    else:
+        tracemalloc.start()
+        func(groups)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def reset_peak_rss() -> int:
+    """Reset the peak resident set size and return the current one, 0 if we can't."""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        return proc_status("VmRSS")
+    except OSError:
+        return 0
+
+
+def peak_rss() -> int:
+    try:
+        return proc_status("VmHWM")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def proc_status(field: str) -> int:
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    msg = f"{field} is not in /proc/self/status"
+    raise OSError(msg)
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[dict]:
+    """Add the speedup over the baseline to each result and return the slow ones."""
+    old = {case_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        if before := old.get(case_key(result)):
+            result["speedup"] = result["cells_per_sec"] / before["cells_per_sec"]
+            if result["speedup"] < 1.0 - tolerance:
+                regressions.append(result)
+    return regressions
+
+
+def case_key(result: dict) -> tuple:
+    return result["op"], result["impl"], result["length"], result["size"]
+
+
+def report(results: list[dict]) -> None:
+    header = (
+        "op              impl  length  size      cells         ms  Mcells/s  peak MiB"
+    )
+    has_speedup = any("speedup" in r for r in results)
+    print(header + ("  speedup" if has_speedup else ""))
+    for r in results:
+        line = (
+            f"{r['op']:<15} {r['impl']:<4} {r['length']:>7} {r['size']:>5} "
+            f"{r['cells']:>10} {r['seconds'] * 1e3:>10.3f} "
+            f"{r['cells_per_sec'] / 1e6:>9.3f} {r['peak_bytes'] / 2**20:>9.2f}"
+        )
+        if "speedup" in r:
+            line += f" {r['speedup']:>8.2f}"
+        print(line)
+
+
+def meta(args: argparse.Namespace) -> dict:
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpp": line_align_py is not None,
+        "seed": args.seed,
+        "lengths": args.lengths,
+        "sizes": args.sizes,
+        "groups": args.groups,
+        "repeat": args.repeat,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    description = """Time the Python and C++ versions of align, levenshtein, and
+        levenshtein_all on synthetic OCR lines, for a grid of line lengths and group
+        sizes. Each group is noisy copies of one random line, with look-alike
+        characters swapped in and characters dropped, mostly at the ends. It reports
+        DP cells per second and peak memory, and can save the results as a baseline
+        JSON file to compare later runs against."""
+
+    arg_parser = argparse.ArgumentParser(
+        description=textwrap.dedent(description), fromfile_prefix_chars="@"
+    )
+
+    arg_parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[20, 80, 320],
+        metavar="N",
+        help="""Line lengths to test. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        metavar="N",
+        help="""The number of lines in each group. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--op",
+        choices=OPS,
+        nargs="+",
+        default=list(OPS),
+        help="""Time these operations. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--impl",
+        choices=IMPLS,
+        nargs="+",
+        default=list(IMPLS),
+        help="""Time these implementations. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--groups",
+        type=int,
+        default=2,
+        metavar="N",
+        help="""How many groups to time for each case. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        metavar="N",
+        help="""Report the fastest of this many runs. Fast cases are called as often
+            as needed for each run to take at least 0.2 seconds.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="""Seed for the synthetic lines. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--save",
+        type=Path,
+        metavar="PATH",
+        help="""Save the results to this JSON file.""",
+    )
+
+    arg_parser.add_argument(
+        "--compare",
+        type=Path,
+        metavar="PATH",
+        help="""Compare the results to the ones in this JSON file, from --save.
+            Exits with an error if any case is slower than the tolerance allows.""",
+    )
+
+    arg_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        metavar="FRACTION",
+        help="""How much slower than the baseline a case may get, as a fraction of
+            its cells per second. (default: %(default)s)""",
+    )
+
+    args = arg_parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    main()
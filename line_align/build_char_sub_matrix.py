@@ -8,9 +8,16 @@ from line_align.pylib import char_sub_matrix as matrix
 
 def main():
     args = parse_args()
-    matrix.add_chars(
-        args.char_set, args.new_chars, args.image_size, args.font_path, args.font_size
-    )
+    for char_set, font_path in zip(args.char_set, args.font_path, strict=True):
+        matrix.add_chars(
+            char_set,
+            args.new_chars,
+            args.image_size,
+            font_path,
+            args.font_size,
+            workers=args.workers,
+            cache_db=args.cache_db,
+        )
 
 
 def parse_args() -> argparse.Namespace:
@@ -25,9 +32,11 @@ def parse_args() -> argparse.Namespace:
 
     arg_parser.add_argument(
         "--char-set",
-        default="default",
+        nargs="+",
+        default=["default"],
         metavar="NAME",
-        help="""Update this character set matrix. (default: %(default)s)""",
+        help="""Update these character set matrices. Give one for each font path.
+            (default: %(default)s)""",
     )
 
     arg_parser.add_argument(
@@ -42,9 +51,11 @@ def parse_args() -> argparse.Namespace:
     arg_parser.add_argument(
         "--font-path",
         type=Path,
+        nargs="+",
+        required=True,
         metavar="PATH",
-        help="""A true type font file to use for calculations.
-            (default: %(default)s)""",
+        help="""True type font files to use for calculations. Each one builds the
+            character set matrix in the same position in --char-set.""",
     )
 
     arg_parser.add_argument(
@@ -64,7 +75,30 @@ def parse_args() -> argparse.Namespace:
         help="""Size of the image that contains a char. (default: %(default)s)""",
     )
 
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        default=1,
+        help="""Score character pairs in this many processes. Zero means one per
+            core. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--cache-db",
+        type=Path,
+        metavar="PATH",
+        default=matrix.CACHE_DB,
+        help="""Keep rendered characters and the progress of interrupted builds in
+            this database. Running an interrupted build again resumes it.
+            (default: %(default)s)""",
+    )
+
     args = arg_parser.parse_args()
+
+    if len(args.char_set) != len(args.font_path):
+        arg_parser.error("Give one --char-set for each --font-path.")
+
     return args
 
 
@@ -1,240 +1,1922 @@
 #include "line_align.hpp"
 #include <algorithm>
-#include <codecvt>
+#include <atomic>
+#include <chrono>
+#include <cmath>
 #include <cstddef>
+#include <cstring>
 #include <exception>
+#include <future>
 #include <iostream>
 #include <iterator>
 #include <limits>
-#include <locale>
+#include <map>
+#include <mutex>
 #include <numeric>
 #include <sstream>
+#include <stdexcept>
+#include <thread>
 #include <utility>
 
+// The vector fill kernels need GCC or Clang for the per-function target attributes
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define FILL_X86
+#include <immintrin.h>
+#endif
+
 
 // A utility function for converting a string from UTF-32 to UTF-8
 std::string convert_32_8(const std::u32string &wides) {
-    std::wstring_convert<std::codecvt_utf8<char32_t>, char32_t> conv;
-    return conv.to_bytes(wides);
+    std::string bytes;
+    bytes.reserve(wides.size());
+    for (char32_t ch : wides) {
+        if (ch < 0x80) {
+            bytes += static_cast<char>(ch);
+        } else if (ch < 0x800) {
+            bytes += static_cast<char>(0xC0 | ch >> 6);
+            bytes += static_cast<char>(0x80 | (ch & 0x3F));
+        } else if (ch < 0x10000) {
+            bytes += static_cast<char>(0xE0 | ch >> 12);
+            bytes += static_cast<char>(0x80 | (ch >> 6 & 0x3F));
+            bytes += static_cast<char>(0x80 | (ch & 0x3F));
+        } else {
+            bytes += static_cast<char>(0xF0 | ch >> 18);
+            bytes += static_cast<char>(0x80 | (ch >> 12 & 0x3F));
+            bytes += static_cast<char>(0x80 | (ch >> 6 & 0x3F));
+            bytes += static_cast<char>(0x80 | (ch & 0x3F));
+        }
+    }
+    return bytes;
+}
+
+// Characters below this are looked up in a flat vector instead of a map
+const char32_t latinSize = 256;
+
+SubstitutionMatrix::SubstitutionMatrix(
+    const std::unordered_map<std::u32string, float>& substitutions
+)
+{
+    this->latin.assign(latinSize, gapIndex);
+
+    for (const auto &[key, value] : substitutions) {
+        if (key.length() != 2) {
+            std::stringstream err;
+            err << "The substitution matrix key '" << convert_32_8(key)
+                << "' must be exactly two characters long.";
+            throw std::invalid_argument(err.str());
+        }
+        for (char32_t ch : key) {
+            if (this->index(ch) == gapIndex) {
+                int32_t idx = this->size();
+                this->chars.push_back(ch);
+                if (ch < latinSize) {
+                    this->latin[ch] = idx;
+                } else {
+                    this->indexes[ch] = idx;
+                }
+            }
+        }
+    }
+
+    size_t size = this->chars.size();
+    this->scores.assign(size * size, std::numeric_limits<float>::quiet_NaN());
+
+    // Keys in lexical order win over the reversed key, just like the lookups in
+    // the original implementation
+    for (const auto &[key, value] : substitutions) {
+        int32_t idx1 = this->index(key[0]);
+        int32_t idx2 = this->index(key[1]);
+        if (key[0] > key[1] && this->has_score(idx1, idx2)) {
+            continue;
+        }
+        this->scores[idx1 * size + idx2] = value;
+        this->scores[idx2 * size + idx1] = value;
+    }
+}
+
+SubstitutionMatrix::SubstitutionMatrix(const std::u32string &alphabet, const float *scores)
+{
+    this->latin.assign(latinSize, gapIndex);
+
+    for (char32_t ch : alphabet) {
+        if (this->index(ch) != gapIndex) {
+            std::stringstream err;
+            err << "The character '" << convert_32_8(std::u32string(1, ch))
+                << "' is in the alphabet more than once.";
+            throw std::invalid_argument(err.str());
+        }
+        int32_t idx = this->size();
+        this->chars.push_back(ch);
+        if (ch < latinSize) {
+            this->latin[ch] = idx;
+        } else {
+            this->indexes[ch] = idx;
+        }
+    }
+
+    this->scores.assign(scores, scores + alphabet.size() * alphabet.size());
+}
+
+int32_t SubstitutionMatrix::index(char32_t ch) const {
+    if (ch < latinSize) {
+        return this->latin[ch];
+    }
+    auto found = this->indexes.find(ch);
+    return found == this->indexes.end() ? gapIndex : found->second;
 }
 
-// A utility function for converting a string from UTF-8 to UTF-32
-std::u32string convert_8_32(const std::string &bytes) {
-    std::wstring_convert<std::codecvt_utf8<char32_t>, char32_t> conv;
-    return conv.from_bytes(bytes);
+bool SubstitutionMatrix::has_score(int32_t idx1, int32_t idx2) const {
+    return !std::isnan(this->score(idx1, idx2));
 }
 
+std::vector<int32_t>
+SubstitutionMatrix::encode(const std::u32string &line, char32_t gap_char) const {
+    std::vector<int32_t> codes;
+    codes.reserve(line.length());
+    for (char32_t ch : line) {
+        if (ch == gap_char) {
+            codes.push_back(gapIndex);
+            continue;
+        }
+        int32_t idx = this->index(ch);
+        if (idx == gapIndex) {
+            std::stringstream err;
+            err << "The character '" << convert_32_8(std::u32string(1, ch))
+                << "' is missing from the substitution matrix.";
+            throw std::invalid_argument(err.str());
+        }
+        codes.push_back(idx);
+    }
+    return codes;
+}
+
+std::u32string
+SubstitutionMatrix::decode(const std::vector<int32_t> &codes, char32_t gap_char) const {
+    std::u32string line;
+    line.reserve(codes.size());
+    for (int32_t idx : codes) {
+        line += idx == gapIndex ? gap_char : this->chars[idx];
+    }
+    return line;
+}
+
+void SubstitutionMatrix::check_pairs(
+    const std::vector<int32_t> &idxs1, const std::vector<int32_t> &idxs2
+) const
+{
+    for (int32_t idx1 : idxs1) {
+        for (int32_t idx2 : idxs2) {
+            if (!this->has_score(idx1, idx2)) {
+                std::u32string key = U"";
+                key += std::min(this->chars[idx1], this->chars[idx2]);
+                key += std::max(this->chars[idx1], this->chars[idx2]);
+                std::stringstream err;
+                err << "One of '" << convert_32_8(key)
+                    << "' these characters are missing from the "
+                    << "substitution matrix.";
+                throw std::invalid_argument(err.str());
+            }
+        }
+    }
+}
+
+std::u32string render(const std::u32string &line, const Gaps &gaps, char32_t gap_char) {
+    std::u32string padded;
+    size_t pos = 0;
+    for (auto [at, count] : gaps) {
+        padded.append(line, pos, at - pos);
+        padded.append(count, gap_char);
+        pos = at;
+    }
+    padded.append(line, pos);
+    return padded;
+}
+
+// The same as render() but as code points, gaps and gap_char become gapIndex
+std::vector<int32_t>
+render_codes(const std::u32string &line, const Gaps &gaps, char32_t gap_char) {
+    std::vector<int32_t> padded;
+    auto append = [&](size_t from, size_t to) {
+        for (size_t i = from; i < to; ++i) {
+            padded.push_back(line[i] == gap_char ? gapIndex : static_cast<int32_t>(line[i]));
+        }
+    };
+    size_t pos = 0;
+    for (auto [at, count] : gaps) {
+        append(pos, at);
+        padded.insert(padded.end(), count, gapIndex);
+        pos = at;
+    }
+    append(pos, line.size());
+    return padded;
+}
+
+// Add a gap before the given position, extending the last run if it is there
+void push_gap(Gaps &gaps, int64_t pos, int64_t count = 1) {
+    if (!gaps.empty() && gaps.back().first == pos) {
+        gaps.back().second += count;
+    } else {
+        gaps.emplace_back(pos, count);
+    }
+}
+
+// Add new gap runs to the gaps in one row of an alignment. The new runs are given
+// as positions in the alignment, the result is positions in the original line.
+Gaps insert_gaps(const Gaps &gaps, const Gaps &inserts) {
+    Gaps result;
+    result.reserve(gaps.size() + inserts.size());
+    size_t g = 0;
+    int64_t shift = 0;  // The gaps in the row before gaps[g]
+    for (auto [column, count] : inserts) {
+        while (g < gaps.size() && column > gaps[g].first + shift + gaps[g].second) {
+            push_gap(result, gaps[g].first, gaps[g].second);
+            shift += gaps[g].second;
+            ++g;
+        }
+        // Inside, or just after, a run of gaps joins that run
+        bool joins = g < gaps.size() && column >= gaps[g].first + shift;
+        push_gap(result, joins ? gaps[g].first : column - shift, count);
+    }
+    for (; g < gaps.size(); ++g) {
+        push_gap(result, gaps[g].first, gaps[g].second);
+    }
+    return result;
+}
+
+/* An alignment without its rows. The rows are only needed to merge alignments
+ * through the characters in each column, so those are all that is kept, along with
+ * where the gaps go in each row. Merging is then proportional to the length of the
+ * alignment and the number of gaps, not the number of rows times the length.
+ */
+struct Profile {
+    std::vector<size_t> starts;  // Column pos has chars[starts[pos]] to chars[starts[pos + 1]]
+    std::vector<int32_t> chars;  // The distinct non-gap indexes in each column
+    std::vector<Gaps> gaps;      // One per row
+
+    Profile() : starts(1, 0) {}
+
+    explicit Profile(const std::vector<int32_t> &line) : starts(1, 0), gaps(1) {
+        for (int32_t idx : line) {
+            if (idx != gapIndex) {
+                this->chars.push_back(idx);
+            }
+            this->starts.push_back(this->chars.size());
+        }
+    }
+
+    size_t length() const { return this->starts.size() - 1; }
+
+    // Add the characters from another profile's column to the last column here
+    void add_column(const Profile &other, size_t pos) {
+        size_t first = this->starts.back();
+        for (size_t i = other.starts[pos]; i < other.starts[pos + 1]; ++i) {
+            int32_t idx = other.chars[i];
+            if (std::find(this->chars.begin() + first, this->chars.end(), idx)
+                    == this->chars.end()) {
+                this->chars.push_back(idx);
+            }
+        }
+    }
+};
+
+// Get the distinct non-gap character indexes in an alignment
+std::vector<int32_t> distinct_chars(const Profile &aligned) {
+    std::vector<int32_t> distinct = aligned.chars;
+    std::sort(distinct.begin(), distinct.end());
+    distinct.erase(std::unique(distinct.begin(), distinct.end()), distinct.end());
+    return distinct;
+}
+
+// Get the best substitution score for every aligned column against every distinct
+// character in the new line. The profile already has the distinct characters in
+// each column, so the cost does not grow with the number of aligned lines.
+// The scores are returned in a flat table indexed by (column * chars.size() + char).
+void column_profile(
+    const SubstitutionMatrix &subs,
+    const Profile &aligned,
+    const std::vector<int32_t> &chars,
+    std::vector<float> &profile
+) {
+    size_t width = chars.size();
+    size_t len = aligned.length();
+    profile.assign(len * width, std::numeric_limits<float>::lowest());
+
+    for (size_t pos = 0; pos < len; ++pos) {
+        float *best = &profile[pos * width];
+        for (size_t ch = 0; ch < width; ++ch) {
+            for (size_t i = aligned.starts[pos]; i < aligned.starts[pos + 1]; ++i) {
+                best[ch] = std::max(best[ch], subs.score(aligned.chars[i], chars[ch]));
+            }
+        }
+    }
+}
+
+
+void AlignStats::add(const AlignStats &other) {
+    this->calls += other.calls;
+    this->merges += other.merges;
+    this->cells += other.cells;
+    this->lookups += other.lookups;
+    this->matrix_bytes += other.matrix_bytes;
+    this->traceback += other.traceback;
+    this->fill_seconds += other.fill_seconds;
+    this->trace_seconds += other.trace_seconds;
+}
+
+// Guards every AlignStats, they may be shared by many threads. It is only taken once
+// per merge, so there is no point in having one per object.
+std::mutex statsMutex;
+
+void add_stats(AlignStats &total, const AlignStats &counts) {
+    std::lock_guard<std::mutex> lock(statsMutex);
+    total.add(counts);
+}
+
+typedef std::chrono::steady_clock Clock;
+
+double seconds(Clock::duration duration) {
+    return std::chrono::duration<double>(duration).count();
+}
+
+
 LineAlign::LineAlign(
     const std::unordered_map<std::u32string, float>& substitutions,
     float gap,
     float skew,
-    char32_t gap_char
+    char32_t gap_char,
+    int64_t band,
+    std::shared_ptr<AlignStats> stats
+) : LineAlign(
+        std::make_shared<SubstitutionMatrix>(substitutions),
+        gap,
+        skew,
+        gap_char,
+        band,
+        stats)
+{
+}
+
+LineAlign::LineAlign(
+    std::shared_ptr<const SubstitutionMatrix> matrix,
+    float gap,
+    float skew,
+    char32_t gap_char,
+    int64_t band,
+    std::shared_ptr<AlignStats> stats
 )
 {
-    this->substitutions = substitutions;
+    this->matrix = matrix;
     this->gap = gap;
     this->skew = skew;
     this->gap_char = gap_char;
+    this->band = band;
+    this->align_stats = stats;
 }
 
 
-// Modified from: https://en.wikipedia.org/wiki/Levenshtein_distance
+// Bit-vectors marking where each character occurs in a pattern string. The pattern
+// is split into 64 character blocks.
+struct PatternMasks {
+    size_t blocks;
+    std::vector<uint64_t> latin;  // Masks for characters below latinSize
+    std::unordered_map<char32_t, std::vector<uint64_t>> others;
+    std::vector<uint64_t> empty;
+
+    PatternMasks(const std::u32string &pattern)
+        : blocks((pattern.length() + 63) / 64),
+          latin(latinSize * blocks, 0),
+          empty(blocks, 0) {
+        for (size_t i = 0; i < pattern.length(); ++i) {
+            char32_t ch = pattern[i];
+            uint64_t bit = uint64_t(1) << (i % 64);
+            if (ch < latinSize) {
+                this->latin[ch * this->blocks + i / 64] |= bit;
+            } else {
+                auto [it, _] = this->others.try_emplace(ch, this->blocks, 0);
+                it->second[i / 64] |= bit;
+            }
+        }
+    }
+
+    const uint64_t *get(char32_t ch) const {
+        if (ch < latinSize) {
+            return &this->latin[ch * this->blocks];
+        }
+        auto found = this->others.find(ch);
+        return found == this->others.end() ? this->empty.data() : found->second.data();
+    }
+};
+
+
+/* Bit-parallel Levenshtein distance from Myers, 1999 as formulated by Hyyrö, 2001.
+ * Patterns longer than 64 characters are split into blocks with the horizontal
+ * deltas carried from one block to the next (Hyyrö, 2003). The shorter string is
+ * used as the pattern.
+ */
 int64_t LineAlign::levenshtein(
     const std::u32string &s,
-    const std::u32string &t
+    const std::u32string &t,
+    int64_t max_dist
 ) const
 {
-    const int64_t m = s.length();
-    const int64_t n = t.length();
-
-    std::vector<int64_t> v0(n + 1);
-    std::vector<int64_t> v1(n + 1);
+    const std::u32string &text = s.length() < t.length() ? t : s;
+    const std::u32string &pattern = s.length() < t.length() ? s : t;
+    const int64_t m = pattern.length();
+    const int64_t n = text.length();
 
-    for (int64_t i = 0; i <= n; ++i) {
-        v0[i] = i;
+    if (max_dist >= 0 && n - m > max_dist) {
+        return max_dist + 1;
+    }
+    if (m == 0) {
+        return n;
     }
 
-    for (int64_t i = 0; i < m; ++i) {
-        v1[0] = i + 1;
+    PatternMasks masks(pattern);
+    const size_t blocks = masks.blocks;
+    const uint64_t last = uint64_t(1) << ((m - 1) % 64);
+    int64_t dist = m;
 
+    if (blocks == 1) {
+        uint64_t pv = ~uint64_t(0);
+        uint64_t mv = 0;
         for (int64_t j = 0; j < n; ++j) {
-            int64_t del = v0[j + 1] + 1;
-            int64_t ins = v1[j] + 1;
-            int64_t sub = s[i] == t[j] ? v0[j] : v0[j] + 1;
+            uint64_t eq = *masks.get(text[j]);
+            uint64_t xv = eq | mv;
+            uint64_t xh = (((eq & pv) + pv) ^ pv) | eq;
+            uint64_t ph = mv | ~(xh | pv);
+            uint64_t mh = pv & xh;
+            dist += (ph & last) ? 1 : (mh & last) ? -1 : 0;
+            ph = (ph << 1) | 1;
+            mh <<= 1;
+            pv = mh | ~(xv | ph);
+            mv = ph & xv;
+            if (max_dist >= 0 && dist - (n - j - 1) > max_dist) {
+                return max_dist + 1;
+            }
+        }
+        return dist;
+    }
 
-            int64_t min = del < ins ? del : ins;
-            min = min < sub ? min : sub;
+    std::vector<uint64_t> pvs(blocks, ~uint64_t(0));
+    std::vector<uint64_t> mvs(blocks, 0);
+    for (int64_t j = 0; j < n; ++j) {
+        const uint64_t *eqs = masks.get(text[j]);
+        int hin = 1;  // The top row of the matrix is always +1 from the left
+        for (size_t b = 0; b < blocks; ++b) {
+            uint64_t pv = pvs[b];
+            uint64_t mv = mvs[b];
+            uint64_t eq = eqs[b];
+            uint64_t hin_neg = hin < 0 ? 1 : 0;
+            uint64_t hin_pos = hin > 0 ? 1 : 0;
 
-            v1[j + 1] = min;
+            uint64_t xv = eq | mv;
+            eq |= hin_neg;
+            uint64_t xh = (((eq & pv) + pv) ^ pv) | eq;
+            uint64_t ph = mv | ~(xh | pv);
+            uint64_t mh = pv & xh;
+
+            if (b == blocks - 1) {
+                dist += (ph & last) ? 1 : (mh & last) ? -1 : 0;
+            }
+            hin = (ph >> 63) ? 1 : (mh >> 63) ? -1 : 0;
+
+            ph = (ph << 1) | hin_pos;
+            mh = (mh << 1) | hin_neg;
+            pvs[b] = mh | ~(xv | ph);
+            mvs[b] = ph & xv;
+        }
+        // Each of the remaining characters can only lower the distance by one
+        if (max_dist >= 0 && dist - (n - j - 1) > max_dist) {
+            return max_dist + 1;
         }
-        v0.swap(v1);
     }
-    return v0[n];
+    return dist;
 }
 
 
 std::vector<std::tuple<int64_t, int64_t, int64_t>>
- LineAlign::levenshtein_all(const std::vector<std::u32string> &strings) const {
+ LineAlign::levenshtein_all(
+    const std::vector<std::u32string> &strings, int64_t max_dist, int64_t threads
+) const {
     const int64_t len = strings.size();
+    if (threads <= 0) {
+        threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    threads = std::max<int64_t>(1, std::min(threads, len - 1));
 
-    std::vector<std::tuple<int64_t, int64_t, int64_t>> results;
+    // Each thread takes the next unclaimed row of pairs and keeps its own results
+    std::atomic<int64_t> next_row(0);
+    std::vector<std::vector<std::tuple<int64_t, int64_t, int64_t>>> partials(threads);
 
-    for (int64_t i = 0; i < len - 1; ++i) {
-        for (int64_t j = i + 1; j < len; ++j) {
-            auto dist = levenshtein(strings[i], strings[j]);
-            results.push_back(std::make_tuple(dist, i, j));
+    auto worker = [&](int64_t thread) {
+        auto &partial = partials[thread];
+        for (int64_t i = next_row++; i < len - 1; i = next_row++) {
+            for (int64_t j = i + 1; j < len; ++j) {
+                auto dist = levenshtein(strings[i], strings[j], max_dist);
+                if (max_dist < 0 || dist <= max_dist) {
+                    partial.push_back(std::make_tuple(dist, i, j));
+                }
+            }
         }
+    };
+
+    std::vector<std::thread> pool;
+    for (int64_t thread = 1; thread < threads; ++thread) {
+        pool.emplace_back(worker, thread);
+    }
+    worker(0);
+    for (auto &thread : pool) {
+        thread.join();
+    }
+
+    std::vector<std::tuple<int64_t, int64_t, int64_t>> results;
+    for (const auto &partial : partials) {
+        results.insert(results.end(), partial.begin(), partial.end());
     }
 
-    std::stable_sort(results.begin(), results.end(),
-                     [](auto const &tuple1, auto const &tuple2) {
-                         return std::get<0>(tuple1) < std::get<0>(tuple2);
-                     });
+    // The same order as a stable sort on the distance of pairs generated in order
+    std::sort(results.begin(), results.end());
 
     return results;
 }
 
 // Structures supporting the align() function.
-enum TraceDir { none, diag, left, up };
-struct Trace {
-    float val;
-    float up;
-    float left;
-    TraceDir dir;
-    Trace() : val(0.0), up(0.0), left(0.0), dir(none) {}
+enum TraceDir : uint8_t { none, diag, left, up };
+
+// Matrices with more cells than this are filled in linear memory
+const int64_t linearCells = int64_t(1) << 22;
+
+// The cells of the matrix that get filled: those with (col - row) in
+// [min(0, cols - rows) - width, max(0, cols - rows) + width]. A band wide enough to
+// hold every cell is the full matrix.
+struct Band {
+    int64_t rows;
+    int64_t cols;
+    int64_t k_lo;
+    int64_t k_hi;
+
+    Band(int64_t rows, int64_t cols, int64_t width)
+        : rows(rows),
+          cols(cols),
+          k_lo(std::min<int64_t>(0, cols - rows) - width),
+          k_hi(std::max<int64_t>(0, cols - rows) + width) {}
+
+    int64_t lo(int64_t row) const { return std::max<int64_t>(0, row + this->k_lo); }
+    int64_t hi(int64_t row) const { return std::min<int64_t>(cols, row + this->k_hi); }
+    bool full() const { return this->lo(this->rows) == 0 && this->hi(0) == this->cols; }
+};
+
+// The trace-back directions for the cells inside of a band, packed four cells to a
+// byte in one block of memory. Each row starts on a new byte. The memory is kept
+// for later fills.
+struct PackedDirs {
+    std::vector<uint8_t> bits;
+    std::vector<size_t> starts;  // The first byte of each row
+    std::vector<int64_t> lo;     // The first column of each row
+
+    void reset(const Band &band) {
+        this->starts.resize(band.rows + 2);
+        this->lo.resize(band.rows + 1);
+        this->starts[0] = 0;
+        for (int64_t row = 0; row <= band.rows; ++row) {
+            this->lo[row] = band.lo(row);
+            size_t cells = band.hi(row) - band.lo(row) + 1;
+            this->starts[row + 1] = this->starts[row] + (cells + 3) / 4;
+        }
+        this->bits.resize(this->starts[band.rows + 1]);
+    }
+
+    // Pack dirs[lo(row)] to dirs[hi(row)], the rest of dirs is ignored
+    void set_row(int64_t row, const uint8_t *dirs) {
+        const uint8_t *cell = dirs + this->lo[row];
+        for (size_t byte = this->starts[row]; byte < this->starts[row + 1]; ++byte) {
+            this->bits[byte] = cell[0] | cell[1] << 2 | cell[2] << 4 | cell[3] << 6;
+            cell += 4;
+        }
+    }
+
+    TraceDir at(int64_t row, int64_t col) const {
+        size_t cell = col - this->lo[row];
+        uint8_t byte = this->bits[this->starts[row] + cell / 4];
+        return static_cast<TraceDir>(byte >> (cell % 4 * 2) & 3);
+    }
 };
-typedef std::vector<std::vector<Trace>> TraceMatrix;
+
+// The scores for one row of the matrix, indexed by column
+struct ScoreRow {
+    std::vector<float> val;
+    std::vector<float> up;
+    std::vector<float> left;
+
+    void resize(size_t size) {
+        this->val.resize(size);
+        this->up.resize(size);
+        this->left.resize(size);
+    }
+
+    void set(int64_t col, float value) {
+        this->val[col] = value;
+        this->up[col] = value;
+        this->left[col] = value;
+    }
+};
+
+// The most cells a fill kernel handles at once. Buffers of directions are padded by
+// this on both ends of every row, so the kernels can write past the band.
+const int64_t fillPad = 8;
+
+// Everything needed to score the cells of a merge
+struct Scoring {
+    const float *profile;   // See column_profile(), widened by column_codes()
+    size_t width;           // The number of scores per profile column
+    const int32_t *codes;   // See column_codes()
+    const float *edges;     // The penalties for the first row and column
+};
+
+// Buffers used by merge(). Every thread keeps its own set and reuses it for every
+// merge it does, so there is little allocation after the first few alignments.
+struct Scratch {
+    ScoreRow prev;
+    ScoreRow cur;
+    std::vector<uint8_t> row_dirs;  // One strip of rows, padded by fillPad
+    PackedDirs dirs;
+    std::vector<ScoreRow> checkpoints;
+    std::vector<uint8_t> block;
+    std::vector<float> profile;
+    std::vector<size_t> starts;
+    std::vector<int32_t> offsets;
+    std::vector<int32_t> codes;
+    std::vector<float> edges;
+    std::vector<TraceDir> moves;
+    AlignStats *stats;       // The counters for the current merge, if collecting them
+    Clock::time_point filled;  // When the fill finished, if collecting stats
+};
+
+
+// Count the cells and substitution lookups for one row of the fill
+void count_row(AlignStats &stats, const Band &band, int64_t row) {
+    int64_t lo = band.lo(row);
+    int64_t hi = band.hi(row);
+    stats.cells += hi - lo + 1;
+    lo = std::max<int64_t>(lo, 1);
+    if (row > 0 && lo <= hi) {
+        // Every cell past the first column reads one profile score
+        stats.lookups += hi - lo + 1;
+    }
+}
+
+// The bytes in a row of scores
+size_t row_bytes(int64_t cols) {
+    return 3 * (cols + 1) * sizeof(float);
+}
+
+
+// Get the distinct characters in every column of an alignment as offsets into chars.
+// The result is packed: the offsets for column pos are in
+// offsets[starts[pos]] to offsets[starts[pos + 1]].
+void column_chars(
+    const Profile &aligned,
+    const std::vector<int32_t> &chars,
+    std::vector<size_t> &starts,
+    std::vector<int32_t> &offsets
+) {
+    starts = aligned.starts;
+    offsets.clear();
+    for (int32_t idx : aligned.chars) {
+        offsets.push_back(
+            std::lower_bound(chars.begin(), chars.end(), idx) - chars.begin());
+    }
+}
+
+/* Give every column of the other profile a single code into the profile, so that
+ * each cell reads one score, which the vector kernels can gather. A column with one
+ * character uses the offset of that character. Columns with more than one character
+ * get a new score at the end of every profile column, the best score over their
+ * characters. Columns with the same characters share it. The codes are indexed by
+ * the matrix column that reads them, (cols - pos), and padded with fillPad zeros on
+ * both ends.
+ * @return The number of lookups used to add the new scores.
+ */
+int64_t column_codes(
+    size_t len,
+    const std::vector<size_t> &starts,
+    const std::vector<int32_t> &offsets,
+    std::vector<float> &profile,
+    size_t &width,
+    std::vector<int32_t> &codes
+) {
+    int64_t cols = starts.size() - 1;
+    codes.assign(cols + 1 + 2 * fillPad, 0);
+
+    std::map<std::vector<int32_t>, int32_t> shared;
+    std::vector<const std::vector<int32_t> *> extras;
+    for (int64_t pos = 0; pos < cols; ++pos) {
+        int32_t &code = codes[fillPad + cols - pos];
+        if (starts[pos + 1] - starts[pos] == 1) {
+            code = offsets[starts[pos]];
+            continue;
+        }
+        std::vector<int32_t> chars(
+            offsets.begin() + starts[pos], offsets.begin() + starts[pos + 1]);
+        std::sort(chars.begin(), chars.end());
+        auto [it, added] = shared.emplace(chars, width + extras.size());
+        if (added) {
+            extras.push_back(&it->first);
+        }
+        code = it->second;
+    }
+    if (extras.empty()) {
+        return 0;
+    }
+
+    int64_t lookups = 0;
+    size_t wide = width + extras.size();
+    std::vector<float> widened(len * wide);
+    for (size_t pos = 0; pos < len; ++pos) {
+        const float *best = &profile[pos * width];
+        float *out = &widened[pos * wide];
+        std::copy(best, best + width, out);
+        for (size_t extra = 0; extra < extras.size(); ++extra) {
+            float score = std::numeric_limits<float>::lowest();
+            for (int32_t offset : *extras[extra]) {
+                score = std::max(score, best[offset]);
+            }
+            out[width + extra] = score;
+            lookups += extras[extra]->size();
+        }
+    }
+    profile.swap(widened);
+    width = wide;
+    return lookups;
+}
 
 
 /* Implementation notes:
- * Building strings backwards in an attempt to prevent string copies in the backtrace loop.
+ * The strings are encoded into substitution matrix indexes once, up front, so the
+ * inner loop is a flat table lookup. The trace-back only records the moves, the
+ * merged profile is built from those.
  */
+Profile LineAlign::merge(const Profile &aligned, const Profile &other) const {
+    const SubstitutionMatrix &subs = *this->matrix;
+
+    std::vector<int32_t> other_chars = distinct_chars(other);
+    subs.check_pairs(distinct_chars(aligned), other_chars);
+
+    thread_local Scratch scratch;
+    AlignStats counts;
+    scratch.stats = this->align_stats ? &counts : nullptr;
+    Clock::time_point start = scratch.stats ? Clock::now() : Clock::time_point();
+
+    std::vector<float> &profile = scratch.profile;
+    std::vector<size_t> &starts = scratch.starts;
+    std::vector<int32_t> &offsets = scratch.offsets;
+    std::vector<int32_t> &codes = scratch.codes;
+
+    // Score columns against the distinct characters in the other columns, not
+    // every row
+    column_profile(subs, aligned, other_chars, profile);
+    column_chars(other, other_chars, starts, offsets);
+    size_t width = other_chars.size();
+    counts.lookups += column_codes(aligned.length(), starts, offsets, profile, width, codes);
+
+    // The best score any diagonal move can get. This bounds the score of paths
+    // that leave the band.
+    float max_score = std::numeric_limits<float>::lowest();
+    for (float score : profile) {
+        max_score = std::max(max_score, score);
+    }
+
+    int64_t rows = aligned.length();
+    int64_t cols = other.length();
+
+    std::vector<float> &edges = scratch.edges;
+    edges.assign(std::max(rows, cols) + 1, 0.0);
+    float penalty = this->gap;
+    for (size_t i = 1; i < edges.size(); ++i) {
+        edges[i] = penalty;
+        penalty += this->skew;
+    }
+
+    Scoring scoring = {profile.data(), width, codes.data() + fillPad, edges.data()};
+
+    std::vector<TraceDir> &moves = scratch.moves;
+    if ((rows + 1) * (cols + 1) > linearCells) {
+        this->trace_linear(scratch, rows, cols, scoring, max_score);
+    } else {
+        this->trace_full(scratch, rows, cols, scoring, max_score);
+    }
+
+    // The moves start at the front of the strings. A left move is a gap in the
+    // aligned rows and an up move is a gap in the other rows.
+    Profile merged;
+    merged.starts.reserve(moves.size() + 1);
+    merged.chars.reserve(aligned.chars.size() + other.chars.size());
+    Gaps aligned_inserts;
+    Gaps other_inserts;
+    size_t pos1 = 0;
+    size_t pos2 = 0;
+    for (TraceDir dir : moves) {
+        if (dir == left) {
+            push_gap(aligned_inserts, pos1);
+        } else {
+            merged.add_column(aligned, pos1++);
+        }
+        if (dir == up) {
+            push_gap(other_inserts, pos2);
+        } else {
+            merged.add_column(other, pos2++);
+        }
+        merged.starts.push_back(merged.chars.size());
+    }
+
+    merged.gaps.reserve(aligned.gaps.size() + other.gaps.size());
+    for (const Gaps &gaps : aligned.gaps) {
+        merged.gaps.push_back(insert_gaps(gaps, aligned_inserts));
+    }
+    for (const Gaps &gaps : other.gaps) {
+        merged.gaps.push_back(insert_gaps(gaps, other_inserts));
+    }
+
+    if (scratch.stats) {
+        counts.merges = 1;
+        counts.lookups += other_chars.size() * aligned.chars.size();
+        counts.traceback = moves.size();
+        counts.fill_seconds = seconds(scratch.filled - start);
+        counts.trace_seconds = seconds(Clock::now() - scratch.filled);
+        add_stats(*this->align_stats, counts);
+    }
+    return merged;
+}
+
+
+// Fill the band, widening it until the best path is certain to stay inside, and
+// then follow the trace back from the last cell. Only two rows of scores are kept,
+// the directions for every cell go into the packed scratch.dirs.
+void LineAlign::trace_full(
+    Scratch &scratch, int64_t rows, int64_t cols, const Scoring &scoring, float max_score
+) const
+{
+    ScoreRow &prev = scratch.prev;
+    ScoreRow &cur = scratch.cur;
+    prev.resize(cols + 1);
+    cur.resize(cols + 1);
+    const size_t stride = cols + 1 + 2 * fillPad;
+    scratch.row_dirs.resize(fillPad * stride);
+    uint8_t *dirs = scratch.row_dirs.data() + fillPad;
+
+    int64_t width = this->band > 0 ? this->band : std::max(rows, cols);
+    while (true) {
+        Band band(rows, cols, width);
+        scratch.dirs.reset(band);
+        for (int64_t row = 0; row <= rows;) {
+            int64_t filled = this->fill_rows(band, row, rows, prev, cur, scoring, dirs, stride);
+            for (int64_t i = 0; i < filled; ++i, ++row) {
+                scratch.dirs.set_row(row, dirs + i * stride);
+                if (scratch.stats) {
+                    count_row(*scratch.stats, band, row);
+                }
+            }
+            std::swap(prev, cur);
+        }
+        float score = prev.val[cols];
+        if (band.full() || score > this->band_bound(rows, cols, width, max_score)) {
+            break;
+        }
+        // The banded score is a lower bound on the best score, so jump straight to
+        // the width where it would beat the bound
+        width = std::max(2 * width, this->band_width(rows, cols, score, max_score));
+    }
+
+    if (scratch.stats) {
+        scratch.stats->matrix_bytes =
+            scratch.dirs.bits.size() + scratch.row_dirs.size() + 2 * row_bytes(cols);
+        scratch.filled = Clock::now();
+    }
+
+    std::vector<TraceDir> &moves = scratch.moves;
+    moves.clear();
+    int64_t row = rows;
+    int64_t col = cols;
+    while (true) {
+        TraceDir dir = scratch.dirs.at(row, col);
+        if (dir == none) {
+            break;
+        }
+        moves.push_back(dir);
+        row -= dir == left ? 0 : 1;
+        col -= dir == up ? 0 : 1;
+    }
+}
+
+
+/* The same result as trace_full() in O(cols * sqrt(rows)) memory instead of
+ * O(rows * cols). The forward pass only keeps two rows of scores and saves a
+ * checkpoint row every step rows. The trace-back then recomputes the directions for
+ * one block of rows at a time, starting from the checkpoint above it. Because the
+ * directions are recomputed exactly, the trace-back follows the same cells as it
+ * would in the full matrix. This costs about one extra fill.
+ */
+void LineAlign::trace_linear(
+    Scratch &scratch, int64_t rows, int64_t cols, const Scoring &scoring, float max_score
+) const
+{
+    // A whole number of strips, so that checkpoint rows end a strip
+    int64_t step = std::max<int64_t>(1, std::ceil(std::sqrt(rows)));
+    step = (step + fillPad - 1) / fillPad * fillPad;
+    std::vector<ScoreRow> &checkpoints = scratch.checkpoints;
+    checkpoints.resize(rows / step + 1);
+    ScoreRow &prev = scratch.prev;
+    ScoreRow &cur = scratch.cur;
+    prev.resize(cols + 1);
+    cur.resize(cols + 1);
+
+    int64_t width = this->band > 0 ? this->band : std::max(rows, cols);
+    while (true) {
+        Band band(rows, cols, width);
+        for (int64_t row = 0; row <= rows;) {
+            int64_t filled = this->fill_rows(band, row, rows, prev, cur, scoring, nullptr, 0);
+            std::swap(prev, cur);
+            for (int64_t i = 0; i < filled; ++i, ++row) {
+                if (scratch.stats) {
+                    count_row(*scratch.stats, band, row);
+                }
+            }
+            if ((row - 1) % step == 0) {
+                checkpoints[(row - 1) / step] = prev;
+            }
+        }
+        float score = prev.val[cols];
+        if (band.full() || score > this->band_bound(rows, cols, width, max_score)) {
+            break;
+        }
+        width = std::max(2 * width, this->band_width(rows, cols, score, max_score));
+    }
+    Band band(rows, cols, width);
+
+    std::vector<TraceDir> &moves = scratch.moves;
+    moves.clear();
+    std::vector<uint8_t> &block = scratch.block;
+    const size_t stride = cols + 1 + 2 * fillPad;
+    block.resize(step * stride);
+
+    if (scratch.stats) {
+        scratch.stats->matrix_bytes =
+            (checkpoints.size() + 2) * row_bytes(cols) + block.size();
+        scratch.filled = Clock::now();
+    }
+    int64_t row = rows;
+    int64_t col = cols;
+    while (row > 0) {
+        // Recompute the directions from the checkpoint above the current row
+        int64_t base = (row - 1) / step * step;
+        prev = checkpoints[base / step];
+        for (int64_t r = base + 1; r <= row;) {
+            uint8_t *dirs = &block[(r - base - 1) * stride + fillPad];
+            int64_t filled = this->fill_rows(band, r, row, prev, cur, scoring, dirs, stride);
+            std::swap(prev, cur);
+            for (int64_t i = 0; i < filled; ++i, ++r) {
+                if (scratch.stats) {
+                    count_row(*scratch.stats, band, r);
+                }
+            }
+        }
+        while (row > base) {
+            TraceDir dir = static_cast<TraceDir>(
+                block[(row - base - 1) * stride + fillPad + col]);
+            moves.push_back(dir);
+            row -= dir == left ? 0 : 1;
+            col -= dir == up ? 0 : 1;
+        }
+    }
+    moves.insert(moves.end(), col, left);
+}
+
+
+/* The vector fill kernels.
+ * Each cell depends on the cells to its left, above, and above-left, so the cells
+ * of a row cannot be filled at the same time. The cells on an anti-diagonal can be.
+ * A kernel fills a strip of as many rows as it has lanes. Lane k holds row
+ * (first + k) and at each step every lane moves one column to the right, with
+ * lane k one column behind lane k - 1, so a vector is always on one anti-diagonal.
+ * Lane k gets its left neighbour from itself one step back, its up neighbour from
+ * lane k - 1 one step back, and its diagonal neighbour from lane k - 1 two steps
+ * back. Lane 0 reads these from the row above the strip. The cells are scored
+ * with the same float operations as fill_row() and cells outside of the band are
+ * set to -infinity, so the scores and directions are the same bit for bit and so
+ * are the trace-backs.
+ */
+
+// The rows of the matrix filled by a vector kernel
+struct Strip {
+    const Band *band;
+    int64_t first;          // The first row of the strip
+    const ScoreRow *prev;   // Row first - 1
+    ScoreRow *cur;          // Gets the last row of the strip
+    const Scoring *scoring;
+    uint8_t *dirs;          // Row (first + k) goes at dirs + k * stride, if given
+    size_t stride;
+    float gap;
+    float skew;
+
+    // The first and last columns that any lane is in: lane 0 starts at the start
+    // of its band and the last lane ends at the end of its band
+    int64_t start() const { return this->band->lo(this->first); }
+    int64_t end(int64_t lanes) const {
+        return this->band->hi(this->first + lanes - 1) + lanes - 1;
+    }
+
+    // The row above the strip, for lane 0, is -infinity past the end of the matrix
+    float above(const std::vector<float> &scores, int64_t col) const {
+        return col <= this->band->cols
+            ? scores[col] : -std::numeric_limits<float>::infinity();
+    }
+
+    // Write the directions for the count steps that ended at column col of lane 0,
+    // where the bytes of rows[k] are the directions for lane k, one per step
+    template <typename Bytes>
+    void set_dirs(const Bytes *rows, int64_t col, int64_t count) const {
+        int64_t start = col - count + 1;
+        for (size_t k = 0; k < sizeof(Bytes); ++k) {
+            std::memcpy(this->dirs + k * this->stride + start - k, &rows[k], count);
+        }
+    }
+
+    // The last lane's cell goes into cur, when it is inside of the matrix
+    void set_last(int64_t col, float val, float up, float left) const {
+        if (col >= 0 && col <= this->band->cols) {
+            this->cur->val[col] = val;
+            this->cur->up[col] = up;
+            this->cur->left[col] = left;
+        }
+    }
+};
+
+#ifdef FILL_X86
+// Turn the directions for up to 8 steps of 8 lanes into 8 bytes for each row,
+// writing them a row at a time instead of a byte at a time
+__attribute__((target("avx2")))
+inline void transpose_dirs(const Strip &strip, const uint64_t *steps, int64_t col, int64_t count) {
+    const __m128i *in = reinterpret_cast<const __m128i *>(steps);
+    __m128i s01 = _mm_load_si128(in);
+    __m128i s23 = _mm_load_si128(in + 1);
+    __m128i s45 = _mm_load_si128(in + 2);
+    __m128i s67 = _mm_load_si128(in + 3);
+    __m128i t0 = _mm_unpacklo_epi8(s01, _mm_srli_si128(s01, 8));
+    __m128i t1 = _mm_unpacklo_epi8(s23, _mm_srli_si128(s23, 8));
+    __m128i t2 = _mm_unpacklo_epi8(s45, _mm_srli_si128(s45, 8));
+    __m128i t3 = _mm_unpacklo_epi8(s67, _mm_srli_si128(s67, 8));
+    __m128i u0 = _mm_unpacklo_epi16(t0, t1);
+    __m128i u1 = _mm_unpackhi_epi16(t0, t1);
+    __m128i u2 = _mm_unpacklo_epi16(t2, t3);
+    __m128i u3 = _mm_unpackhi_epi16(t2, t3);
+    alignas(16) uint64_t rows[8];
+    __m128i *out = reinterpret_cast<__m128i *>(rows);
+    _mm_store_si128(out, _mm_unpacklo_epi32(u0, u2));
+    _mm_store_si128(out + 1, _mm_unpackhi_epi32(u0, u2));
+    _mm_store_si128(out + 2, _mm_unpacklo_epi32(u1, u3));
+    _mm_store_si128(out + 3, _mm_unpackhi_epi32(u1, u3));
+    strip.set_dirs(rows, col, count);
+}
+
+__attribute__((target("avx2")))
+void fill_strip_avx2(const Strip &strip) {
+    const int64_t lanes = 8;
+    const Band &band = *strip.band;
+    const Scoring &scoring = *strip.scoring;
+    const float outside = -std::numeric_limits<float>::infinity();
+    const __m256 gap = _mm256_set1_ps(strip.gap);
+    const __m256 skew = _mm256_set1_ps(strip.skew);
+    const __m256 minus_inf = _mm256_set1_ps(outside);
+    const __m256i lane = _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7);
+    const __m256i shift = _mm256_setr_epi32(0, 0, 1, 2, 3, 4, 5, 6);
+    const __m256i reverse = _mm256_setr_epi32(7, 6, 5, 4, 3, 2, 1, 0);
+    const __m256i from_diag = _mm256_set1_epi32(diag);
+    const __m256i from_up = _mm256_set1_epi32(up);
+    const __m256i from_left = _mm256_set1_epi32(left);
+
+    alignas(32) int32_t lo[lanes];
+    alignas(32) int32_t hi[lanes];
+    alignas(32) int32_t base[lanes];
+    alignas(32) float edges[lanes];
+    for (int64_t k = 0; k < lanes; ++k) {
+        int64_t row = strip.first + k;
+        lo[k] = band.lo(row);
+        hi[k] = band.hi(row);
+        base[k] = (band.rows - row) * scoring.width;
+        edges[k] = scoring.edges[row];
+    }
+    const __m256i lo_col = _mm256_load_si256(reinterpret_cast<const __m256i *>(lo));
+    const __m256i hi_col = _mm256_load_si256(reinterpret_cast<const __m256i *>(hi));
+    const __m256i row_base = _mm256_load_si256(reinterpret_cast<const __m256i *>(base));
+    const __m256 edge = _mm256_load_ps(edges);
+
+    // The cells one step back, and the values two steps back
+    __m256 val1 = minus_inf;
+    __m256 up1 = minus_inf;
+    __m256 left1 = minus_inf;
+    __m256 val2 = minus_inf;
+
+    int64_t first = strip.start();
+    int64_t last = strip.end(lanes);
+    // The directions for the last few steps, one byte per lane
+    alignas(16) uint64_t steps[lanes];
+
+    float above_diag = first > 0 ? strip.prev->val[first - 1] : outside;
+    for (int64_t col = first; col <= last; ++col) {
+        float above_val = strip.above(strip.prev->val, col);
+        float above_up = strip.above(strip.prev->up, col);
+
+        // Shift lane k - 1 into lane k and put the row above into lane 0
+        __m256 up_up = _mm256_blend_ps(
+            _mm256_permutevar8x32_ps(up1, shift), _mm256_set1_ps(above_up), 1);
+        __m256 up_val = _mm256_blend_ps(
+            _mm256_permutevar8x32_ps(val1, shift), _mm256_set1_ps(above_val), 1);
+        __m256 diag_val = _mm256_blend_ps(
+            _mm256_permutevar8x32_ps(val2, shift), _mm256_set1_ps(above_diag), 1);
+        above_diag = above_val;
+
+        __m256i cols = _mm256_sub_epi32(_mm256_set1_epi32(col), lane);
+        __m256i codes = _mm256_permutevar8x32_epi32(
+            _mm256_loadu_si256(
+                reinterpret_cast<const __m256i *>(scoring.codes + col - lanes + 1)),
+            reverse);
+        __m256 sub = _mm256_i32gather_ps(
+            scoring.profile, _mm256_add_epi32(row_base, codes), 4);
+
+        __m256 cell_up = _mm256_max_ps(
+            _mm256_add_ps(up_up, skew), _mm256_add_ps(up_val, gap));
+        __m256 cell_left = _mm256_max_ps(
+            _mm256_add_ps(left1, skew), _mm256_add_ps(val1, gap));
+        diag_val = _mm256_add_ps(sub, diag_val);
+        __m256 val = _mm256_max_ps(_mm256_max_ps(diag_val, cell_up), cell_left);
+
+        __m256i dirs = _mm256_blendv_epi8(
+            from_left, from_up, _mm256_castps_si256(_mm256_cmp_ps(val, cell_up, _CMP_EQ_OQ)));
+        dirs = _mm256_blendv_epi8(
+            dirs, from_diag, _mm256_castps_si256(_mm256_cmp_ps(val, diag_val, _CMP_EQ_OQ)));
+
+        // The first column gets the edge penalties and the cells outside of the band
+        // are -infinity
+        __m256 is_edge = _mm256_castsi256_ps(_mm256_cmpeq_epi32(cols, _mm256_setzero_si256()));
+        val = _mm256_blendv_ps(val, edge, is_edge);
+        cell_up = _mm256_blendv_ps(cell_up, edge, is_edge);
+        cell_left = _mm256_blendv_ps(cell_left, edge, is_edge);
+        dirs = _mm256_blendv_epi8(dirs, from_up, _mm256_castps_si256(is_edge));
+
+        __m256 is_out = _mm256_castsi256_ps(_mm256_or_si256(
+            _mm256_cmpgt_epi32(lo_col, cols), _mm256_cmpgt_epi32(cols, hi_col)));
+        val = _mm256_blendv_ps(val, minus_inf, is_out);
+        cell_up = _mm256_blendv_ps(cell_up, minus_inf, is_out);
+        cell_left = _mm256_blendv_ps(cell_left, minus_inf, is_out);
+
+        if (strip.dirs) {
+            __m128i words = _mm_packs_epi32(
+                _mm256_castsi256_si128(dirs), _mm256_extracti128_si256(dirs, 1));
+            int64_t step = (col - first) % lanes;
+            steps[step] = _mm_cvtsi128_si64(_mm_packus_epi16(words, words));
+            if (step == lanes - 1 || col == last) {
+                transpose_dirs(strip, steps, col, step + 1);
+            }
+        }
+
+        const __m256i top = _mm256_set1_epi32(lanes - 1);
+        strip.set_last(
+            col - lanes + 1,
+            _mm256_cvtss_f32(_mm256_permutevar8x32_ps(val, top)),
+            _mm256_cvtss_f32(_mm256_permutevar8x32_ps(cell_up, top)),
+            _mm256_cvtss_f32(_mm256_permutevar8x32_ps(cell_left, top)));
+
+        val2 = val1;
+        val1 = val;
+        up1 = cell_up;
+        left1 = cell_left;
+    }
+}
+
+// Shift the lanes up by one and put a value into lane 0
+__attribute__((target("sse4.1")))
+inline __m128 shift_in(__m128 vec, float value) {
+    __m128 shifted = _mm_castsi128_ps(_mm_slli_si128(_mm_castps_si128(vec), 4));
+    return _mm_blend_ps(shifted, _mm_set_ss(value), 1);
+}
+
+__attribute__((target("sse4.1")))
+void fill_strip_sse4(const Strip &strip) {
+    const int64_t lanes = 4;
+    const Band &band = *strip.band;
+    const Scoring &scoring = *strip.scoring;
+    const float outside = -std::numeric_limits<float>::infinity();
+    const __m128 gap = _mm_set1_ps(strip.gap);
+    const __m128 skew = _mm_set1_ps(strip.skew);
+    const __m128 minus_inf = _mm_set1_ps(outside);
+    const __m128i lane = _mm_setr_epi32(0, 1, 2, 3);
+    const __m128i from_diag = _mm_set1_epi32(diag);
+    const __m128i from_up = _mm_set1_epi32(up);
+    const __m128i from_left = _mm_set1_epi32(left);
+
+    const float *best[lanes];
+    alignas(16) int32_t lo[lanes];
+    alignas(16) int32_t hi[lanes];
+    alignas(16) float edges[lanes];
+    for (int64_t k = 0; k < lanes; ++k) {
+        int64_t row = strip.first + k;
+        best[k] = &scoring.profile[(band.rows - row) * scoring.width];
+        lo[k] = band.lo(row);
+        hi[k] = band.hi(row);
+        edges[k] = scoring.edges[row];
+    }
+    const __m128i lo_col = _mm_load_si128(reinterpret_cast<const __m128i *>(lo));
+    const __m128i hi_col = _mm_load_si128(reinterpret_cast<const __m128i *>(hi));
+    const __m128 edge = _mm_load_ps(edges);
+
+    __m128 val1 = minus_inf;
+    __m128 up1 = minus_inf;
+    __m128 left1 = minus_inf;
+    __m128 val2 = minus_inf;
+
+    int64_t first = strip.start();
+    int64_t last = strip.end(lanes);
+    alignas(16) uint32_t steps[lanes];
+    const __m128i transpose = _mm_setr_epi8(0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15);
+
+    float above_diag = first > 0 ? strip.prev->val[first - 1] : outside;
+    for (int64_t col = first; col <= last; ++col) {
+        float above_val = strip.above(strip.prev->val, col);
+        __m128 up_up = shift_in(up1, strip.above(strip.prev->up, col));
+        __m128 up_val = shift_in(val1, above_val);
+        __m128 diag_val = shift_in(val2, above_diag);
+        above_diag = above_val;
+
+        __m128i cols = _mm_sub_epi32(_mm_set1_epi32(col), lane);
+        const int32_t *codes = scoring.codes + col;
+        __m128 sub = _mm_setr_ps(
+            best[0][codes[0]], best[1][codes[-1]], best[2][codes[-2]], best[3][codes[-3]]);
+
+        __m128 cell_up = _mm_max_ps(_mm_add_ps(up_up, skew), _mm_add_ps(up_val, gap));
+        __m128 cell_left = _mm_max_ps(_mm_add_ps(left1, skew), _mm_add_ps(val1, gap));
+        diag_val = _mm_add_ps(sub, diag_val);
+        __m128 val = _mm_max_ps(_mm_max_ps(diag_val, cell_up), cell_left);
+
+        __m128i dirs = _mm_blendv_epi8(
+            from_left, from_up, _mm_castps_si128(_mm_cmpeq_ps(val, cell_up)));
+        dirs = _mm_blendv_epi8(
+            dirs, from_diag, _mm_castps_si128(_mm_cmpeq_ps(val, diag_val)));
+
+        __m128 is_edge = _mm_castsi128_ps(_mm_cmpeq_epi32(cols, _mm_setzero_si128()));
+        val = _mm_blendv_ps(val, edge, is_edge);
+        cell_up = _mm_blendv_ps(cell_up, edge, is_edge);
+        cell_left = _mm_blendv_ps(cell_left, edge, is_edge);
+        dirs = _mm_blendv_epi8(dirs, from_up, _mm_castps_si128(is_edge));
+
+        __m128 is_out = _mm_castsi128_ps(_mm_or_si128(
+            _mm_cmpgt_epi32(lo_col, cols), _mm_cmpgt_epi32(cols, hi_col)));
+        val = _mm_blendv_ps(val, minus_inf, is_out);
+        cell_up = _mm_blendv_ps(cell_up, minus_inf, is_out);
+        cell_left = _mm_blendv_ps(cell_left, minus_inf, is_out);
+
+        if (strip.dirs) {
+            __m128i words = _mm_packs_epi32(dirs, dirs);
+            int64_t step = (col - first) % lanes;
+            steps[step] = _mm_cvtsi128_si32(_mm_packus_epi16(words, words));
+            if (step == lanes - 1 || col == last) {
+                // Turn the 4 steps of 4 lanes into 4 bytes for each row
+                alignas(16) uint32_t rows[lanes];
+                _mm_store_si128(
+                    reinterpret_cast<__m128i *>(rows),
+                    _mm_shuffle_epi8(
+                        _mm_load_si128(reinterpret_cast<const __m128i *>(steps)), transpose));
+                strip.set_dirs(rows, col, step + 1);
+            }
+        }
+
+        strip.set_last(
+            col - lanes + 1,
+            _mm_cvtss_f32(_mm_shuffle_ps(val, val, _MM_SHUFFLE(3, 3, 3, 3))),
+            _mm_cvtss_f32(_mm_shuffle_ps(cell_up, cell_up, _MM_SHUFFLE(3, 3, 3, 3))),
+            _mm_cvtss_f32(_mm_shuffle_ps(cell_left, cell_left, _MM_SHUFFLE(3, 3, 3, 3))));
+
+        val2 = val1;
+        val1 = val;
+        up1 = cell_up;
+        left1 = cell_left;
+    }
+}
+#endif
+
+// A way to fill the matrix. The scalar kernel fills one row at a time with
+// fill_row(), the others fill strips of rows.
+struct FillKernel {
+    const char *name;
+    int64_t lanes;
+    void (*fill)(const Strip &strip);
+    bool (*supported)();
+};
+
+const FillKernel fillKernels[] = {
+#ifdef FILL_X86
+    {"avx2", 8, fill_strip_avx2, [] { return __builtin_cpu_supports("avx2") != 0; }},
+    {"sse4", 4, fill_strip_sse4, [] { return __builtin_cpu_supports("sse4.1") != 0; }},
+#endif
+    {"scalar", 1, nullptr, [] { return true; }},
+};
+
+// The widest kernel the CPU can run
+const FillKernel *best_fill_kernel() {
+#ifdef FILL_X86
+    __builtin_cpu_init();
+#endif
+    for (const FillKernel &kernel : fillKernels) {
+        if (kernel.supported()) {
+            return &kernel;
+        }
+    }
+    return nullptr;
+}
+
+std::atomic<const FillKernel *> fillKernel(best_fill_kernel());
+
+std::vector<std::string> fill_kernels() {
+    std::vector<std::string> names;
+    for (const FillKernel &kernel : fillKernels) {
+        if (kernel.supported()) {
+            names.push_back(kernel.name);
+        }
+    }
+    return names;
+}
+
+std::string fill_kernel() {
+    return fillKernel.load()->name;
+}
+
+void set_fill_kernel(const std::string &name) {
+    for (const FillKernel &kernel : fillKernels) {
+        if (kernel.name == name && kernel.supported()) {
+            fillKernel.store(&kernel);
+            return;
+        }
+    }
+    throw std::invalid_argument("The fill kernel is not available: " + name);
+}
+
+
+/* Fill rows of the matrix from row up to at most last, and return how many were
+ * filled. A vector kernel fills a strip of rows when there are enough left, the
+ * rest are filled one at a time. The last row filled goes into cur and the
+ * directions for row (row + i) go to dirs + i * stride, if dirs is given.
+ */
+int64_t LineAlign::fill_rows(
+    const Band &band,
+    int64_t row,
+    int64_t last,
+    const ScoreRow &prev,
+    ScoreRow &cur,
+    const Scoring &scoring,
+    uint8_t *dirs,
+    size_t stride
+) const
+{
+    const FillKernel *kernel = fillKernel.load(std::memory_order_relaxed);
+    int64_t lanes = kernel->lanes;
+
+    // The kernels use 32 bit columns and profile indexes
+    const int64_t limit = std::numeric_limits<int32_t>::max();
+    bool fits = band.cols + fillPad < limit
+        && (band.rows + 1) * static_cast<int64_t>(scoring.width) < limit;
+
+    if (lanes == 1 || row == 0 || row + lanes - 1 > last || !fits) {
+        this->fill_row(band, row, prev, cur, scoring, dirs);
+        return 1;
+    }
+
+    Strip strip = {
+        &band, row, &prev, &cur, &scoring, dirs, stride, this->gap, this->skew
+    };
+    kernel->fill(strip);
+
+    // Like fill_row(), so the next strip does not need to check the edge of the band
+    int64_t end = row + lanes - 1;
+    if (band.hi(end) < band.cols) {
+        cur.set(band.hi(end) + 1, -std::numeric_limits<float>::infinity());
+    }
+    return lanes;
+}
+
+
+/* Fill one row of the matrix from the row above it. Row zero is filled with the
+ * edge penalties and prev is ignored. Cells just outside of the band are set to
+ * -infinity so that the next row does not need to check for them. The directions
+ * are written to dirs, indexed by column, if it is given.
+ */
+void LineAlign::fill_row(
+    const Band &band,
+    int64_t row,
+    const ScoreRow &prev,
+    ScoreRow &cur,
+    const Scoring &scoring,
+    uint8_t *dirs
+) const
+{
+    const float outside = -std::numeric_limits<float>::infinity();
+    const int64_t rows = band.rows;
+    const int64_t cols = band.cols;
+    const int64_t lo = band.lo(row);
+    const int64_t hi = band.hi(row);
+
+    if (lo > 0) {
+        cur.set(lo - 1, outside);
+    }
+    if (hi < cols) {
+        cur.set(hi + 1, outside);
+    }
+
+    if (row == 0) {
+        cur.set(0, 0.0);
+        if (dirs) {
+            dirs[0] = none;
+        }
+        for (int64_t col = 1; col <= hi; ++col) {
+            cur.set(col, scoring.edges[col]);
+            if (dirs) {
+                dirs[col] = left;
+            }
+        }
+        return;
+    }
+
+    int64_t col = lo;
+    if (lo == 0) {
+        cur.set(0, scoring.edges[row]);
+        if (dirs) {
+            dirs[0] = up;
+        }
+        col = 1;
+    }
+
+    const float *best = &scoring.profile[(rows - row) * scoring.width];
+    for (; col <= hi; ++col) {
+        float cell_up = std::max(prev.up[col] + this->skew, prev.val[col] + this->gap);
+        float cell_left =
+            std::max(cur.left[col - 1] + this->skew, cur.val[col - 1] + this->gap);
+
+        float diag_val = best[scoring.codes[col]] + prev.val[col - 1];
+        float val = std::max({diag_val, cell_up, cell_left});
+
+        cur.val[col] = val;
+        cur.up[col] = cell_up;
+        cur.left[col] = cell_left;
+
+        if (dirs) {
+            dirs[col] = val == diag_val ? diag : val == cell_up ? up : left;
+        }
+    }
+}
+
+
+/* A path that leaves a band of the given width needs at least
+ * |rows - cols| + 2 * (width + 1) gap characters, and every gap character costs at
+ * least max(gap, skew). The rest of the path is diagonal moves that score at most
+ * max_score each. If the best path inside of the band beats this bound then it is
+ * the best path overall, and every cell on it has the same value and direction as
+ * it would in the full matrix.
+ */
+double LineAlign::band_bound(
+    int64_t rows, int64_t cols, int64_t width, float max_score
+) const
+{
+    double gap_score = std::max(this->gap, this->skew);
+    auto bound = [&](int64_t gaps) {
+        return (rows + cols - gaps) / 2.0 * max_score + gaps * gap_score;
+    };
+    int64_t min_gaps = std::abs(rows - cols) + 2 * (width + 1);
+    return std::max(bound(min_gaps), bound(rows + cols));
+}
+
+
+// The narrowest band where a path scoring the given score beats band_bound()
+int64_t LineAlign::band_width(
+    int64_t rows, int64_t cols, float score, float max_score
+) const
+{
+    double slope = std::max(this->gap, this->skew) - max_score / 2.0;
+    double gaps = (score - (rows + cols) / 2.0 * max_score) / slope;
+    if (slope >= 0.0 || gaps > rows + cols) {
+        return std::max(rows, cols);
+    }
+    int64_t width = std::floor((gaps - std::abs(rows - cols)) / 2.0);
+    return std::max<int64_t>(width, 0) + 1;
+}
+
+
 std::vector<std::u32string>
 LineAlign::align(const std::vector<std::u32string> &lines) const {
     if (lines.size() <= 1) {
         return lines;
     }
-    std::vector<std::u32string> aligned;
-    aligned.push_back(lines[0]);
+    return this->render_all(lines, this->align_profile(lines).gaps);
+}
+
+
+Encoded LineAlign::align_codes(const std::vector<std::u32string> &lines) const {
+    if (lines.size() <= 1) {
+        return this->render_codes_all(lines, std::vector<Gaps>(lines.size()));
+    }
+    return this->render_codes_all(lines, this->align_profile(lines).gaps);
+}
+
+
+std::vector<Gaps> LineAlign::align_gaps(const std::vector<std::u32string> &lines) const {
+    if (lines.size() <= 1) {
+        return std::vector<Gaps>(lines.size());
+    }
+    return this->align_profile(lines).gaps;
+}
+
+
+Profile LineAlign::align_profile(const std::vector<std::u32string> &lines) const {
+    const SubstitutionMatrix &subs = *this->matrix;
+    if (this->align_stats) {
+        AlignStats counts;
+        counts.calls = 1;
+        add_stats(*this->align_stats, counts);
+    }
+
+    Profile aligned(subs.encode(lines[0], this->gap_char));
 
     for (size_t ln = 1; ln < lines.size(); ++ln) {
-        // Build the matrix
-        size_t rows = aligned[0].length();
-        size_t cols = lines[ln].length();
-        size_t rows_p1 = rows + 1;
-        size_t cols_p1 = cols + 1;
-
-        TraceMatrix trace(rows_p1, std::vector<Trace>(cols_p1));
-
-        float penalty = this->gap;
-        for (size_t row = 1; row < rows_p1; ++row) {
-            trace[row][0].val = penalty;
-            trace[row][0].up = penalty;
-            trace[row][0].left = penalty;
-            trace[row][0].dir = up;
-            penalty += this->skew;
-        }
-
-        penalty = this->gap;
-        for (size_t col = 1; col < cols_p1; ++col) {
-            trace[0][col].val = penalty;
-            trace[0][col].up = penalty;
-            trace[0][col].left = penalty;
-            trace[0][col].dir = left;
-            penalty += this->skew;
-        }
-
-        for (size_t row = 1; row < rows_p1; ++row) {
-            for (size_t col = 1; col < cols_p1; ++col) {
-                Trace &cell = trace[row][col];
-                Trace &cell_up = trace[row - 1][col];
-                Trace &cell_left = trace[row][col - 1];
-
-                cell.up = std::max({cell_up.up + this->skew, cell_up.val + this->gap});
-                cell.left = std::max({
-                    cell_left.left + this->skew, cell_left.val + this->gap});
-
-                float diag_val = std::numeric_limits<float>::lowest();
-                for (size_t k = 0; k < aligned.size(); ++k) {
-                    char32_t aligned_char = aligned[k][rows - row];
-                    char32_t lines_char = lines[ln][cols - col];
-
-                    if (aligned_char == this->gap_char) {
-                        continue;
-                    }
-
-                    if (aligned_char > lines_char) {
-                        std::swap(lines_char, aligned_char);
-                    }
-
-                    std::u32string key = U"";
-                    key += aligned_char;
-                    key += lines_char;
-                    float value;
-                    try {
-                        value = this->substitutions.at(key);
-                    } catch (std::out_of_range &e) {
-                        std::stringstream err;
-                        err << "One of '" << convert_32_8(key)
-                            << "' these characters are missing from the "
-                            << "substitution matrix.";
-                        throw std::invalid_argument(err.str());
-                    }
-                    diag_val = value > diag_val ? value : diag_val;
-                }
-                diag_val += trace[row - 1][col - 1].val;
-                cell.val = std::max({diag_val, cell.up, cell.left});
+        aligned = this->merge(aligned, Profile(subs.encode(lines[ln], this->gap_char)));
+    }
+    return aligned;
+}
 
-                if (cell.val == diag_val) {
-                    cell.dir = diag;
-                } else if (cell.val == cell.up) {
-                    cell.dir = up;
-                } else {
-                    cell.dir = left;
+
+std::vector<std::u32string> LineAlign::render_all(
+    const std::vector<std::u32string> &lines, const std::vector<Gaps> &gaps
+) const
+{
+    std::vector<std::u32string> results;
+    results.reserve(lines.size());
+    for (size_t k = 0; k < lines.size(); ++k) {
+        results.push_back(render(lines[k], gaps[k], this->gap_char));
+    }
+    return results;
+}
+
+
+Encoded LineAlign::render_codes_all(
+    const std::vector<std::u32string> &lines, const std::vector<Gaps> &gaps
+) const
+{
+    Encoded results;
+    results.reserve(lines.size());
+    for (size_t k = 0; k < lines.size(); ++k) {
+        results.push_back(render_codes(lines[k], gaps[k], this->gap_char));
+    }
+    return results;
+}
+
+
+// UPGMA clustering of the pairwise Levenshtein distances
+std::vector<std::pair<int64_t, int64_t>>
+LineAlign::guide_tree(const std::vector<std::u32string> &lines) const {
+    const int64_t len = lines.size();
+    std::vector<std::pair<int64_t, int64_t>> merges;
+    if (len <= 1) {
+        return merges;
+    }
+
+    // Distances between the current clusters, indexed by node number
+    const int64_t nodes = 2 * len - 1;
+    std::vector<double> dist(nodes * nodes, 0.0);
+    for (const auto &[d, i, j] : this->levenshtein_all(lines)) {
+        dist[i * nodes + j] = dist[j * nodes + i] = d;
+    }
+
+    std::vector<int64_t> active(len);
+    std::iota(active.begin(), active.end(), 0);
+    std::vector<double> sizes(nodes, 1.0);
+
+    for (int64_t node = len; node < nodes; ++node) {
+        // Closest pair, ties go to the lowest node numbers
+        size_t best1 = 0;
+        size_t best2 = 1;
+        for (size_t i = 0; i < active.size() - 1; ++i) {
+            for (size_t j = i + 1; j < active.size(); ++j) {
+                if (dist[active[i] * nodes + active[j]]
+                        < dist[active[best1] * nodes + active[best2]]) {
+                    best1 = i;
+                    best2 = j;
                 }
             }
         }
+        int64_t node1 = active[best1];
+        int64_t node2 = active[best2];
+        merges.push_back(std::make_pair(node1, node2));
 
-        // Trace-back
-        int64_t row = rows;
-        int64_t col = cols;
-        std::u32string new_line;
+        active.erase(active.begin() + best2);
+        active.erase(active.begin() + best1);
 
-        std::vector<std::u32string> new_aligned;
-        for (size_t k = 0; k < aligned.size(); ++k) {
-            new_aligned.push_back(U"");
+        sizes[node] = sizes[node1] + sizes[node2];
+        for (int64_t other : active) {
+            double d = (dist[node1 * nodes + other] * sizes[node1]
+                        + dist[node2 * nodes + other] * sizes[node2]) / sizes[node];
+            dist[node * nodes + other] = dist[other * nodes + node] = d;
         }
+        active.push_back(node);
+    }
+    return merges;
+}
 
-        while (true) {
-            Trace cell = trace[row][col];
-            if (cell.dir == none) {
-                break;
-            }
 
-            if (cell.dir == diag) {
-                for (size_t k = 0; k < aligned.size(); ++k) {
-                    new_aligned[k] += aligned[k][rows - row];
-                }
-                new_line += lines[ln][cols - col];
-                --row;
-                --col;
-            } else if (cell.dir == up) {
-                for (size_t k = 0; k < aligned.size(); ++k) {
-                    new_aligned[k] += aligned[k][rows - row];
+// Align the subtree under node. Independent subtrees are aligned in separate
+// threads while there are threads to spare.
+Profile LineAlign::align_subtree(
+    const std::vector<std::pair<int64_t, int64_t>> &merges,
+    int64_t node,
+    const Encoded &leaves,
+    int64_t threads
+) const
+{
+    const int64_t len = leaves.size();
+    if (node < len) {
+        return Profile(leaves[node]);
+    }
+    auto [node1, node2] = merges[node - len];
+
+    Profile aligned1;
+    Profile aligned2;
+    if (threads > 1) {
+        auto future = std::async(std::launch::async, [&]() {
+            return this->align_subtree(merges, node1, leaves, threads / 2);
+        });
+        aligned2 = this->align_subtree(merges, node2, leaves, threads - threads / 2);
+        aligned1 = future.get();
+    } else {
+        aligned1 = this->align_subtree(merges, node1, leaves, 1);
+        aligned2 = this->align_subtree(merges, node2, leaves, 1);
+    }
+    return this->merge(aligned1, aligned2);
+}
+
+
+std::vector<std::u32string>
+LineAlign::align_tree(const std::vector<std::u32string> &lines, int64_t threads) const {
+    if (lines.size() <= 1) {
+        return lines;
+    }
+    return this->render_all(lines, this->align_tree_gaps(lines, threads));
+}
+
+
+Encoded
+LineAlign::align_tree_codes(const std::vector<std::u32string> &lines, int64_t threads) const {
+    return this->render_codes_all(lines, this->align_tree_gaps(lines, threads));
+}
+
+
+std::vector<Gaps>
+LineAlign::align_tree_gaps(const std::vector<std::u32string> &lines, int64_t threads) const {
+    if (lines.size() <= 1) {
+        return std::vector<Gaps>(lines.size());
+    }
+    const SubstitutionMatrix &subs = *this->matrix;
+    if (threads <= 0) {
+        threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    if (this->align_stats) {
+        AlignStats counts;
+        counts.calls = 1;
+        add_stats(*this->align_stats, counts);
+    }
+
+    Encoded leaves;
+    for (const auto &line : lines) {
+        leaves.push_back(subs.encode(line, this->gap_char));
+    }
+
+    auto merges = this->guide_tree(lines);
+    int64_t root = 2 * lines.size() - 2;
+    Profile aligned = this->align_subtree(merges, root, leaves, threads);
+
+    // Put the rows back into the same order as the input lines
+    std::vector<int64_t> order;
+    std::vector<int64_t> stack = {root};
+    while (!stack.empty()) {
+        int64_t node = stack.back();
+        stack.pop_back();
+        if (node < static_cast<int64_t>(lines.size())) {
+            order.push_back(node);
+        } else {
+            stack.push_back(merges[node - lines.size()].second);
+            stack.push_back(merges[node - lines.size()].first);
+        }
+    }
+
+    std::vector<Gaps> results(lines.size());
+    for (size_t k = 0; k < order.size(); ++k) {
+        results[order[k]] = std::move(aligned.gaps[k]);
+    }
+    return results;
+}
+
+
+// Call func(i) for every i in [0, len) over a pool of threads. The first exception
+// stops the remaining work and is rethrown.
+template <typename Func>
+void parallel_for(int64_t len, int64_t threads, Func func) {
+    if (threads <= 0) {
+        threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    threads = std::max<int64_t>(1, std::min(threads, len));
+
+    std::atomic<int64_t> next(0);
+    std::exception_ptr error = nullptr;
+    std::mutex error_mutex;
+
+    auto worker = [&]() {
+        for (int64_t i = next++; i < len; i = next++) {
+            try {
+                func(i);
+            } catch (...) {
+                std::lock_guard<std::mutex> lock(error_mutex);
+                if (!error) {
+                    error = std::current_exception();
                 }
-                new_line += this->gap_char;
-                --row;
+                next = len;
+            }
+        }
+    };
+
+    std::vector<std::thread> pool;
+    for (int64_t thread = 1; thread < threads; ++thread) {
+        pool.emplace_back(worker);
+    }
+    worker();
+    for (auto &thread : pool) {
+        thread.join();
+    }
+
+    if (error) {
+        std::rethrow_exception(error);
+    }
+}
+
+
+std::vector<std::vector<std::u32string>>
+LineAlign::align_batch(
+    const std::vector<std::vector<std::u32string>> &groups, int64_t threads
+) const {
+    std::vector<std::vector<std::u32string>> results(groups.size());
+    parallel_for(groups.size(), threads, [&](int64_t i) {
+        results[i] = this->align(groups[i]);
+    });
+    return results;
+}
+
+
+/* Each column is scored by how well every candidate character is supported by all
+ * of the rows: the sum of the substitution scores against each row's character,
+ * weighted by the row's weight. So a character that looks like the characters in
+ * the other rows gets some support from them too.
+ */
+Consensus LineAlign::consensus(
+    const std::vector<std::u32string> &aligned, const std::vector<double> &weights
+) const
+{
+    const SubstitutionMatrix &subs = *this->matrix;
+    Consensus result;
+    if (aligned.empty()) {
+        return result;
+    }
+    if (!weights.empty() && weights.size() != aligned.size()) {
+        throw std::invalid_argument(
+            "There must be one weight for every row of the alignment.");
+    }
+
+    Encoded rows;
+    for (const auto &row : aligned) {
+        if (row.size() != aligned[0].size()) {
+            throw std::invalid_argument("The rows of the alignment must be the same length.");
+        }
+        rows.push_back(subs.encode(row, this->gap_char));
+    }
+
+    std::vector<int32_t> chars;  // The distinct characters in the column
+    std::vector<double> votes;   // The total weight of the rows with each character
+    for (size_t pos = 0; pos < aligned[0].size(); ++pos) {
+        chars.clear();
+        votes.clear();
+        double gap_votes = 0.0;
+        double total = 0.0;
+        for (size_t k = 0; k < rows.size(); ++k) {
+            double weight = weights.empty() ? 1.0 : weights[k];
+            total += weight;
+            int32_t idx = rows[k][pos];
+            if (idx == gapIndex) {
+                gap_votes += weight;
+                continue;
+            }
+            auto it = std::find(chars.begin(), chars.end(), idx);
+            if (it == chars.end()) {
+                chars.push_back(idx);
+                votes.push_back(weight);
             } else {
-                for (size_t k = 0; k < aligned.size(); ++k) {
-                    new_aligned[k] += this->gap_char;
-                }
-                new_line += lines[ln][cols - col];
-                --col;
+                votes[it - chars.begin()] += weight;
+            }
+        }
+
+        // At least half of the rows think there is nothing here
+        if (chars.empty() || gap_votes >= total - gap_votes) {
+            continue;
+        }
+
+        subs.check_pairs(chars, chars);
+        size_t best = 0;
+        double best_score = -std::numeric_limits<double>::infinity();
+        for (size_t i = 0; i < chars.size(); ++i) {
+            double score = 0.0;
+            for (size_t j = 0; j < chars.size(); ++j) {
+                score += votes[j] * subs.score(chars[i], chars[j]);
+            }
+            if (score > best_score) {
+                best = i;
+                best_score = score;
             }
         }
-        new_aligned.push_back(new_line);
-        aligned = new_aligned;
+
+        result.first += subs.alphabet()[chars[best]];
+        result.second.push_back(total > 0.0 ? votes[best] / total : 0.0);
     }
+    return result;
+}
 
-    return aligned;
+
+std::vector<Consensus> LineAlign::consensus_batch(
+    const std::vector<std::vector<std::u32string>> &alignments,
+    const std::vector<double> &weights,
+    int64_t threads
+) const
+{
+    std::vector<Consensus> results(alignments.size());
+    parallel_for(alignments.size(), threads, [&](int64_t i) {
+        results[i] = this->consensus(alignments[i], weights);
+    });
+    return results;
+}
+
+
+Aligner::Aligner(const LineAlign &line_align) : line_align(line_align) {}
+
+// Defined here, where Profile is complete
+Aligner::~Aligner() = default;
+
+
+void Aligner::add(const std::u32string &line) {
+    const LineAlign &la = this->line_align;
+    Profile other(la.matrix->encode(line, la.gap_char));
+
+    std::lock_guard<std::mutex> guard(this->mutex);
+    if (!this->profile) {
+        this->profile = std::make_unique<Profile>(std::move(other));
+    } else {
+        if (this->added.size() == 1 && la.align_stats) {
+            AlignStats counts;
+            counts.calls = 1;
+            add_stats(*la.align_stats, counts);
+        }
+        // Replace the profile only once the merge has worked
+        Profile merged = la.merge(*this->profile, other);
+        *this->profile = std::move(merged);
+    }
+    this->added.push_back(line);
+}
+
+
+size_t Aligner::size() const {
+    std::lock_guard<std::mutex> guard(this->mutex);
+    return this->added.size();
+}
+
+
+std::vector<std::u32string> Aligner::lines() const {
+    std::lock_guard<std::mutex> guard(this->mutex);
+    return this->added;
+}
+
+
+std::vector<std::u32string> Aligner::snapshot() const {
+    std::lock_guard<std::mutex> guard(this->mutex);
+    if (!this->profile) {
+        return std::vector<std::u32string>();
+    }
+    return this->line_align.render_all(this->added, this->profile->gaps);
+}
+
+
+std::vector<Gaps> Aligner::snapshot_gaps() const {
+    std::lock_guard<std::mutex> guard(this->mutex);
+    if (!this->profile) {
+        return std::vector<Gaps>();
+    }
+    return this->profile->gaps;
 }
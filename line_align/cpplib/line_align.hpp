@@ -13,13 +13,137 @@
  *       on visual similarity, etc.
  */
 
+#include <cstdint>
+#include <memory>
+#include <mutex>
 #include <string>
 #include <tuple>
+#include <utility>
 #include <unordered_map>
 #include <vector>
 
 const std::unordered_map<std::u32string, float> noSubs = {};
 
+// The index used for gap characters in encoded strings.
+const int32_t gapIndex = -1;
+
+// Strings encoded as substitution matrix indexes, one vector per string
+typedef std::vector<std::vector<int32_t>> Encoded;
+
+// Where the gaps go in one row of an alignment. Each run is (pos, count): count gaps
+// go before the character at pos in the original string. Gaps at the end of the
+// string have pos equal to its length. The runs are in order of pos.
+typedef std::vector<std::pair<int64_t, int64_t>> Gaps;
+
+// The consensus line of an alignment and the confidence in each of its characters
+typedef std::pair<std::u32string, std::vector<double>> Consensus;
+
+// Insert the gaps into a string to get its row of the alignment
+std::u32string render(const std::u32string &line, const Gaps &gaps, char32_t gap_char);
+
+// The names of the alignment fill kernels this CPU can run, from the widest vectors
+// to the plain scalar one. The widest is used by default. Every kernel gives the
+// same scores and trace-backs.
+std::vector<std::string> fill_kernels();
+
+// The name of the fill kernel in use
+std::string fill_kernel();
+
+/**
+ * Use another fill kernel for all alignments, mostly for testing and benchmarks.
+ *
+ * @throws std::invalid_argument If the kernel is not in fill_kernels().
+ */
+void set_fill_kernel(const std::string &name);
+
+// Counters for the work done by the alignments of a LineAlign that was given a
+// stats object. They keep adding up over every call until they are reset.
+struct AlignStats {
+    int64_t calls = 0;           // Alignments made
+    int64_t merges = 0;          // Pairs of alignments merged
+    int64_t cells = 0;           // DP cells filled, including any that are re-filled
+    int64_t lookups = 0;         // Substitution scores read
+    int64_t matrix_bytes = 0;    // Memory used by the DP matrix of each merge
+    int64_t traceback = 0;       // Moves in the trace-backs
+    double fill_seconds = 0.0;   // Time spent scoring and filling the matrices
+    double trace_seconds = 0.0;  // Time spent following the trace-backs
+
+    void add(const AlignStats &other);
+    void reset() { *this = AlignStats(); }
+};
+
+struct Band;
+struct Profile;
+struct ScoreRow;
+struct Scoring;
+struct Scratch;
+enum TraceDir : uint8_t;
+
+// A dense version of the substitution matrix. Every character in the matrix gets a
+// small integer index, and the scores are kept in a flat table indexed by
+// (index1 * size + index2). Build it once and share it between LineAlign objects.
+struct SubstitutionMatrix {
+    /** Constructor.
+     * @param substitutions The substitution matrix given as a map, with the key as
+     * a two character string representing the two character being substituted.
+     * Symmetry is assumed so you only need to give the lexically first of a pair.
+     */
+    SubstitutionMatrix(
+        const std::unordered_map<std::u32string, float>& substitutions = noSubs);
+
+    /** Constructor.
+     * @param alphabet The characters in the matrix.
+     * @param scores A dense (alphabet.size() * alphabet.size()) row major table of
+     * scores, with NaN for missing pairs. This is the layout of the binary matrix
+     * files written by char_sub_matrix.export().
+     */
+    SubstitutionMatrix(const std::u32string &alphabet, const float *scores);
+
+    // The number of characters in the matrix.
+    int32_t size() const { return static_cast<int32_t>(chars.size()); }
+
+    // The characters in the matrix, in index order.
+    const std::vector<char32_t>& alphabet() const { return chars; }
+
+    // Get the index of a character or -1 if it is not in the matrix.
+    int32_t index(char32_t ch) const;
+
+    // Get the substitution score for two character indexes.
+    float score(int32_t idx1, int32_t idx2) const {
+        return scores[idx1 * chars.size() + idx2];
+    }
+
+    // Is there a score for the pair of character indexes?
+    bool has_score(int32_t idx1, int32_t idx2) const;
+
+    /**
+     * Convert a string into character indexes.
+     *
+     * @param line The string to convert.
+     * @param gap_char Characters equal to this are encoded as gapIndex.
+     * @throws std::invalid_argument If a character is not in the matrix.
+     */
+    std::vector<int32_t> encode(const std::u32string &line, char32_t gap_char) const;
+
+    // Convert character indexes back into a string.
+    std::u32string decode(const std::vector<int32_t> &codes, char32_t gap_char) const;
+
+    /**
+     * Make sure that every pair of characters from the two sets of indexes has a
+     * substitution score. This is done once per input instead of once per cell.
+     *
+     * @throws std::invalid_argument If any pair is missing.
+     */
+    void check_pairs(
+        const std::vector<int32_t> &idxs1, const std::vector<int32_t> &idxs2) const;
+
+private:
+    std::vector<char32_t> chars;
+    std::vector<int32_t> latin;  // Fast lookup for the most common characters
+    std::unordered_map<char32_t, int32_t> indexes;
+    std::vector<float> scores;
+};
+
 // The only reason for the struct is so that I can setup the substitution matrix once
 // at the start of the program.
 struct LineAlign {
@@ -32,28 +156,65 @@ struct LineAlign {
      * @param gap The gap open penalty for alignments. This is typically negative.
      * @param skew The gap extension penalty for the alignments. Also negative.
      * @param gap_char The character used to represent gaps in alignment output.
+     * @param band If this is positive only cells within this many diagonals of the
+     * ones between the two corners of the matrix are filled. The band is widened
+     * until the result is the same as filling the full matrix. Zero fills the full
+     * matrix.
+     * @param stats If given, the work done by every alignment is added to this. It
+     * may be shared with other LineAlign objects.
     */
     LineAlign(
         const std::unordered_map<std::u32string, float>& substitutions = noSubs,
         float gap = -3.0,
         float skew = -0.5,
-        char32_t gap_char = U'⋄'
+        char32_t gap_char = U'⋄',
+        int64_t band = 0,
+        std::shared_ptr<AlignStats> stats = nullptr
     );
 
+    /** Constructor.
+     * @param matrix A precompiled substitution matrix. It may be shared with other
+     * LineAlign objects.
+     * @param gap The gap open penalty for alignments. This is typically negative.
+     * @param skew The gap extension penalty for the alignments. Also negative.
+     * @param gap_char The character used to represent gaps in alignment output.
+     * @param band The starting band width, zero fills the full matrix.
+     * @param stats If given, the work done by every alignment is added to this.
+    */
+    LineAlign(
+        std::shared_ptr<const SubstitutionMatrix> matrix,
+        float gap = -3.0,
+        float skew = -0.5,
+        char32_t gap_char = U'⋄',
+        int64_t band = 0,
+        std::shared_ptr<AlignStats> stats = nullptr
+    );
+
+    // The counters given to the constructor, or null if stats are not collected
+    std::shared_ptr<AlignStats> stats() const { return this->align_stats; }
+
     /**
      * Compute the Levenshtein distance for 2 strings.
      *
      * @param str1 Is a string to compare.
      * @param str2 The other string to compare.
+     * @param max_dist If this is not negative, stop as soon as the distance is
+     * certain to be more than this and return max_dist + 1.
      * @return The Levenshtein distance is an integer. The lower the number the more
      * similar the strings.
      */
-    long levenshtein(const std::u32string &str1, const std::u32string &str2) const;
+    long levenshtein(
+        const std::u32string &str1, const std::u32string &str2, long max_dist = -1
+    ) const;
 
     /**
      * Compute a Levenshtein distance for every pair of strings in list.
      *
      * @param strings A list of strings to compare.
+     * @param max_dist If this is not negative, only return the pairs with a distance
+     * of at most this.
+     * @param threads The number of threads used to compute the distances. Zero means
+     * one thread per core.
      * @return A sorted list of tuples. The tuple contains:
      *     - The Levenshtein distance of the pair of strings.
      *     - The index of the first string compared.
@@ -61,7 +222,9 @@ struct LineAlign {
      * The tuples are sorted by distance.
      */
     std::vector<std::tuple<long, long, long>>
-    levenshtein_all(const std::vector<std::u32string> &strings) const;
+    levenshtein_all(
+        const std::vector<std::u32string> &strings, long max_dist = -1, long threads = 1
+    ) const;
 
     /**
      * Create a multiple sequence alignment of a set of similar short text fragments.
@@ -87,9 +250,206 @@ struct LineAlign {
      */
     std::vector<std::u32string> align(const std::vector<std::u32string> &strings) const;
 
+    /**
+     * Build a UPGMA guide tree from the pairwise Levenshtein distances.
+     *
+     * @param strings A list of strings to cluster.
+     * @return The merge steps as pairs of node numbers. The leaves are numbered by
+     * their index in strings and the node created by the Nth merge is numbered
+     * strings.size() + N.
+     */
+    std::vector<std::pair<int64_t, int64_t>>
+    guide_tree(const std::vector<std::u32string> &strings) const;
+
+    /**
+     * Create a multiple sequence alignment by following a guide tree. The closest
+     * strings are aligned first and then the sub-alignments are merged with each
+     * other. The result may differ from align(), which adds strings in input order.
+     *
+     * @param strings A list of strings to align.
+     * @param threads The number of threads used to align independent subtrees.
+     * Zero means one thread per core.
+     * @return The aligned strings in the same order as the input strings.
+     */
+    std::vector<std::u32string>
+    align_tree(const std::vector<std::u32string> &strings, int64_t threads = 1) const;
+
+    /**
+     * The same as align() but each row is returned as code points, with gapIndex
+     * for the gaps.
+     */
+    Encoded align_codes(const std::vector<std::u32string> &strings) const;
+
+    // The same as align_tree() but returns code points like align_codes()
+    Encoded
+    align_tree_codes(const std::vector<std::u32string> &strings, int64_t threads = 1) const;
+
+    /**
+     * The same as align() but only returns where the gaps go in each string. This is
+     * much smaller than the padded strings, use render() to get those.
+     */
+    std::vector<Gaps> align_gaps(const std::vector<std::u32string> &strings) const;
+
+    // The same as align_tree() but returns the gaps like align_gaps()
+    std::vector<Gaps>
+    align_tree_gaps(const std::vector<std::u32string> &strings, int64_t threads = 1) const;
+
+    /**
+     * Create multiple sequence alignments for many independent groups of strings.
+     *
+     * @param groups A list of groups, each one is a list of strings to align.
+     * @param threads The number of threads used to align the groups. Zero means one
+     * thread per core.
+     * @return The result of align() for every group, in the same order as groups.
+     */
+    std::vector<std::vector<std::u32string>> align_batch(
+        const std::vector<std::vector<std::u32string>> &groups, int64_t threads = 1
+    ) const;
+
+    /**
+     * Build a single line from an alignment by picking a character for every column.
+     * Each character in a column is scored by the sum of its substitution scores
+     * against the characters in every row, times the weight of the row. The best
+     * scoring character wins and ties go to the first row. Columns where the gaps
+     * have at least half of the weight are dropped.
+     *
+     * @param aligned The rows of an alignment, as returned by align().
+     * @param weights The weight of each row, for when some sources are more
+     * trustworthy than others. Empty means every row has a weight of one.
+     * @return The consensus line and the confidence in each of its characters, which
+     * is the share of the total weight that voted for it.
+     * @throws std::invalid_argument If the rows are not the same length, a character
+     * is missing from the substitution matrix, or the weights do not match the rows.
+     */
+    Consensus consensus(
+        const std::vector<std::u32string> &aligned,
+        const std::vector<double> &weights = {}
+    ) const;
+
+    /**
+     * Get the consensus() for many alignments.
+     *
+     * @param alignments A list of alignments.
+     * @param weights The weights of the rows, the same for every alignment.
+     * @param threads The number of threads to use. Zero means one thread per core.
+     */
+    std::vector<Consensus> consensus_batch(
+        const std::vector<std::vector<std::u32string>> &alignments,
+        const std::vector<double> &weights = {},
+        int64_t threads = 1
+    ) const;
+
 private:
-    std::unordered_map<std::u32string, float> substitutions;
+    friend struct Aligner;
+
+    // Add the strings to the alignment in order, strings.size() must be > 1
+    Profile align_profile(const std::vector<std::u32string> &strings) const;
+
+    std::vector<std::u32string> render_all(
+        const std::vector<std::u32string> &strings, const std::vector<Gaps> &gaps) const;
+    Encoded render_codes_all(
+        const std::vector<std::u32string> &strings, const std::vector<Gaps> &gaps) const;
+
+    // Align two alignments with each other. The result has the rows from aligned
+    // followed by the rows from other.
+    Profile merge(const Profile &aligned, const Profile &other) const;
+
+    void trace_full(
+        Scratch &scratch,
+        int64_t rows,
+        int64_t cols,
+        const Scoring &scoring,
+        float max_score
+    ) const;
+
+    // Same as trace_full() but it only keeps O(cols * sqrt(rows)) scores. This is
+    // used automatically for large matrices.
+    void trace_linear(
+        Scratch &scratch,
+        int64_t rows,
+        int64_t cols,
+        const Scoring &scoring,
+        float max_score
+    ) const;
+
+    // Fill one or more rows, with a vector kernel when there are enough rows left
+    int64_t fill_rows(
+        const Band &band,
+        int64_t row,
+        int64_t last,
+        const ScoreRow &prev,
+        ScoreRow &cur,
+        const Scoring &scoring,
+        uint8_t *dirs,
+        size_t stride
+    ) const;
+
+    void fill_row(
+        const Band &band,
+        int64_t row,
+        const ScoreRow &prev,
+        ScoreRow &cur,
+        const Scoring &scoring,
+        uint8_t *dirs
+    ) const;
+
+    // An upper bound on the score of any path that leaves a band of the given width
+    double band_bound(int64_t rows, int64_t cols, int64_t width, float max_score) const;
+
+    // The narrowest band where a path with the given score beats band_bound()
+    int64_t band_width(int64_t rows, int64_t cols, float score, float max_score) const;
+
+    Profile align_subtree(
+        const std::vector<std::pair<int64_t, int64_t>> &merges,
+        int64_t node,
+        const Encoded &leaves,
+        int64_t threads
+    ) const;
+
+    std::shared_ptr<const SubstitutionMatrix> matrix;
     float gap;
     float skew;
     char32_t gap_char;
+    int64_t band;
+    std::shared_ptr<AlignStats> align_stats;
+};
+
+// An alignment that is built one line at a time, for when the versions of a line
+// arrive at different times. It keeps the profile of the alignment so far and each
+// added line is merged into it with a single DP pass, the same as the next step of
+// LineAlign::align(). Adding the lines in order gives the same alignment as align().
+// It may be shared by threads, each call takes a lock.
+struct Aligner {
+    /** Constructor.
+     * @param line_align The scores and settings used for the merges. It is copied,
+     * the substitution matrix and the stats are shared with it.
+    */
+    explicit Aligner(const LineAlign &line_align);
+    ~Aligner();
+
+    /**
+     * Merge another line into the alignment.
+     *
+     * @throws std::invalid_argument If a character is not in the substitution matrix.
+     * The alignment is left as it was.
+     */
+    void add(const std::u32string &line);
+
+    // The number of lines added
+    size_t size() const;
+
+    // The lines added so far, in order
+    std::vector<std::u32string> lines() const;
+
+    // The alignment of the lines added so far, like LineAlign::align()
+    std::vector<std::u32string> snapshot() const;
+
+    // The same as snapshot() but returns the gaps like LineAlign::align_gaps()
+    std::vector<Gaps> snapshot_gaps() const;
+
+private:
+    LineAlign line_align;
+    std::vector<std::u32string> added;
+    std::unique_ptr<Profile> profile;
+    mutable std::mutex mutex;  // Guards added and profile
 };
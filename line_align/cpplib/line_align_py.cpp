@@ -1,25 +1,324 @@
 #include "line_align.hpp"
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <cstring>
+#include <optional>
+#include <sstream>
+#include <stdexcept>
 
 namespace py = pybind11;
 
+// Not a code point, so encode() with it as the gap character encodes every character
+const char32_t noGapChar = 0x110000;
+
+namespace pybind11::detail {
+
+// Copy str objects straight out of their PEP 393 buffers, and build new ones from
+// the UCS4 data, instead of going through the UTF-32 codec like the default caster.
+template <> struct type_caster<std::u32string> {
+    PYBIND11_TYPE_CASTER(std::u32string, const_name("str"));
+
+    // Used by the char32_t caster
+    static constexpr size_t UTF_N = 32;
+
+    bool load(handle src, bool) {
+        if (!src || !PyUnicode_Check(src.ptr())) {
+            return false;
+        }
+        PyObject *obj = src.ptr();
+#if PY_VERSION_HEX < 0x030C0000
+        // Legacy strings only have their PEP 393 buffer after this
+        if (PyUnicode_READY(obj) == -1) {
+            PyErr_Clear();
+            return false;
+        }
+#endif
+        Py_ssize_t len = PyUnicode_GET_LENGTH(obj);
+        const void *data = PyUnicode_DATA(obj);
+        switch (PyUnicode_KIND(obj)) {
+            case PyUnicode_1BYTE_KIND: {
+                auto chars = static_cast<const Py_UCS1 *>(data);
+                this->value.assign(chars, chars + len);
+                break;
+            }
+            case PyUnicode_2BYTE_KIND: {
+                auto chars = static_cast<const Py_UCS2 *>(data);
+                this->value.assign(chars, chars + len);
+                break;
+            }
+            default: {
+                auto chars = static_cast<const char32_t *>(data);
+                this->value.assign(chars, chars + len);
+            }
+        }
+        return true;
+    }
+
+    static handle cast(const std::u32string &src, return_value_policy, handle) {
+        PyObject *obj =
+            PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, src.data(), src.size());
+        if (!obj) {
+            throw error_already_set();
+        }
+        return obj;
+    }
+};
+
+}  // namespace pybind11::detail
+
+// An alignment as an (n_lines, aligned_len) array of code points
+py::array_t<int32_t> to_array(const Encoded &aligned) {
+    size_t rows = aligned.size();
+    size_t cols = rows > 0 ? aligned[0].size() : 0;
+    py::array_t<int32_t> array({rows, cols});
+    for (size_t row = 0; row < rows; ++row) {
+        std::memcpy(array.mutable_data(row), aligned[row].data(), cols * sizeof(int32_t));
+    }
+    return array;
+}
+
+// The max_dist for the levenshtein functions, where -1 is no cutoff
+int64_t cutoff(std::optional<int64_t> max_dist) {
+    if (max_dist && *max_dist < 0) {
+        throw std::invalid_argument("The max_dist must not be negative.");
+    }
+    return max_dist.value_or(-1);
+}
+
 PYBIND11_MODULE(line_align_py, m) {
     m.doc() = "Align multiple strings.";
+    m.attr("GAP_CODE") = gapIndex;
+
+    m.def("render", &render,
+          "Insert gaps, as returned by align_gaps(), into a string.",
+          py::arg("line"),
+          py::arg("gaps"),
+          py::arg("gap_char") = U'⋄');
+
+    m.def("fill_kernels", &fill_kernels,
+          "The alignment fill kernels this CPU can run, widest vectors first.");
+
+    m.def("fill_kernel", &fill_kernel, "The alignment fill kernel in use.");
+
+    m.def("set_fill_kernel", &set_fill_kernel,
+          "Use another alignment fill kernel. They all give the same alignments.",
+          py::arg("name"));
+
+    py::class_<SubstitutionMatrix, std::shared_ptr<SubstitutionMatrix>>(
+        m, "SubstitutionMatrix")
+        .def(py::init<const std::unordered_map<std::u32string, float>&>(),
+             py::arg("substitutions") = noSubs)
+        .def(py::init([](const std::u32string &alphabet,
+                         py::array_t<float, py::array::c_style | py::array::forcecast>
+                             scores) {
+                 py::ssize_t size = alphabet.size();
+                 if (scores.ndim() != 2 || scores.shape(0) != size
+                         || scores.shape(1) != size) {
+                     throw py::value_error(
+                         "The scores must be a square matrix the size of the alphabet.");
+                 }
+                 return std::make_shared<SubstitutionMatrix>(alphabet, scores.data());
+             }),
+             "Build the matrix from a dense table of scores, like the ones from "
+             "char_sub_matrix.load().",
+             py::arg("alphabet"),
+             py::arg("scores"))
+        .def("__len__", &SubstitutionMatrix::size)
+        .def("__contains__",
+             [](const SubstitutionMatrix &self, char32_t ch) {
+                 return self.index(ch) != gapIndex;
+             })
+        .def_property_readonly("alphabet",
+             [](const SubstitutionMatrix &self) {
+                 return std::u32string(self.alphabet().begin(), self.alphabet().end());
+             },
+             "The characters in the matrix, in index order.")
+        .def("score",
+             [](const SubstitutionMatrix &self, char32_t ch1, char32_t ch2) {
+                 std::vector<int32_t> idxs1 =
+                     self.encode(std::u32string(1, ch1), noGapChar);
+                 std::vector<int32_t> idxs2 =
+                     self.encode(std::u32string(1, ch2), noGapChar);
+                 self.check_pairs(idxs1, idxs2);
+                 return self.score(idxs1[0], idxs2[0]);
+             },
+             "Get the substitution score for 2 characters.",
+             py::arg("char1"), py::arg("char2"));
+
+    py::class_<AlignStats, std::shared_ptr<AlignStats>>(
+        m, "AlignStats",
+        "Counters for the work done by a LineAlign. Pass one to the LineAlign to "
+        "collect them. They add up over every call until they are reset.")
+        .def(py::init<>())
+        .def_readonly("calls", &AlignStats::calls, "Alignments made.")
+        .def_readonly("merges", &AlignStats::merges, "Pairs of alignments merged.")
+        .def_readonly("cells", &AlignStats::cells,
+                      "DP cells filled, including any that are re-filled.")
+        .def_readonly("lookups", &AlignStats::lookups, "Substitution scores read.")
+        .def_readonly("matrix_bytes", &AlignStats::matrix_bytes,
+                      "Memory used by the DP matrix of each merge.")
+        .def_readonly("traceback", &AlignStats::traceback,
+                      "Moves in the trace-backs.")
+        .def_readonly("fill_seconds", &AlignStats::fill_seconds,
+                      "Time spent scoring and filling the matrices.")
+        .def_readonly("trace_seconds", &AlignStats::trace_seconds,
+                      "Time spent following the trace-backs.")
+        .def("reset", &AlignStats::reset, "Set all of the counters back to zero.")
+        .def("__repr__", [](const AlignStats &self) {
+            std::stringstream repr;
+            repr << "AlignStats(calls=" << self.calls << ", merges=" << self.merges
+                 << ", cells=" << self.cells << ", lookups=" << self.lookups
+                 << ", matrix_bytes=" << self.matrix_bytes
+                 << ", traceback=" << self.traceback
+                 << ", fill_seconds=" << self.fill_seconds
+                 << ", trace_seconds=" << self.trace_seconds << ")";
+            return repr.str();
+        });
 
     py::class_<LineAlign>(m, "LineAlign")
-        .def(py::init<const std::unordered_map<std::u32string, float>&, float, float, char32_t>(),
+        .def(py::init<const std::unordered_map<std::u32string, float>&, float, float,
+                      char32_t, int64_t, std::shared_ptr<AlignStats>>(),
              py::arg("substitutions") = noSubs,
              py::arg("gap") = -2.0,
              py::arg("skew") = -2.0,
-             py::arg("gap_char") = U'⋄')
-        .def("align", &LineAlign::align,
-             "Get a multiple sequence alignment for a list of strings.",
+             py::arg("gap_char") = U'⋄',
+             py::arg("band") = 0,
+             py::arg("stats") = py::none())
+        .def(py::init<std::shared_ptr<const SubstitutionMatrix>, float, float, char32_t,
+                      int64_t, std::shared_ptr<AlignStats>>(),
+             py::arg("substitutions"),
+             py::arg("gap") = -2.0,
+             py::arg("skew") = -2.0,
+             py::arg("gap_char") = U'⋄',
+             py::arg("band") = 0,
+             py::arg("stats") = py::none())
+        .def_property_readonly("stats", &LineAlign::stats,
+             "The AlignStats given to the constructor, if any.")
+        .def("align",
+             [](const LineAlign &self, const std::vector<std::u32string> &strings,
+                bool as_array) -> py::object {
+                 if (as_array) {
+                     Encoded aligned;
+                     {
+                         py::gil_scoped_release release;
+                         aligned = self.align_codes(strings);
+                     }
+                     return to_array(aligned);
+                 }
+                 std::vector<std::u32string> aligned;
+                 {
+                     py::gil_scoped_release release;
+                     aligned = self.align(strings);
+                 }
+                 return py::cast(aligned);
+             },
+             "Get a multiple sequence alignment for a list of strings. With as_array "
+             "the result is an int32 array of code points with GAP_CODE for gaps.",
+             py::arg("strings"),
+             py::kw_only(),
+             py::arg("as_array") = false)
+        .def("align_batch", &LineAlign::align_batch,
+             "Get multiple sequence alignments for a list of groups of strings.",
+             py::arg("groups"),
+             py::arg("threads") = 1,
+             py::call_guard<py::gil_scoped_release>())
+        .def("align_tree",
+             [](const LineAlign &self, const std::vector<std::u32string> &strings,
+                int64_t threads, bool as_array) -> py::object {
+                 if (as_array) {
+                     Encoded aligned;
+                     {
+                         py::gil_scoped_release release;
+                         aligned = self.align_tree_codes(strings, threads);
+                     }
+                     return to_array(aligned);
+                 }
+                 std::vector<std::u32string> aligned;
+                 {
+                     py::gil_scoped_release release;
+                     aligned = self.align_tree(strings, threads);
+                 }
+                 return py::cast(aligned);
+             },
+             "Get a multiple sequence alignment by following a guide tree.",
+             py::arg("strings"),
+             py::arg("threads") = 1,
+             py::kw_only(),
+             py::arg("as_array") = false)
+        .def("align_gaps", &LineAlign::align_gaps,
+             "Get where the gaps go in each string of a multiple sequence alignment, "
+             "as lists of (position, count) runs.",
+             py::arg("strings"),
+             py::call_guard<py::gil_scoped_release>())
+        .def("align_tree_gaps", &LineAlign::align_tree_gaps,
+             "The same as align_gaps() but by following a guide tree.",
+             py::arg("strings"),
+             py::arg("threads") = 1,
+             py::call_guard<py::gil_scoped_release>())
+        .def("consensus",
+             [](const LineAlign &self, const std::vector<std::u32string> &aligned,
+                std::optional<std::vector<double>> weights) {
+                 return self.consensus(aligned, weights.value_or(std::vector<double>()));
+             },
+             "Get the consensus line of an alignment and the confidence in each of "
+             "its characters.",
+             py::arg("aligned"),
+             py::arg("weights") = py::none(),
+             py::call_guard<py::gil_scoped_release>())
+        .def("consensus_batch",
+             [](const LineAlign &self,
+                const std::vector<std::vector<std::u32string>> &alignments,
+                std::optional<std::vector<double>> weights, int64_t threads) {
+                 return self.consensus_batch(
+                     alignments, weights.value_or(std::vector<double>()), threads);
+             },
+             "Get the consensus for a list of alignments.",
+             py::arg("alignments"),
+             py::arg("weights") = py::none(),
+             py::arg("threads") = 1,
+             py::call_guard<py::gil_scoped_release>())
+        .def("guide_tree", &LineAlign::guide_tree,
+             "Get the UPGMA guide tree merge steps for a list of strings.",
              py::arg("strings"))
-        .def("levenshtein", &LineAlign::levenshtein,
-             "Get the levenshtein distance for 2 strings.")
-        .def("levenshtein_all", &LineAlign::levenshtein_all,
-             "Get the levenshtein distance for all pairs of strings in the list.");
+        .def("levenshtein",
+             [](const LineAlign &self, const std::u32string &str1,
+                const std::u32string &str2, std::optional<int64_t> max_dist) {
+                 return self.levenshtein(str1, str2, cutoff(max_dist));
+             },
+             "Get the levenshtein distance for 2 strings.",
+             py::arg("str1"),
+             py::arg("str2"),
+             py::arg("max_dist") = py::none())
+        .def("levenshtein_all",
+             [](const LineAlign &self, const std::vector<std::u32string> &strings,
+                std::optional<int64_t> max_dist, int64_t threads) {
+                 return self.levenshtein_all(strings, cutoff(max_dist), threads);
+             },
+             "Get the levenshtein distance for all pairs of strings in the list.",
+             py::arg("strings"),
+             py::arg("max_dist") = py::none(),
+             py::arg("threads") = 1,
+             py::call_guard<py::gil_scoped_release>());
+
+    py::class_<Aligner>(
+        m, "Aligner",
+        "An alignment that is built one line at a time. Each add() is a single merge "
+        "into the alignment so far, and adding the lines in order gives the same "
+        "alignment as LineAlign.align(). It may be shared by threads.")
+        .def(py::init<const LineAlign &>(), py::arg("line_align"))
+        .def("__len__", &Aligner::size)
+        .def_property_readonly("lines", &Aligner::lines, "The lines added so far.")
+        .def("add", &Aligner::add, "Merge another line into the alignment.",
+             py::arg("line"),
+             py::call_guard<py::gil_scoped_release>())
+        .def("snapshot", &Aligner::snapshot,
+             "Get the alignment of the lines added so far, like LineAlign.align().",
+             py::call_guard<py::gil_scoped_release>())
+        .def("snapshot_gaps", &Aligner::snapshot_gaps,
+             "Get the snapshot() as the gaps in each line, like "
+             "LineAlign.align_gaps().",
+             py::call_guard<py::gil_scoped_release>());
 }
 
 /*
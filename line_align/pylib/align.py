@@ -12,11 +12,18 @@ Therefore: I do not consider transpositions in the Needleman Wunsch
 distances, and substitutions are based on visual similarity, etc.
 """
 
+import sys
+import time
 from dataclasses import dataclass, field
 from enum import Enum
 
 import numpy as np
 
+from line_align.pylib.levenshtein import levenshtein_all
+
+# Where the gaps go in one row of an alignment, as (position, count) runs
+Gaps = list[tuple[int, int]]
+
 
 class Dir(Enum):
     NONE = 0
@@ -33,6 +40,33 @@ class Trace:
     dir_: Dir = Dir.NONE
 
 
+# The bytes in one cell of the trace matrix: a pointer to a Trace and its contents
+TRACE_BYTES = 8 + sys.getsizeof(Trace()) + sys.getsizeof(vars(Trace()))
+
+
+@dataclass
+class AlignStats:
+    """
+    Counters for the work done by a LineAlign.
+
+    Pass one to the LineAlign to collect them. They add up over every call until they
+    are reset.
+    """
+
+    calls: int = 0  # Alignments made
+    merges: int = 0  # Pairs of alignments merged
+    cells: int = 0  # DP cells filled
+    lookups: int = 0  # Substitution scores read
+    matrix_bytes: int = 0  # Memory used by the DP matrix of each merge
+    traceback: int = 0  # Moves in the trace-backs
+    fill_seconds: float = 0.0  # Time spent scoring and filling the matrices
+    trace_seconds: float = 0.0  # Time spent following the trace-backs
+
+    def reset(self) -> None:
+        """Set all of the counters back to zero."""
+        self.__init__()
+
+
 @dataclass
 class LineAlign:
     """
@@ -46,12 +80,15 @@ class LineAlign:
     @param gap The gap open penalty for alignments. This is typically negative.
     @param skew The gap extension penalty for the alignments. Also negative.
     @param gap_char The character used to represent gaps in alignment output.
+    @param stats If given, the work done by every alignment is added to this. It may
+        be shared with other LineAlign objects.
     """
 
     substitutions: dict[str, float] = field(default_factory=dict)
     gap: float = -3.0
     skew: float = -0.5
     gap_char: str = "⋄"
+    stats: AlignStats | None = None
 
     def align(self, lines: list[str]) -> list[str]:
         """
@@ -79,16 +116,190 @@ class LineAlign:
         if len(lines) <= 1:
             return lines
 
+        if self.stats:
+            self.stats.calls += 1
+
         aligned: list[list[str]] = [list(lines[0])]
 
         for ln in range(1, len(lines)):
-            cols, rows, trace = self.build_matrix(aligned, lines, ln)
-            aligned = self.trace_back(aligned, cols, lines, ln, rows, trace)
+            aligned = self.merge(aligned, [list(lines[ln])])
 
         result: list[str] = ["".join(a) for a in aligned]
         return result
 
-    def trace_back(self, aligned, cols, lines, ln, rows, trace):
+    def align_tree(self, lines: list[str]) -> list[str]:
+        """
+        Create a multiple sequence alignment by following a guide tree.
+
+        The closest lines are aligned first and then the sub-alignments are merged
+        with each other, so the result may differ from align(), which adds the lines
+        in input order. The native extension aligns independent subtrees in parallel,
+        this version does them one after the other.
+
+        @param lines A list of strings to align.
+        @return The aligned strings in the same order as the input lines.
+        """
+        if len(lines) <= 1:
+            return lines
+
+        if self.stats:
+            self.stats.calls += 1
+
+        nodes: dict[int, tuple[list[int], list[list[str]]]] = {
+            i: ([i], [list(ln)]) for i, ln in enumerate(lines)
+        }
+
+        for node, (node1, node2) in enumerate(guide_tree(lines), start=len(lines)):
+            order1, aligned1 = nodes.pop(node1)
+            order2, aligned2 = nodes.pop(node2)
+            nodes[node] = (order1 + order2, self.merge(aligned1, aligned2))
+
+        order, aligned = nodes.popitem()[1]
+
+        result: list[str] = [""] * len(lines)
+        for i, row in zip(order, aligned, strict=True):
+            result[i] = "".join(row)
+        return result
+
+    def align_gaps(self, lines: list[str]) -> list[Gaps]:
+        """
+        Get the alignment from align() as the gaps in each line.
+
+        This is a lot smaller than the padded lines for large groups. Use render()
+        to get a padded line when it is needed.
+
+        @param lines A list of strings to align. They should not contain the gap
+            character.
+        @return One list of (position, count) runs per line. Each run puts count
+            gaps before the character at that position in the line, a position equal
+            to the length of the line puts them at the end.
+        """
+        return [self.find_gaps(row) for row in self.align(lines)]
+
+    def align_tree_gaps(self, lines: list[str]) -> list[Gaps]:
+        """Get the alignment from align_tree() as the gaps in each line."""
+        return [self.find_gaps(row) for row in self.align_tree(lines)]
+
+    def find_gaps(self, row: str) -> Gaps:
+        """Get the gap runs in one row of an alignment."""
+        gaps: Gaps = []
+        pos = 0
+        for char in row:
+            if char != self.gap_char:
+                pos += 1
+            elif gaps and gaps[-1][0] == pos:
+                gaps[-1] = (pos, gaps[-1][1] + 1)
+            else:
+                gaps.append((pos, 1))
+        return gaps
+
+    def consensus(
+        self, aligned: list[str], weights: list[float] | None = None
+    ) -> tuple[str, list[float]]:
+        """
+        Build a single line from an alignment by picking a character per column.
+
+        Each character in a column is scored by the sum of its substitution scores
+        against the characters in every row, times the weight of the row. So a
+        character that looks like the characters in the other rows gets some support
+        from them too. The best scoring character wins and ties go to the first row.
+        Columns where the gaps have at least half of the weight are dropped.
+
+        @param aligned The rows of an alignment, as returned by align().
+        @param weights The weight of each row, for when some sources are more
+            trustworthy than others. None gives every row a weight of one.
+        @return The consensus line and the confidence in each of its characters,
+            which is the share of the total weight that voted for it.
+        """
+        if not aligned:
+            return "", []
+        if weights is None:
+            weights = [1.0] * len(aligned)
+        if len(weights) != len(aligned):
+            msg = "There must be one weight for every row of the alignment."
+            raise ValueError(msg)
+        if any(len(row) != len(aligned[0]) for row in aligned):
+            msg = "The rows of the alignment must be the same length."
+            raise ValueError(msg)
+
+        line: list[str] = []
+        confidence: list[float] = []
+
+        for column in zip(*aligned, strict=True):
+            votes: dict[str, float] = {}
+            gap_votes: float = 0.0
+            total: float = 0.0
+            for char, weight in zip(column, weights, strict=True):
+                total += weight
+                if char == self.gap_char:
+                    gap_votes += weight
+                else:
+                    votes[char] = votes.get(char, 0.0) + weight
+
+            # At least half of the rows think there is nothing here
+            if not votes or gap_votes >= total - gap_votes:
+                continue
+
+            best = self.best_char(votes)
+            line.append(best)
+            confidence.append(votes[best] / total if total > 0.0 else 0.0)
+
+        return "".join(line), confidence
+
+    def best_char(self, votes: dict[str, float]) -> str:
+        """Get the character with the most support from all of the votes."""
+        best: str = ""
+        best_score: float = float("-inf")
+        for char in votes:
+            score: float = 0.0
+            for other, vote in votes.items():
+                score += vote * self.substitution(char, other)
+            if score > best_score:
+                best, best_score = char, score
+        return best
+
+    def substitution(self, char1: str, char2: str) -> float:
+        """Get the substitution score for two characters."""
+        key = "".join(sorted((char1, char2)))
+        value: float | None = self.substitutions.get(key)
+        if value is None:
+            msg: str = (
+                f"One of {key} these characters are missing "
+                "from the substitution matrix."
+            )
+            raise ValueError(msg)
+        return value
+
+    def merge(
+        self, aligned: list[list[str]], other: list[list[str]]
+    ) -> list[list[str]]:
+        """
+        Align two alignments with each other.
+
+        @param aligned The rows of the first alignment.
+        @param other The rows of the second alignment. When adding a line to an
+            alignment this has a single row.
+        @return The rows from aligned followed by the rows from other, with gaps
+            inserted so that they all have the same length.
+        """
+        if not self.stats:
+            cols, rows, trace = self.build_matrix(aligned, other)
+            return self.trace_back(aligned, other, cols, rows, trace)
+
+        start = time.perf_counter()
+        cols, rows, trace = self.build_matrix(aligned, other)
+        filled = time.perf_counter()
+        merged = self.trace_back(aligned, other, cols, rows, trace)
+
+        self.stats.merges += 1
+        self.stats.cells += trace.size
+        self.stats.matrix_bytes += trace.size * TRACE_BYTES
+        self.stats.traceback += len(merged[0])
+        self.stats.fill_seconds += filled - start
+        self.stats.trace_seconds += time.perf_counter() - filled
+        return merged
+
+    def trace_back(self, aligned, other, cols, rows, trace):
         # for row in range(rows_p1):
         #     for col in range(cols_p1):
         #         cell: Trace = trace[row, col]
@@ -96,9 +307,9 @@ class LineAlign:
         #     print()
         row = rows
         col = cols
-        new_line: list[str] = []
 
         new_aligned: list[list[str]] = [[] for _ in range(len(aligned))]
+        new_other: list[list[str]] = [[] for _ in range(len(other))]
 
         while True:
             cell: Trace = trace[row, col]
@@ -106,34 +317,34 @@ class LineAlign:
             if cell.dir_ == Dir.NONE:
                 break
 
-            if cell.dir_ == Dir.DIAG:
-                for k in range(len(aligned)):
-                    new_aligned[k].append(aligned[k][rows - row])
-                new_line.append(lines[ln][cols - col])
-                row -= 1
-                col -= 1
+            for k in range(len(aligned)):
+                char = (
+                    self.gap_char if cell.dir_ == Dir.LEFT else aligned[k][rows - row]
+                )
+                new_aligned[k].append(char)
 
-            elif cell.dir_ == Dir.UP:
-                for k in range(len(aligned)):
-                    new_aligned[k].append(aligned[k][rows - row])
-                new_line.append(self.gap_char)
-                row -= 1
+            for k in range(len(other)):
+                char = self.gap_char if cell.dir_ == Dir.UP else other[k][cols - col]
+                new_other[k].append(char)
 
-            else:
-                for k in range(len(aligned)):
-                    new_aligned[k].append(self.gap_char)
-                new_line.append(lines[ln][cols - col])
-                col -= 1
-        new_aligned.append(new_line)
-        aligned = new_aligned
-        return aligned
-
-    def build_matrix(self, aligned, lines, ln):
+            row -= 0 if cell.dir_ == Dir.LEFT else 1
+            col -= 0 if cell.dir_ == Dir.UP else 1
+
+        return new_aligned + new_other
+
+    def build_matrix(self, aligned, other):
         rows: int = len(aligned[0])
-        cols: int = len(lines[ln])
+        cols: int = len(other[0])
         rows_p1: int = rows + 1
         cols_p1: int = cols + 1
 
+        other_columns = [
+            frozenset(column) - {self.gap_char} for column in zip(*other, strict=True)
+        ]
+        profile = self.column_profile(aligned, set().union(*other_columns))
+        if self.stats:
+            self.stats.lookups += rows * sum(len(c) for c in other_columns)
+
         items: list[Trace] = [Trace() for _ in range(rows_p1 * cols_p1)]
         trace: np.array = np.array(items, dtype="object")
         trace = trace.reshape((rows_p1, cols_p1))
@@ -152,6 +363,7 @@ class LineAlign:
 
         # Fill in the rest of the matrix
         for row in range(1, rows_p1):
+            best: dict[str, float] = profile[rows - row]
             for col in range(1, cols_p1):
                 cell: Trace = trace[row, col]
                 cell_up: Trace = trace[row - 1, col]
@@ -160,29 +372,9 @@ class LineAlign:
                 cell.up = max(cell_up.up + self.skew, cell_up.val + self.gap)
                 cell.left = max(cell_left.left + self.skew, cell_left.val + self.gap)
 
-                diag_val: float = -999_999.0
-                for k in range(len(aligned)):
-                    aligned_char: str = aligned[k][rows - row]
-                    lines_char: str = lines[ln][cols - col]
-
-                    if aligned_char == self.gap_char:
-                        continue
-
-                    if aligned_char > lines_char:
-                        aligned_char, lines_char = lines_char, aligned_char
-
-                    key = aligned_char + lines_char
-
-                    value: float = self.substitutions.get(key)
-                    if value is None:
-                        msg: str = (
-                            f"One of {key} these characters are missing "
-                            "from the substitution matrix."
-                        )
-                        raise ValueError(msg)
-
-                    diag_val = value if value > diag_val else diag_val
-
+                diag_val: float = max(
+                    (best[c] for c in other_columns[cols - col]), default=-999_999.0
+                )
                 diag_val += trace[row - 1, col - 1].val
                 cell.val = max(diag_val, cell.up, cell.left)
 
@@ -195,3 +387,133 @@ class LineAlign:
                 # f"{int(cell.val)} {int(cell.up)} {int(cell.left)} {cell.dir_.value} "
                 # )
         return cols, rows, trace
+
+    def column_profile(
+        self, aligned: list[list[str]], chars: set[str]
+    ) -> list[dict[str, float]]:
+        """
+        Get the best substitution score for every aligned column & character.
+
+        Each column of the alignment is reduced to its distinct non-gap characters,
+        so the cost of scoring a cell no longer grows with the number of aligned
+        lines.
+
+        @param aligned The lines that are already aligned.
+        @param chars The characters in the lines being added to the alignment.
+        @return A list, one entry per aligned column, of dicts mapping each of the
+            chars to its best score against that column.
+        """
+        profile: list[dict[str, float]] = []
+        cache: dict[frozenset[str], dict[str, float]] = {}
+
+        for column in zip(*aligned, strict=True):
+            distinct = frozenset(column) - {self.gap_char}
+
+            if (scores := cache.get(distinct)) is None:
+                if self.stats:
+                    self.stats.lookups += len(chars) * len(distinct)
+                scores = {}
+                for char in chars:
+                    best: float = -999_999.0
+                    for aligned_char in distinct:
+                        key = "".join(sorted((aligned_char, char)))
+                        value: float = self.substitutions.get(key)
+                        if value is None:
+                            msg: str = (
+                                f"One of {key} these characters are missing "
+                                "from the substitution matrix."
+                            )
+                            raise ValueError(msg)
+                        best = max(best, value)
+                    scores[char] = best
+                cache[distinct] = scores
+
+            profile.append(scores)
+
+        return profile
+
+
+@dataclass
+class Aligner:
+    """
+    An alignment that is built one line at a time.
+
+    This is for when the versions of a line arrive at different times, like the
+    results of several OCR engines. Each add() merges the line into the alignment
+    so far with a single DP pass, so adding the lines in order gives the same
+    alignment as LineAlign.align() without aligning the earlier lines again.
+
+    @param line_align The scores and settings used for the merges. Any LineAlign
+        works, like a NumpyLineAlign.
+    """
+
+    line_align: LineAlign
+    lines: list[str] = field(default_factory=list, init=False)
+    rows: list[list[str]] = field(default_factory=list, init=False, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def add(self, line: str) -> None:
+        """Merge another line into the alignment."""
+        if not self.lines:
+            self.rows = [list(line)]
+        else:
+            if len(self.lines) == 1 and self.line_align.stats:
+                self.line_align.stats.calls += 1
+            self.rows = self.line_align.merge(self.rows, [list(line)])
+        self.lines.append(line)
+
+    def snapshot(self) -> list[str]:
+        """Get the alignment of the lines added so far, like LineAlign.align()."""
+        return ["".join(row) for row in self.rows]
+
+    def snapshot_gaps(self) -> list[Gaps]:
+        """Get the snapshot() as the gaps in each line, like LineAlign.align_gaps()."""
+        return [self.line_align.find_gaps(row) for row in self.snapshot()]
+
+
+def render(line: str, gaps: Gaps, gap_char: str = "⋄") -> str:
+    """Insert gaps, as returned by LineAlign.align_gaps(), into a line."""
+    parts: list[str] = []
+    start = 0
+    for pos, count in gaps:
+        parts.append(line[start:pos])
+        parts.append(gap_char * count)
+        start = pos
+    parts.append(line[start:])
+    return "".join(parts)
+
+
+def guide_tree(lines: list[str]) -> list[tuple[int, int]]:
+    """
+    Build a UPGMA guide tree from the pairwise Levenshtein distances.
+
+    @param lines The strings to cluster.
+    @return The merge steps as pairs of node numbers. The leaves are numbered by
+        their index in lines and the node created by the Nth merge is numbered
+        len(lines) + N. Ties go to the lowest node numbers.
+    """
+    dist: dict[tuple[int, int], float] = {
+        (d.idx1, d.idx2): float(d.dist) for d in levenshtein_all(lines)
+    }
+    sizes: dict[int, int] = dict.fromkeys(range(len(lines)), 1)
+    merges: list[tuple[int, int]] = []
+
+    for node in range(len(lines), 2 * len(lines) - 1):
+        node1, node2 = min(dist, key=lambda k: (dist[k], k))
+        merges.append((node1, node2))
+
+        size1 = sizes.pop(node1)
+        size2 = sizes.pop(node2)
+
+        for other in sizes:
+            dist[(other, node)] = (
+                dist[tuple(sorted((node1, other)))] * size1
+                + dist[tuple(sorted((node2, other)))] * size2
+            ) / (size1 + size2)
+
+        dist = {k: v for k, v in dist.items() if node1 not in k and node2 not in k}
+        sizes[node] = size1 + size2
+
+    return merges
@@ -0,0 +1,168 @@
+"""
+Align groups of lines read from a JSONL stream.
+
+Each record is a JSON array of lines, or an object with the lines under "lines".
+The other keys of an object are copied to its result. The records are handed to
+a pool of workers in chunks, with only a few chunks in flight at a time. The
+input is read only as fast as the workers keep up, so the stream can be any size,
+and the results come out in input order.
+"""
+
+import json
+import os
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import NamedTuple
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import LineAlign
+from line_align.pylib.levenshtein import levenshtein_all
+
+try:
+    import line_align_py
+except ImportError:
+    line_align_py = None
+
+IMPLS = ("cpp", "py")
+DEFAULT_IMPL = "cpp" if line_align_py else "py"
+
+
+class Settings(NamedTuple):
+    impl: str = DEFAULT_IMPL  # "cpp" for the native extension or "py"
+    char_set: str = "default"
+    gap: float = -3.0
+    skew: float = -0.5
+    gap_char: str = "⋄"
+    band: int = 0  # Only used by the native extension
+    tree: bool = False  # Use align_tree() instead of align()
+    consensus: bool = False  # Add the consensus line and its confidence
+    distances: bool = False  # Add the Levenshtein distance for every pair of lines
+    max_dist: int | None = None  # Only add distances up to this
+
+
+def align_stream(
+    records: Iterable[str],
+    settings: Settings,
+    *,
+    workers: int = 1,
+    threads: bool = False,
+    chunk_size: int = 64,
+) -> Iterator[str]:
+    """
+    Align every record in a stream of JSONL records.
+
+    @param records The JSON records, one per string. Blank ones are skipped.
+    @param settings How to align the records.
+    @param workers The number of workers. Zero means one per core and one aligns
+        the records in this process.
+    @param threads Use a pool of threads instead of processes. This only helps the
+        native extension, it lets go of the GIL while aligning.
+    @param chunk_size The number of records sent to a worker at a time.
+    @return The results as JSON strings, in the same order as the records. Records
+        that cannot be aligned get an object with an "error" key.
+    """
+    records = (r for r in records if r.strip())
+    chunks = iter(lambda: list(islice(records, chunk_size)), [])
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        init_worker(settings)
+        for chunk in chunks:
+            yield from align_chunk(chunk)
+        return
+
+    pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with pool(
+        max_workers=workers, initializer=init_worker, initargs=(settings,)
+    ) as executor:
+        # Waiting for the oldest chunk before reading more input is the backpressure
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(align_chunk, chunk))
+        while pending:
+            yield from pending.popleft().result()
+
+
+# The aligner for the workers, it is built once when a worker starts
+WORKER_LINE = None
+WORKER_SETTINGS = Settings()
+
+
+def init_worker(settings: Settings) -> None:
+    global WORKER_LINE, WORKER_SETTINGS
+    WORKER_SETTINGS = settings
+    WORKER_LINE = new_line_align(settings)
+
+
+def new_line_align(settings: Settings):
+    if settings.impl == "py":
+        return LineAlign(
+            char_sub_matrix.get(settings.char_set),
+            settings.gap,
+            settings.skew,
+            settings.gap_char,
+        )
+    if not line_align_py:
+        msg = "The line_align_py extension is not built."
+        raise ImportError(msg)
+    matrix = char_sub_matrix.load(settings.char_set)
+    return line_align_py.LineAlign(
+        line_align_py.SubstitutionMatrix(matrix.alphabet, matrix.scores),
+        settings.gap,
+        settings.skew,
+        settings.gap_char,
+        settings.band,
+    )
+
+
+def align_chunk(chunk: list[str]) -> list[str]:
+    return [json.dumps(align_record(r), ensure_ascii=False) for r in chunk]
+
+
+def align_record(record: str) -> dict:
+    """Align the lines in one JSON record and return the result."""
+    try:
+        result = json.loads(record)
+    except ValueError as err:
+        return {"error": f"Bad JSON: {err}"}
+
+    if isinstance(result, list):
+        result = {"lines": result}
+    elif not isinstance(result, dict):
+        return {"error": "A record must be a list of lines or an object."}
+
+    lines = result.pop("lines", None)
+    if not isinstance(lines, list) or not all(isinstance(ln, str) for ln in lines):
+        result["error"] = "The lines must be a list of strings."
+        return result
+
+    settings = WORKER_SETTINGS
+    try:
+        if settings.tree:
+            result["aligned"] = WORKER_LINE.align_tree(lines)
+        else:
+            result["aligned"] = WORKER_LINE.align(lines)
+
+        if settings.consensus:
+            consensus, confidence = WORKER_LINE.consensus(result["aligned"])
+            result["consensus"] = consensus
+            result["confidence"] = confidence
+
+        if settings.distances:
+            if settings.impl == "py":
+                distances = levenshtein_all(lines, settings.max_dist)
+            else:
+                distances = WORKER_LINE.levenshtein_all(lines, settings.max_dist)
+            result["distances"] = [list(d) for d in distances]
+
+    except ValueError as err:
+        result.pop("aligned", None)
+        result["error"] = str(err)
+
+    return result
@@ -1,6 +1,13 @@
+import functools
+import hashlib
+import os
 import sqlite3
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
+from typing import NamedTuple
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -10,6 +17,14 @@ from tqdm import tqdm
 
 CHAR_DB = Path(__file__).parent / "char_sub_matrix.sqlite"
 
+# Rendered glyphs and the progress of interrupted builds
+CACHE_DB = Path(__file__).parent / "char_sub_matrix_cache.sqlite"
+
+# The binary matrix file is: this signature, the alphabet size as a little-endian
+# uint64, the alphabet as uint32 code points, and then the scores as a dense float32
+# (size, size) matrix with NaN for missing pairs.
+MATRIX_MAGIC = b"LASUBMX1"
+
 CHARS = r"""
     ! " # % & ' ( ) * + , - . /
     0 1 2 3 4 5 6 7 8 9
@@ -53,7 +68,7 @@ class Char:
         char = " " if self.char.isspace() else self.char
         draw.text((0, 0), char, font=self.font, anchor="lt", fill="white")
         threshold = 128  # Midway point of [0, 255]
-        pix = np.asarray(image.getdata()) > threshold
+        pix = np.asarray(image) > threshold
         pix = pix.astype("float")
         return pix
 
@@ -74,19 +89,141 @@ class Char:
 
 
 # #####################################################################################
-def add_chars(char_set, new_chars, image_size, font_path, font_size):
-    """Add characters to the character substitution matrix."""
-    font = ImageFont.truetype(str(font_path), font_size)
+def add_chars(
+    char_set,
+    new_chars,
+    image_size,
+    font_path,
+    font_size,
+    *,
+    workers=1,
+    cache_db=CACHE_DB,
+):
+    """
+    Add characters to the character substitution matrix.
 
+    The pair scores are spread over a pool of worker processes and saved to the cache
+    database as they finish. If the build is interrupted then running it again with
+    the same arguments picks up where it stopped.
+    """
     matrix = select_matrix(char_set)
 
     old_chars = {k[0] for k in matrix}
     old_chars |= {k[1] for k in matrix}
 
     new_chars = set(new_chars)
+    all_chars = sorted(old_chars | new_chars)
+
+    glyphs = render_glyphs(all_chars, image_size, font_path, font_size, cache_db)
+
+    build = build_key(
+        char_set,
+        "".join(all_chars),
+        "".join(sorted(new_chars)),
+        image_size,
+        font_key(font_path),
+        font_size,
+    )
+    calc_scores(
+        old_chars,
+        new_chars,
+        matrix,
+        glyphs,
+        workers=workers,
+        cache_db=cache_db,
+        build=build,
+    )
 
-    calc_scores(old_chars, new_chars, matrix, image_size, font)
     insert_matrix(matrix, char_set)
+    clear_checkpoint(cache_db, build)
+
+
+def font_key(font_path):
+    """Identify a font file, including its version on disk."""
+    path = Path(font_path).resolve()
+    return f"{path}:{path.stat().st_mtime_ns}"
+
+
+def build_key(*args):
+    """Identify a build so that only an identical build resumes from a checkpoint."""
+    return hashlib.sha256("\0".join(map(str, args)).encode()).hexdigest()
+
+
+def create_cache(cxn):
+    cxn.executescript("""
+        create table if not exists glyphs (
+            font       text,
+            font_size  integer,
+            image_size integer,
+            char       text,
+            pix        blob,
+            primary key (font, font_size, image_size, char)
+        );
+        create table if not exists checkpoints (
+            build text,
+            char1 text,
+            char2 text,
+            score real,
+            sub   real,
+            primary key (build, char1, char2)
+        );
+        """)
+
+
+def render_glyphs(chars, image_size, font_path, font_size, cache_db=CACHE_DB):
+    """Get the centered pixels for every char, only rendering those not cached."""
+    font_id = font_key(font_path)
+    select = """
+        select char, pix from glyphs
+         where font = ? and font_size = ? and image_size = ?"""
+    insert = """insert or replace into glyphs values (?, ?, ?, ?, ?)"""
+
+    with connect(cache_db) as cxn:
+        create_cache(cxn)
+        rows = cxn.execute(select, (font_id, font_size, image_size))
+        glyphs = {
+            r["char"]: np.frombuffer(r["pix"], dtype=np.uint8)
+            .reshape(image_size, image_size)
+            .astype("float")
+            for r in rows
+        }
+
+        missing = [c for c in chars if c not in glyphs]
+        if missing:
+            font = ImageFont.truetype(str(font_path), font_size)
+            batch = []
+            for char in missing:
+                glyph = Char(char, image_size, font)
+                glyph.center()
+                glyphs[char] = glyph.pix
+                pix = glyph.pix.astype(np.uint8).tobytes()
+                batch.append((font_id, font_size, image_size, char, pix))
+            cxn.executemany(insert, batch)
+
+    return {c: glyphs[c] for c in chars}
+
+
+def select_checkpoint(cache_db, build):
+    sql = """select char1, char2, score, sub from checkpoints where build = ?"""
+    with connect(cache_db) as cxn:
+        create_cache(cxn)
+        rows = cxn.execute(sql, (build,))
+        return {
+            (r["char1"], r["char2"]): {"score": r["score"], "sub": r["sub"]}
+            for r in rows
+        }
+
+
+def insert_checkpoint(cache_db, build, scores):
+    sql = """insert or replace into checkpoints values (?, ?, ?, ?, ?)"""
+    batch = [(build, c1, c2, rec["score"], rec["sub"]) for (c1, c2), rec in scores]
+    with connect(cache_db) as cxn:
+        cxn.executemany(sql, batch)
+
+
+def clear_checkpoint(cache_db, build):
+    with connect(cache_db) as cxn:
+        cxn.execute("""delete from checkpoints where build = ?""", (build,))
 
 
 def select_matrix(char_set):
@@ -124,33 +261,88 @@ def insert_matrix(matrix, char_set):
         cxn.executemany(insert, batch)
 
 
-def calc_scores(old_chars, new_chars, matrix, image_size, font):
+def calc_scores(
+    old_chars, new_chars, matrix, glyphs, *, workers=1, cache_db=CACHE_DB, build=None
+):
     """
     Calculate character substitution values.
 
     Substitution values go from 2 to -2. The cutoff values for converting a scores into
     substitution values are _magic_ constants.
-    """
-    all_chars = [Char(c, image_size, font) for c in sorted(old_chars | new_chars)]
 
-    for i, char1 in tqdm(enumerate(all_chars)):
-        char1.center()
+    The IoU scores are calculated one char at a time, against all of the chars after
+    it. Each of these rows is a task for the worker pool, and is checkpointed when it
+    is done. Rows already in the checkpoint are skipped.
+    """
+    all_chars = sorted(old_chars | new_chars)
+    done = select_checkpoint(cache_db, build) if build else {}
+    matrix |= done
 
+    tasks = []
+    for i, char1 in enumerate(all_chars):
+        compare = []  # Chars that need an IoU score against char1
         for char2 in all_chars[i:]:
-            if char1.char not in new_chars and char2.char not in new_chars:
-                score = matrix[(char1.char, char2.char)]["score"]
-                sub = matrix[(char1.char, char2.char)]["sub"]
-            elif char1 == char2:
+            if char1 not in new_chars and char2 not in new_chars:
+                continue
+            if char1 == char2:
                 score = None
                 sub = 2.0
-            elif char1.char.isspace() or char2.char.isspace():
-                score = np.sum(char2.pix)
+            elif char1.isspace() or char2.isspace():
+                score = np.sum(glyphs[char2])
                 sub = -1.0 if score < 20 else -2.0  # noqa: PLR2004
+            elif (char1, char2) not in done:
+                compare.append(char2)
+                continue
             else:
-                score = get_max_iou(char1.pix, char2.pix)
-                sub = get_sub(score)
+                continue
 
-            matrix[(char1.char, char2.char)] = {"score": score, "sub": sub}
+            matrix[(char1, char2)] = {"score": score, "sub": sub}
+
+        if compare:
+            tasks.append((char1, compare))
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        init_worker(glyphs)
+        results = (score_row(*t) for t in tasks)
+        save_scores(tasks, results, matrix, cache_db, build)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(glyphs,)
+        ) as executor:
+            results = executor.map(score_row, *zip(*tasks, strict=True))
+            save_scores(tasks, results, matrix, cache_db, build)
+
+
+def save_scores(tasks, results, matrix, cache_db, build):
+    """Add each row of IoU scores to the matrix and checkpoint it."""
+    for (char1, compare), scores in tqdm(
+        zip(tasks, results, strict=True), total=len(tasks)
+    ):
+        row = {
+            (char1, char2): {"score": float(score), "sub": get_sub(score)}
+            for char2, score in zip(compare, scores, strict=True)
+        }
+        matrix |= row
+        if build:
+            insert_checkpoint(cache_db, build, row.items())
+
+
+# The glyphs for the worker processes, they are sent once when a worker starts
+WORKER_GLYPHS = {}
+
+
+def init_worker(glyphs):
+    global WORKER_GLYPHS
+    WORKER_GLYPHS = glyphs
+
+
+def score_row(char1, compare):
+    """Get the IoU scores for one char against a list of others."""
+    others = np.stack([WORKER_GLYPHS[c] for c in compare])
+    return max_ious(WORKER_GLYPHS[char1], others)
 
 
 def get_sub(score):  # TODO(rafe): These values are all way too MAGIC
@@ -167,22 +359,133 @@ def get_sub(score):  # TODO(rafe): These values are all way too MAGIC
 
 def get_max_iou(pix1, pix2):
     """Get the max intersection over union of two chars."""
-    max_iou = 0.0
-    for y in range(pix2.shape[0]):
-        for x in range(pix2.shape[1]):
-            rolled = np.roll(pix2, (y, x), axis=(0, 1))
-            overlap = pix1 + rolled
-            union = np.sum(overlap > 0.0)
-            inter = np.sum(overlap == 2.0)  # noqa: PLR2004
-            curr_iou = inter / union if union else 0.0
-            max_iou = max(max_iou, curr_iou)
-    return max_iou
+    return float(max_ious(pix1, pix2[np.newaxis])[0])
+
+
+def max_ious(pix, others):
+    """
+    Get the max intersection over union of a char against a stack of other chars.
+
+    The IoU is tried for every circular shift of the other chars. The intersections
+    for all of the shifts are a cross-correlation, so they are computed at once with
+    FFTs instead of rolling the image for each shift. The pixels must be 0 or 1.
+    """
+    pix = np.asarray(pix, dtype=np.float64)
+    others = np.asarray(others, dtype=np.float64)
+
+    corr = np.fft.rfft2(pix) * np.conj(np.fft.rfft2(others))
+    inter = np.rint(np.fft.irfft2(corr, s=pix.shape))
+
+    sizes = np.sum(others, axis=(1, 2))[:, np.newaxis, np.newaxis]
+    union = np.sum(pix) + sizes - inter
+
+    iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0.0)
+    return iou.max(axis=(1, 2))
 
 
 # #####################################################################################
+class SubMatrix(NamedTuple):
+    alphabet: str
+    scores: np.ndarray  # float32 (len(alphabet), len(alphabet)), NaN if missing
+
+    def to_dict(self):
+        """Convert to the two character key format used by LineAlign."""
+        matrix = {}
+        for i, j in zip(*np.nonzero(~np.isnan(self.scores)), strict=True):
+            char1, char2 = self.alphabet[i], self.alphabet[j]
+            if char1 <= char2:
+                matrix[char1 + char2] = float(self.scores[i, j])
+        return matrix
+
+
 def get(char_set="default"):
-    sql = """select * from char_sub_matrix where char_set = ?"""
+    """Get the substitution matrix as a dict, see load()."""
+    return dict(get_dict(char_set))
+
+
+@functools.lru_cache(maxsize=16)
+def get_dict(char_set):
+    return load(char_set).to_dict()
+
+
+@functools.lru_cache(maxsize=16)
+def load(char_set="default"):
+    """
+    Get the memory mapped substitution matrix for a char_set.
+
+    The matrix file is built from the database the first time, and again whenever the
+    database changes. It is kept in the user's cache directory, not in the package.
+    The result is cached for the life of the process, and forked processes share the
+    mapped pages.
+    """
+    path = matrix_path(char_set)
+    if not path.exists() or path.stat().st_mtime < CHAR_DB.stat().st_mtime:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            export(char_set, path)
+        except OSError:  # No writable cache directory
+            return build(char_set)
+    try:
+        return read(path)
+    except OSError:  # A file written by another user that this one cannot read
+        return build(char_set)
+
+
+def matrix_path(char_set):
+    """Get the matrix file for a char_set, one per install of the database."""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    install = hashlib.sha256(str(CHAR_DB.resolve()).encode()).hexdigest()[:12]
+    return Path(cache_dir) / "line-align" / f"char_sub_matrix.{char_set}.{install}.bin"
+
+
+def build(char_set="default"):
+    """Build the substitution matrix for a char_set from the database."""
+    sql = """select char1, char2, sub from char_sub_matrix where char_set = ?"""
     with connect(CHAR_DB) as cxn:
-        rows = cxn.execute(sql, (char_set,))
-        matrix = {f'{r["char1"]}{r["char2"]}': r["sub"] for r in rows}
-        return matrix
+        rows = cxn.execute(sql, (char_set,)).fetchall()
+
+    alphabet = sorted({r["char1"] for r in rows} | {r["char2"] for r in rows})
+    index = {c: i for i, c in enumerate(alphabet)}
+
+    scores = np.full((len(alphabet), len(alphabet)), np.nan, dtype="<f4")
+    # Keys in lexical order win over the reversed key, like the lookups in LineAlign
+    for row in sorted(rows, key=lambda r: r["char1"] <= r["char2"]):
+        i, j = index[row["char1"]], index[row["char2"]]
+        scores[i, j] = scores[j, i] = row["sub"]
+
+    return SubMatrix(alphabet="".join(alphabet), scores=scores)
+
+
+def export(char_set="default", path=None):
+    """Write the substitution matrix for a char_set to a binary matrix file."""
+    path = Path(path) if path else matrix_path(char_set)
+    matrix = build(char_set)
+    codes = np.array([ord(c) for c in matrix.alphabet], dtype="<u4")
+
+    # Write to a temporary file first so readers never see a partial file
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as temp:
+        temp.write(MATRIX_MAGIC)
+        temp.write(struct.pack("<Q", len(matrix.alphabet)))
+        temp.write(codes.tobytes())
+        temp.write(matrix.scores.tobytes())
+    # Temporary files are only readable by their owner, but the file may be shared
+    Path(temp.name).chmod(0o644)
+    Path(temp.name).replace(path)
+    return path
+
+
+def read(path):
+    """Memory map a binary matrix file."""
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(data[: len(MATRIX_MAGIC)]) != MATRIX_MAGIC:
+        msg = f"{path} is not a substitution matrix file."
+        raise ValueError(msg)
+
+    start = len(MATRIX_MAGIC)
+    (size,) = struct.unpack("<Q", bytes(data[start : start + 8]))
+    start += 8
+    codes = data[start : start + 4 * size].view("<u4")
+    start += 4 * size
+    scores = data[start : start + 4 * size * size].view("<f4").reshape(size, size)
+
+    return SubMatrix(alphabet="".join(map(chr, codes)), scores=scores)
@@ -0,0 +1,182 @@
+"""
+Group lines that are versions of the same line, so each group can be aligned.
+
+Comparing every pair of lines with levenshtein_all() is quadratic, so this does it
+in three steps instead:
+1. Every line gets a MinHash signature of its q-grams (the substrings of length q).
+   Lines that share most of their q-grams are likely to share signature values.
+2. The signatures are cut into bands and lines with the same values for a band
+   land in the same bucket (locality sensitive hashing). Only lines that share a
+   bucket become candidate pairs.
+3. Each candidate pair is checked with the Levenshtein distance and the pairs
+   that pass are joined into groups.
+
+Lines that are already in the same group are not checked again, and each line is
+only checked against the max_bucket lines before it in a bucket, so the work grows
+about linearly with the number of lines.
+"""
+
+from collections.abc import Callable, Iterator
+
+import numpy as np
+
+from line_align.pylib.levenshtein import levenshtein
+
+PRIME = (1 << 31) - 1  # The hashes are all mod this, so products fit in 64 bits
+BASE = 1_000_003  # For the rolling hash of the q-grams
+
+
+def cluster(
+    lines: list[str],
+    *,
+    q: int = 3,
+    bands: int = 32,
+    rows: int = 3,
+    max_ratio: float = 0.2,
+    max_dist: int | None = None,
+    max_bucket: int = 50,
+    seed: int = 0,
+    distance: Callable[[str, str, int], int] = levenshtein,
+) -> list[list[int]]:
+    """
+    Group the near duplicate lines.
+
+    @param lines The lines to group.
+    @param q The length of the q-grams.
+    @param bands The number of bands in the signatures. More bands find more of the
+        near duplicates but make more candidate pairs.
+    @param rows The number of MinHash values in a band. More rows make the lines
+        need more q-grams in common to become candidates.
+    @param max_ratio Lines are near duplicates when their Levenshtein distance is
+        at most this fraction of the length of the longer line.
+    @param max_dist If given, this is the largest distance instead of max_ratio.
+    @param max_bucket Only check each line against this many lines before it in a
+        bucket. This stops common q-grams from making the work quadratic.
+    @param seed Seed for the MinHash functions.
+    @param distance The distance function, called as distance(line1, line2,
+        max_dist). The native extension's LineAlign.levenshtein also works.
+    @return The groups as lists of indexes into lines. The groups are in order of
+        their first line and lines in a group are in input order. Lines without
+        any near duplicates are in groups of their own.
+    """
+    signatures = minhash(lines, q=q, perms=bands * rows, seed=seed)
+    parents = list(range(len(lines)))
+
+    for i, j in candidate_pairs(
+        signatures, bands=bands, rows=rows, max_bucket=max_bucket
+    ):
+        root_i, root_j = find(parents, i), find(parents, j)
+        if root_i == root_j:
+            continue
+        line_i, line_j = lines[i], lines[j]
+        limit = max_dist
+        if limit is None:
+            limit = int(max_ratio * max(len(line_i), len(line_j)))
+        if abs(len(line_i) - len(line_j)) > limit:
+            continue
+        if distance(line_i, line_j, limit) <= limit:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(lines)):
+        groups.setdefault(find(parents, i), []).append(i)
+    return list(groups.values())
+
+
+def group_lines(lines: list[str], **kwargs) -> list[list[str]]:
+    """Get the groups from cluster() as lists of lines, ready for LineAlign.align()."""
+    return [[lines[i] for i in group] for group in cluster(lines, **kwargs)]
+
+
+def find(parents: list[int], i: int) -> int:
+    """Find the root of a group, and shorten the path to it on the way."""
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def minhash(
+    lines: list[str], *, q: int = 3, perms: int = 96, seed: int = 0, batch: int = 4096
+) -> np.ndarray:
+    """
+    Get the MinHash signature for every line.
+
+    The lines are padded with q - 1 nulls on each side, so short lines still have
+    q-grams and the ends of the lines get q-grams of their own.
+
+    @return A (perms, len(lines)) uint64 array.
+    """
+    if q < 2:  # noqa: PLR2004
+        msg = "The q-grams must be at least 2 characters long."
+        raise ValueError(msg)
+
+    rng = np.random.default_rng(seed)
+    mult = rng.integers(1, PRIME, size=perms, dtype=np.uint64)
+    add = rng.integers(0, PRIME, size=perms, dtype=np.uint64)
+
+    signatures = np.empty((perms, len(lines)), dtype=np.uint64)
+    for start in range(0, len(lines), batch):
+        hashes, starts = qgram_hashes(lines[start : start + batch], q)
+        for perm in range(perms):
+            values = (hashes * mult[perm] + add[perm]) % PRIME
+            signatures[perm, start : start + batch] = np.minimum.reduceat(
+                values, starts
+            )
+    return signatures
+
+
+def qgram_hashes(lines: list[str], q: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the hash of every q-gram in the lines.
+
+    @return The hashes of all of the lines one after the other, and the index of the
+        first hash for each line.
+    """
+    pad = "\0" * (q - 1)
+    text = "".join(pad + ln + pad for ln in lines)
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+    hashes = np.zeros(max(len(codes) - q + 1, 0), dtype=np.uint64)
+    for k in range(q):
+        hashes = (hashes * BASE + codes[k : k + len(hashes)]) % PRIME
+
+    # Drop the q-grams that cross from one line into the next
+    counts = np.array([len(ln) + q - 1 for ln in lines], dtype=np.intp)
+    ends = np.cumsum(counts + q - 1)
+    firsts = ends - counts - q + 1
+    keep = np.repeat(firsts, counts) + (
+        np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    starts = np.cumsum(counts) - counts
+    return hashes[keep], starts
+
+
+def candidate_pairs(
+    signatures: np.ndarray, *, bands: int, rows: int, max_bucket: int
+) -> Iterator[tuple[int, int]]:
+    """
+    Get the pairs of lines that have the same signature values in any band.
+
+    @return Pairs of line indexes (i, j) with i < j. Each line is paired with at most
+        max_bucket of the lines before it in each bucket.
+    """
+    for band in range(bands):
+        # Mix the rows of the band into one key per line
+        keys = np.zeros(signatures.shape[1], dtype=np.uint64)
+        for row in signatures[band * rows : (band + 1) * rows]:
+            keys = (keys * np.uint64(0x100000001B3)) ^ row
+
+        order = np.argsort(keys, kind="stable")
+        ordered = keys[order]
+        breaks = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+        firsts = np.concatenate(([0], breaks))
+        lasts = np.concatenate((breaks, [len(keys)]))
+
+        for first, last in zip(firsts.tolist(), lasts.tolist(), strict=True):
+            if last - first < 2:  # noqa: PLR2004
+                continue
+            bucket = order[first:last].tolist()
+            for k in range(1, len(bucket)):
+                for i in bucket[max(0, k - max_bucket) : k]:
+                    yield i, bucket[k]
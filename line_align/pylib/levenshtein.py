@@ -14,6 +14,10 @@ from typing import NamedTuple
 
 import numpy as np
 
+# levenshtein_many() has a fixed NumPy cost per call, so it only beats a loop over
+# levenshtein() when there are at least this many candidates
+MANY_CUTOFF = 64
+
 
 class Distance(NamedTuple):
     dist: int
@@ -21,59 +25,224 @@ class Distance(NamedTuple):
     idx2: int
 
 
-# Modified from: https://en.wikipedia.org/wiki/Levenshtein_distance
-def levenshtein(str1: str, str2: str) -> int:
+def check_max_dist(max_dist: int | None) -> None:
+    """Distances are never negative so neither is a cutoff for them."""
+    if max_dist is not None and max_dist < 0:
+        msg = "The max_dist must not be negative."
+        raise ValueError(msg)
+
+
+def levenshtein(str1: str, str2: str, max_dist: int | None = None) -> int:
     """
     Compute the Levenshtein distance for 2 strings.
 
+    This uses the bit-parallel algorithm from Myers, 1999 as formulated by Hyyrö,
+    2001. Python integers are used as bit-vectors, so there is no limit on the
+    length of the strings.
+
     @param str1 Is a string to compare.
     @param str2 The other string to compare.
+    @param max_dist If given, stop as soon as the distance is certain to be more
+            than this and return max_dist + 1. It must not be negative.
     @return The Levenshtein distance is an integer. The lower the number the more
             similar the strings.
     """
+    check_max_dist(max_dist)
+
+    # The shorter string is the pattern, it sets the width of the bit-vectors
+    if len(str1) < len(str2):
+        str1, str2 = str2, str1
+
     len1: int = len(str1)
     len2: int = len(str2)
 
-    v0: np.array = np.array(list(range(len2 + 1)), dtype=np.int32)
-    v1: np.array = np.zeros(len2 + 1, dtype=np.int32)
+    if max_dist is not None and len1 - len2 > max_dist:
+        return max_dist + 1
+
+    if len2 == 0:
+        return len1
+
+    # A bit-vector for every character in the pattern, marking where it occurs
+    peq: dict[str, int] = {}
+    for i, char in enumerate(str2):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask: int = (1 << len2) - 1
+    last: int = 1 << (len2 - 1)
+
+    # Vertical positive & negative deltas for the current column
+    pv: int = mask
+    mv: int = 0
+    dist: int = len2
+
+    for i, char in enumerate(str1, start=1):
+        eq: int = peq.get(char, 0)
+        xv: int = eq | mv
+        xh: int = (((eq & pv) + pv) ^ pv) | eq
 
-    for i in range(len1):
-        v1[0] = i + 1
+        # Horizontal positive & negative deltas
+        ph: int = mv | (~(xh | pv) & mask)
+        mh: int = pv & xh
 
-        for j in range(len2):
-            del_: int = v0[j + 1] + 1
-            ins: int = v1[j] + 1
-            sub: int = v0[j] if str1[i] == str2[j] else v0[j] + 1
+        if ph & last:
+            dist += 1
+        elif mh & last:
+            dist -= 1
 
-            min_: int = del_ if del_ < ins else ins
-            min_ = min_ if min_ < sub else sub
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
 
-            v1[j + 1] = min_
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
 
-        v0, v1 = v1, v0
+        # Each of the remaining characters can only lower the distance by one
+        if max_dist is not None and dist - (len1 - i) > max_dist:
+            return max_dist + 1
 
-    return v0[len2]
+    return dist
 
 
-def levenshtein_all(strings: list[str]) -> list[Distance]:
+def levenshtein_many(
+    query: str, candidates: list[str], max_dist: int | None = None
+) -> np.ndarray:
+    """
+    Compute the Levenshtein distance from one string to many other strings.
+
+    This is the same bit-parallel algorithm as levenshtein() but the query is the
+    pattern and all the candidates are advanced together, one character position at a
+    time, with NumPy arrays. Queries longer than 64 characters are split into 64 bit
+    blocks with the horizontal deltas carried between them (Hyyrö, 2003).
+
+    @param query The string to compare with every candidate.
+    @param candidates A list of strings to compare with the query.
+    @param max_dist If given, any distance more than this is returned as
+            max_dist + 1. It must not be negative.
+    @return An array with the Levenshtein distance to each candidate.
+    """
+    check_max_dist(max_dist)
+
+    lengths = np.array([len(c) for c in candidates], dtype=np.int64)
+    len_q = len(query)
+
+    if len_q == 0 or len(candidates) == 0:
+        dist = lengths.copy()
+        return dist if max_dist is None else np.minimum(dist, max_dist + 1)
+
+    codes = encode_many(query, candidates, lengths)
+
+    # A bit-vector for every character in the query, in 64 bit blocks. The extra
+    # last code is for characters not in the query.
+    blocks = (len_q + 63) // 64
+    chars = sorted(set(query))
+    index = {c: i for i, c in enumerate(chars)}
+    peq = np.zeros((blocks, len(chars) + 1), dtype=np.uint64)
+    for i, char in enumerate(query):
+        peq[i // 64, index[char]] |= np.uint64(1 << (i % 64))
+
+    one = np.uint64(1)
+    top = np.uint64(63)
+    last = np.uint64(1 << ((len_q - 1) % 64))
+
+    count = len(candidates)
+    pvs = np.full((blocks, count), ~np.uint64(0), dtype=np.uint64)
+    mvs = np.zeros((blocks, count), dtype=np.uint64)
+    dist = np.full(count, len_q, dtype=np.int64)
+
+    for pos in range(codes.shape[0]):
+        active = pos < lengths
+
+        # The top row of the matrix is always +1 from the left
+        hin_pos = np.ones(count, dtype=np.uint64)
+        hin_neg = np.zeros(count, dtype=np.uint64)
+
+        for block in range(blocks):
+            pv = pvs[block]
+            mv = mvs[block]
+            eq = peq[block, codes[pos]]
+
+            xv = eq | mv
+            eq |= hin_neg
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+
+            if block == blocks - 1:
+                delta = ((ph & last) != 0).astype(np.int64)
+                delta -= (mh & last) != 0
+                dist += np.where(active, delta, 0)
+
+            hout_pos = ph >> top
+            hout_neg = mh >> top
+
+            ph = (ph << one) | hin_pos
+            mh = (mh << one) | hin_neg
+            pvs[block] = mh | ~(xv | ph)
+            mvs[block] = ph & xv
+
+            hin_pos, hin_neg = hout_pos, hout_neg
+
+        # Each of the remaining characters can only lower a distance by one
+        if max_dist is not None and np.all(dist - (lengths - pos - 1) > max_dist):
+            break
+
+    if max_dist is not None:
+        dist = np.where(dist > max_dist, max_dist + 1, dist)
+
+    return dist
+
+
+def encode_many(query: str, candidates: list[str], lengths: np.ndarray) -> np.ndarray:
+    """
+    Convert the candidates into indexes of the sorted distinct characters in query.
+
+    @return A (longest candidate, number of candidates) array. Characters that are
+            not in the query and the padding after the end of a candidate get the
+            index len(set(query)).
+    """
+    chars = np.array(sorted({ord(c) for c in query}), dtype=np.uint32)
+
+    flat = np.frombuffer("".join(candidates).encode("utf-32-le"), dtype=np.uint32)
+    idx = np.searchsorted(chars, flat)
+    found = chars[np.minimum(idx, len(chars) - 1)] == flat
+    flat_codes = np.where(found, idx, len(chars))
+
+    starts = np.cumsum(lengths) - lengths
+    cand = np.repeat(np.arange(len(candidates)), lengths)
+    pos = np.arange(len(flat)) - np.repeat(starts, lengths)
+
+    codes = np.full((max(lengths.max(), 1), len(candidates)), len(chars), dtype=np.intp)
+    codes[pos, cand] = flat_codes
+    return codes
+
+
+def levenshtein_all(strings: list[str], max_dist: int | None = None) -> list[Distance]:
     """
     Compute a Levenshtein distance for every pair of strings in the list.
 
     @param strings A list of strings to compare.
+    @param max_dist If given, only return the pairs with a distance of at most this.
+            It must not be negative.
     @return A sorted list of Distance objects, each contain:
         - dist: The Levenshtein distance of the pair of strings.
         - idx1: The index of the first string compared.
         - idx2: The index of the second string compared.
         The Distance objects are sorted by distance.
     """
+    check_max_dist(max_dist)
+
     results: list[Distance] = []
 
     len_ = len(strings)
 
     for i in range(len_ - 1):
-        for j in range(i + 1, len_):
-            dist = levenshtein(strings[i], strings[j])
-            results.append(Distance(dist, i, j))
+        others = strings[i + 1 :]
+        if len(others) >= MANY_CUTOFF:
+            dists = levenshtein_many(strings[i], others, max_dist).tolist()
+        else:
+            dists = [levenshtein(strings[i], other, max_dist) for other in others]
+        for j, dist in enumerate(dists, start=i + 1):
+            if max_dist is None or dist <= max_dist:
+                results.append(Distance(dist, i, j))
 
     results = sorted(results, key=lambda r: (r.dist, r.idx1, r.idx2))
 
@@ -0,0 +1,308 @@
+"""
+Find the lines in a large reference list that are closest to a query line.
+
+This is a q-gram inverted index with count filtering. Every edit destroys at most q
+of a line's q-grams, so a reference line within a distance d of the query must
+share at least max(len(query), len(line)) + q - 1 - q * d q-grams with it. Only the
+lines that share enough q-grams are checked with the Levenshtein distance.
+
+The reference lines are kept in order of length, so the lines with a possible
+length are a range of ids, and each posting list is cut down to that range before
+it is counted. The index is saved in a single file that is memory mapped when it
+is loaded, so loading is quick and only the pages a query touches are read.
+"""
+
+import struct
+import tempfile
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from line_align.pylib.cluster import qgram_hashes
+from line_align.pylib.levenshtein import levenshtein_many
+
+# The index file is: this signature; q, the number of lines, q-grams, postings, and
+# text bytes as little-endian uint64s; and then the arrays in the order of FIELDS.
+INDEX_MAGIC = b"LAINDEX1"
+
+FIELDS = (
+    ("grams", "<u8"),  # The distinct q-gram hashes, sorted
+    ("offsets", "<i8"),  # The postings for grams[i] are ids[offsets[i]:offsets[i+1]]
+    ("order", "<i8"),  # The index of each line in the original list
+    ("text_offsets", "<i8"),  # Line i is text[text_offsets[i]:text_offsets[i+1]]
+    ("ids", "<i4"),  # The line ids of the postings, one per q-gram occurrence
+    ("lengths", "<i4"),  # The length of each line, in ascending order
+    ("text", "u1"),  # The lines as UTF-8
+)
+
+
+class Match(NamedTuple):
+    dist: int
+    idx: int  # The index of the line in the list the index was built from
+    line: str
+
+
+@dataclass(eq=False)
+class LineIndex:
+    """
+    A q-gram index of reference lines.
+
+    Use LineIndex.build() or LineIndex.load() to make one.
+
+    @param distance The function used to check the candidate lines, called as
+        distance(query, lines, max_dist) like levenshtein_many(). It returns the
+        distance to each line and may return anything over max_dist for lines
+        that are further away.
+    """
+
+    q: int
+    grams: np.ndarray
+    offsets: np.ndarray
+    order: np.ndarray
+    text_offsets: np.ndarray
+    ids: np.ndarray
+    lengths: np.ndarray
+    text: np.ndarray
+    distance: Callable[[str, list[str], int | None], Sequence[int]] = field(
+        default=levenshtein_many, repr=False
+    )
+
+    @classmethod
+    def build(cls, lines: list[str], q: int = 3, **kwargs) -> "LineIndex":
+        """Index the reference lines."""
+        lengths = np.array([len(ln) for ln in lines], dtype="<i4")
+        order = np.argsort(lengths, kind="stable").astype("<i8")
+        lines = [lines[i] for i in order]
+        lengths = lengths[order]
+
+        encoded = [ln.encode() for ln in lines]
+        text_offsets = np.zeros(len(lines) + 1, dtype="<i8")
+        np.cumsum([len(b) for b in encoded], out=text_offsets[1:])
+        text = np.frombuffer(b"".join(encoded), dtype="u1")
+
+        hashes, _ = qgram_hashes(lines, q)
+        ids = np.repeat(np.arange(len(lines), dtype="<i4"), lengths + q - 1)
+        postings = np.lexsort((ids, hashes))
+        hashes, ids = hashes[postings], ids[postings]
+
+        grams, firsts = np.unique(hashes, return_index=True)
+        offsets = np.append(firsts, len(ids)).astype("<i8")
+
+        return cls(
+            q=q,
+            grams=grams.astype("<u8"),
+            offsets=offsets,
+            order=order,
+            text_offsets=text_offsets,
+            ids=ids,
+            lengths=lengths,
+            text=text,
+            **kwargs,
+        )
+
+    @classmethod
+    def load(cls, path: Path | str, **kwargs) -> "LineIndex":
+        """Memory map an index file written by save()."""
+        # A plain array over the map is faster to slice than a memmap
+        data = np.asarray(np.memmap(path, dtype=np.uint8, mode="r"))
+        if bytes(data[: len(INDEX_MAGIC)]) != INDEX_MAGIC:
+            msg = f"{path} is not a line index file."
+            raise ValueError(msg)
+
+        start = len(INDEX_MAGIC)
+        q, lines, grams, postings, text = struct.unpack(
+            "<5Q", bytes(data[start : start + 40])
+        )
+        start += 40
+
+        sizes = {
+            "grams": grams,
+            "offsets": grams + 1,
+            "order": lines,
+            "text_offsets": lines + 1,
+            "ids": postings,
+            "lengths": lines,
+            "text": text,
+        }
+        arrays = {}
+        for name, dtype in FIELDS:
+            end = start + sizes[name] * np.dtype(dtype).itemsize
+            arrays[name] = data[start:end].view(dtype)
+            start = end
+
+        return cls(q=q, **arrays, **kwargs)
+
+    def save(self, path: Path | str) -> Path:
+        """Write the index to a file."""
+        path = Path(path)
+        sizes = (len(self.order), len(self.grams), len(self.ids), len(self.text))
+
+        # Write to a temporary file first so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as temp:
+            temp.write(INDEX_MAGIC)
+            temp.write(struct.pack("<5Q", self.q, *sizes))
+            for name, dtype in FIELDS:
+                temp.write(np.ascontiguousarray(getattr(self, name), dtype=dtype))
+        # Temporary files are only readable by their owner
+        Path(temp.name).chmod(0o644)
+        Path(temp.name).replace(path)
+        return path
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def line(self, id_: int) -> str:
+        """Get a reference line by its id in the index."""
+        start, end = self.text_offsets[id_], self.text_offsets[id_ + 1]
+        return bytes(self.text[start:end]).decode()
+
+    def lines(self, ids: np.ndarray) -> list[str]:
+        """Get the reference lines for an array of ids."""
+        if len(ids) == 0:
+            return []
+        starts = self.text_offsets[ids]
+        ends = self.text_offsets[ids + 1]
+
+        # Copy the text in one piece when the lines are close together, slicing
+        # a bytes object is much quicker than slicing an array
+        lo, hi = int(starts.min()), int(ends.max())
+        if hi - lo <= 4 * int((ends - starts).sum()):
+            text = self.text[lo:hi].tobytes()
+            starts, ends = starts - lo, ends - lo
+        else:
+            text = self.text
+        return [
+            bytes(text[s:e]).decode()
+            for s, e in zip(starts.tolist(), ends.tolist(), strict=True)
+        ]
+
+    def within(self, query: str, max_dist: int) -> list[Match]:
+        """
+        Find the reference lines within a Levenshtein distance of the query.
+
+        @return The matches sorted by distance and then by index.
+        """
+        first, last = self.length_range(len(query), max_dist)
+
+        if len(query) + self.q - 1 - self.q * max_dist > 0:
+            ids, shared = self.shared_grams(query, first, last)
+            ids = ids[shared >= self.min_shared(len(query), ids, max_dist)]
+        else:  # The query is too short for any q-gram to be required
+            ids = np.arange(first, last)
+
+        return sorted(self.verify(query, ids, max_dist))
+
+    def nearest(self, query: str, k: int = 1) -> list[Match]:
+        """
+        Find the k reference lines closest to the query.
+
+        Every line that shares q-grams with the query gets a lower bound on its
+        distance from its length and the number of q-grams it shares. The lines are
+        checked in order of that bound until the bound is more than the distance to
+        the kth best match. Lines that share no q-grams are only checked when the
+        kth best match is so far away that they could still beat it.
+
+        @return The matches sorted by distance and then by index. Ties with the
+            last match are cut off.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+
+        ids, shared = self.shared_grams(query, 0, len(self))
+        longer = np.maximum(self.lengths[ids], len(query))
+        bounds = np.maximum(
+            np.abs(self.lengths[ids] - len(query)),
+            -((shared - longer - self.q + 1) // self.q),  # Rounded up
+        )
+
+        matches = []
+        for bound in np.unique(bounds).tolist():
+            if len(matches) >= k and bound > matches[-1].dist:
+                break
+            max_dist = matches[-1].dist if len(matches) >= k else None
+            found = self.verify(query, ids[bounds == bound], max_dist)
+            matches = sorted(matches + found)[:k]
+
+        # The bound for a line with no shared q-grams, at its shortest
+        unshared = -(-(len(query) + self.q - 1) // self.q)
+        if len(matches) < k or matches[-1].dist >= unshared:
+            max_dist = matches[-1].dist if len(matches) >= k else None
+            first, last = self.length_range(len(query), max_dist)
+            rest = np.setdiff1d(np.arange(first, last), ids, assume_unique=True)
+            found = self.verify(query, rest, max_dist)
+            matches = sorted(matches + found)[:k]
+
+        return matches
+
+    def verify(self, query: str, ids: np.ndarray, max_dist: int | None) -> list[Match]:
+        """Get the lines that are within max_dist of the query, if it is given."""
+        if len(ids) == 0:
+            return []
+        lines = self.lines(ids)
+        dists = self.distance(query, lines, max_dist)
+        return [
+            Match(int(dist), int(self.order[id_]), line)
+            for id_, line, dist in zip(ids.tolist(), lines, dists, strict=True)
+            if max_dist is None or dist <= max_dist
+        ]
+
+    def length_range(self, length: int, max_dist: int | None) -> tuple[int, int]:
+        """Get the range of ids for lines within max_dist of a length."""
+        if max_dist is None:
+            return 0, len(self)
+        first = int(np.searchsorted(self.lengths, length - max_dist, "left"))
+        last = int(np.searchsorted(self.lengths, length + max_dist, "right"))
+        return first, last
+
+    def min_shared(self, length: int, ids: np.ndarray, max_dist: int) -> np.ndarray:
+        """Get the fewest q-grams each line must share to be within max_dist."""
+        longer = np.maximum(self.lengths[ids], length)
+        return longer + self.q - 1 - self.q * max_dist
+
+    def shared_grams(
+        self, query: str, first: int, last: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Count the q-grams that each line in [first, last) shares with the query.
+
+        @return The ids of the lines that share any q-grams, in order, and the
+            number of q-grams each one shares.
+        """
+        none = np.zeros(0, dtype=np.int64)
+        if len(self.grams) == 0:
+            return none, none
+
+        hashes, _ = qgram_hashes([query], self.q)
+        query_grams, query_counts = np.unique(hashes, return_counts=True)
+
+        found = np.searchsorted(self.grams, query_grams)
+        found[found == len(self.grams)] = 0
+        hits = self.grams[found] == query_grams
+
+        ids = []
+        shared = []
+        for pos, count in zip(found[hits], query_counts[hits], strict=True):
+            postings = self.ids[self.offsets[pos] : self.offsets[pos + 1]]
+            lo, hi = np.searchsorted(postings, [first, last])
+            postings = postings[lo:hi]
+            if len(postings) == 0:
+                continue
+            # A q-gram counts as many times as it is in both the query and the line
+            starts = np.flatnonzero(np.diff(postings, prepend=-1))
+            counts = np.diff(np.append(starts, len(postings)))
+            ids.append(postings[starts])
+            shared.append(np.minimum(counts, count))
+
+        if not ids:
+            return none, none
+
+        ids = np.concatenate(ids).astype(np.int64)
+        shared = np.concatenate(shared).astype(np.int64)
+        order = np.argsort(ids, kind="stable")
+        ids, shared = ids[order], shared[order]
+        starts = np.flatnonzero(np.diff(ids, prepend=-1))
+        return ids[starts], np.add.reduceat(shared, starts)
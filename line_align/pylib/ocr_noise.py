@@ -0,0 +1,89 @@
+"""
+Make synthetic OCR output for tests and benchmarks.
+
+A clean line is a random run of words. Each noisy copy of it gets the kinds of
+errors an OCR engine makes: characters swapped for ones that look like them,
+characters dropped or added, and ragged line ends.
+"""
+
+import random
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from line_align.pylib import char_sub_matrix
+
+
+@dataclass
+class OcrNoise:
+    """
+    A seeded generator of noisy copies of text lines.
+
+    @param substitutions The substitution matrix, like the one from
+        char_sub_matrix.get(). Pairs of different characters that score at least
+        min_sub are the confusable characters.
+    @param seed Seed for the random generator, so runs can be repeated.
+    @param sub_rate The chance of replacing a char with a confusable one.
+    @param drop_rate The chance of dropping a char.
+    @param insert_rate The chance of adding a random char after a char.
+    @param end_rate The chance of dropping chars from each end of a line.
+    @param max_end The most chars dropped from one end of a line.
+    @param min_sub The lowest substitution score that counts as confusable.
+    """
+
+    substitutions: dict[str, float] = field(default_factory=char_sub_matrix.get)
+    seed: int = 0
+    sub_rate: float = 0.05
+    drop_rate: float = 0.02
+    insert_rate: float = 0.01
+    end_rate: float = 0.3
+    max_end: int = 3
+    min_sub: float = 0.0
+
+    def __post_init__(self):
+        self.rand = random.Random(self.seed)  # noqa: S311
+
+        chars = {c for k in self.substitutions for c in k}
+        self.chars = sorted(c for c in chars if c.isprintable())
+        self.letters = [c for c in self.chars if c.isalnum()]
+
+        self.confusable = defaultdict(list)
+        for (char1, char2), sub in self.substitutions.items():
+            if char1 != char2 and sub >= self.min_sub:
+                self.confusable[char1].append(char2)
+                self.confusable[char2].append(char1)
+        for confusable in self.confusable.values():
+            confusable.sort()
+
+    def line(self, length: int) -> str:
+        """Get a clean line of random words."""
+        chars = []
+        while len(chars) < length:
+            if chars:
+                chars.append(" ")
+            chars += self.rand.choices(self.letters, k=self.rand.randint(1, 9))
+        return "".join(chars[:length])
+
+    def noisy(self, line: str) -> str:
+        """Get a copy of the line with OCR errors in it."""
+        chars = []
+        for char in line:
+            roll = self.rand.random()
+            if roll < self.drop_rate:
+                continue
+            if roll < self.drop_rate + self.sub_rate and self.confusable[char]:
+                char = self.rand.choice(self.confusable[char])
+            chars.append(char)
+            if self.rand.random() < self.insert_rate:
+                chars.append(self.rand.choice(self.chars))
+
+        if self.rand.random() < self.end_rate:
+            chars = chars[self.rand.randint(1, self.max_end) :]
+        if self.rand.random() < self.end_rate:
+            chars = chars[: max(0, len(chars) - self.rand.randint(1, self.max_end))]
+
+        return "".join(chars)
+
+    def group(self, length: int, size: int) -> list[str]:
+        """Get noisy copies of one clean line."""
+        line = self.line(length)
+        return [self.noisy(line) for _ in range(size)]
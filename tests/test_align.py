@@ -1,7 +1,7 @@
 import unittest
 
 from line_align.pylib import char_sub_matrix
-from line_align.pylib.align import LineAlign
+from line_align.pylib.align import Aligner, AlignStats, LineAlign, render
 
 
 class TestAlign(unittest.TestCase):
@@ -102,3 +102,113 @@ class TestAlign(unittest.TestCase):
                 "North Carolina ⋄OT⋄⋄ CAROLINA Guilford County",
             ],
         )
+
+    def test_align_16(self):
+        self.assertEqual(
+            self.line.align(["aab", "aab", "aab", "ab"]),
+            ["aab", "aab", "aab", "a⋄b"],
+        )
+
+    def test_align_17(self):
+        line = LineAlign({"aa": 0.0, "bb": 0.0})
+        with self.assertRaises(ValueError):
+            line.align(["aa", "ab"])
+
+    def test_align_tree_01(self):
+        self.assertEqual(
+            self.line.align_tree(["aab", "b", "ab", "aab"]),
+            ["aab", "⋄⋄b", "a⋄b", "aab"],
+        )
+
+    def test_align_tree_02(self):
+        self.assertEqual(self.line.align_tree(["aab"]), ["aab"])
+
+    def test_align_tree_03(self):
+        line = LineAlign(self.matrix)
+        results = line.align_tree(
+            [
+                "Johns Island Sta tion on",
+                " Johns Island Stati on on",
+                "Johns Island Station on i",
+                "Station or",
+            ],
+        )
+        self.assertEqual(
+            results,
+            [
+                "⋄Johns Island Sta ti⋄on on⋄⋄",
+                " Johns Island Sta⋄ti on on⋄⋄",
+                "⋄Johns Island Sta⋄ti⋄on on i",
+                "⋄⋄⋄⋄⋄⋄⋄⋄⋄⋄⋄⋄⋄⋄Sta⋄ti⋄on or⋄⋄",
+            ],
+        )
+
+    def test_align_gaps_01(self):
+        self.assertEqual(
+            self.line.align_gaps(["aab", "b", "ab", "aab"]),
+            [[], [(0, 2)], [(1, 1)], []],
+        )
+
+    def test_align_gaps_02(self):
+        self.assertEqual(self.line.align_gaps(["aa", "baa", "aab"]), [[(0, 1)], [], []])
+
+    def test_align_gaps_03(self):
+        self.assertEqual(
+            self.line.align_tree_gaps(["aab", "b", "ab", "aab"]),
+            [[], [(0, 2)], [(1, 1)], []],
+        )
+
+    def test_render_01(self):
+        self.assertEqual(render("ab", [(0, 2), (1, 1), (2, 3)]), "⋄⋄a⋄b⋄⋄⋄")
+
+    def test_render_02(self):
+        lines = ["aa", "baa", "aab"]
+        gaps = self.line.align_gaps(lines)
+        self.assertEqual(
+            [render(ln, g) for ln, g in zip(lines, gaps, strict=True)],
+            self.line.align(lines),
+        )
+
+    def test_stats_01(self):
+        stats = AlignStats()
+        line = LineAlign({"aa": 0.0, "ab": -1.0, "bb": 0.0}, -1.0, -1.0, stats=stats)
+        line.align(["aba", "aa"])
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(stats.merges, 1)
+        self.assertEqual(stats.cells, 12)
+        self.assertEqual(stats.traceback, 3)
+        self.assertGreater(stats.matrix_bytes, 0)
+
+    def test_stats_02(self):
+        """It adds up over calls until it is reset."""
+        stats = AlignStats()
+        line = LineAlign({"aa": 0.0, "ab": -1.0, "bb": 0.0}, -1.0, -1.0, stats=stats)
+        line.align(["aba", "aa", "ab"])
+        line.align_tree(["aba", "aa", "ab"])
+        self.assertEqual((stats.calls, stats.merges), (2, 4))
+        stats.reset()
+        self.assertEqual(stats, AlignStats())
+
+    def test_aligner_01(self):
+        """Each snapshot is the same as aligning the lines added so far."""
+        lines = ["aab", "baa", "aa", "abba"]
+        aligner = Aligner(self.line)
+        for i, ln in enumerate(lines, start=1):
+            aligner.add(ln)
+            self.assertEqual(aligner.snapshot(), self.line.align(lines[:i]))
+        self.assertEqual(aligner.snapshot_gaps(), self.line.align_gaps(lines))
+        self.assertEqual(aligner.lines, lines)
+
+    def test_aligner_02(self):
+        aligner = Aligner(self.line)
+        self.assertEqual((aligner.snapshot(), len(aligner)), ([], 0))
+        aligner.add("ab")
+        self.assertEqual(aligner.snapshot(), ["ab"])
+
+    def test_aligner_03(self):
+        """Each line added is one merge."""
+        stats = AlignStats()
+        aligner = Aligner(LineAlign({"aa": 0.0, "ab": -1.0, "bb": 0.0}, stats=stats))
+        for ln in ["aa", "ab", "ba"]:
+            aligner.add(ln)
+        self.assertEqual((stats.calls, stats.merges), (1, 2))
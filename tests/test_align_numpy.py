@@ -0,0 +1,101 @@
+import unittest
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import Aligner, AlignStats, LineAlign
+from line_align.pylib.align_numpy import NumpyLineAlign
+
+
+class TestAlignNumpy(unittest.TestCase):
+    matrix = char_sub_matrix.get()
+
+    def setUp(self):
+        two_chars = {"aa": 0.0, "ab": -1.0, "bb": 0.0}
+        self.line = NumpyLineAlign(two_chars, -1.0, -1.0)
+
+    def test_align_numpy_01(self):
+        self.assertEqual(self.line.align(["aba", "aba"]), ["aba", "aba"])
+
+    def test_align_numpy_02(self):
+        self.assertEqual(self.line.align(["aba", "aa"]), ["aba", "a⋄a"])
+
+    def test_align_numpy_03(self):
+        self.assertEqual(self.line.align(["aa", "aba"]), ["a⋄a", "aba"])
+
+    def test_align_numpy_04(self):
+        self.assertEqual(self.line.align(["baa", "aa"]), ["baa", "⋄aa"])
+
+    def test_align_numpy_05(self):
+        self.assertEqual(self.line.align(["aa", "aab"]), ["aa⋄", "aab"])
+
+    def test_align_numpy_06(self):
+        self.assertEqual(self.line.align([]), [])
+
+    def test_align_numpy_07(self):
+        self.assertEqual(self.line.align(["aab", "abb", "aba"]), ["aab", "abb", "aba"])
+
+    def test_align_numpy_08(self):
+        line = NumpyLineAlign(substitutions=self.matrix)
+        results = line.align(
+            [
+                "MOJAVE DESERT, PROVIDENCE MTS.: canyon above",
+                "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above",
+                "E MOJAVE DESERT PROVTDENCE MTS. # canyon above",
+                "Be ‘MOJAVE DESERT, PROVIDENCE canyon “above",
+            ],
+        )
+        self.assertEqual(
+            results,
+            [
+                "⋄⋄⋄⋄MOJAVE DESERT⋄, PROVIDENCE MTS.⋄⋄: canyon ⋄above",
+                "E⋄. MOJAVE DESERT , PROVIDENCE MTS . : canyon ⋄above",
+                "E⋄⋄ MOJAVE DESERT ⋄⋄PROVTDENCE MTS. #⋄ canyon ⋄above",
+                "Be ‘MOJAVE DESERT⋄, PROVIDENCE ⋄⋄⋄⋄⋄⋄⋄⋄canyon “above",
+            ],
+        )
+
+    def test_align_numpy_09(self):
+        line = NumpyLineAlign(self.matrix)
+        results = line.align(
+            [
+                "North Carolina NORTH CAROLINA Guilford County",
+                "North Carolina OT CAROLINA Guilford County",
+            ],
+        )
+        self.assertEqual(
+            results,
+            [
+                "North Carolina NORTH CAROLINA Guilford County",
+                "North Carolina ⋄OT⋄⋄ CAROLINA Guilford County",
+            ],
+        )
+
+    def test_align_numpy_10(self):
+        self.assertEqual(
+            self.line.align_tree(["aab", "b", "ab", "aab"]),
+            ["aab", "⋄⋄b", "a⋄b", "aab"],
+        )
+
+    def test_align_numpy_11(self):
+        line = NumpyLineAlign({"aa": 0.0, "bb": 0.0})
+        with self.assertRaises(ValueError):
+            line.align(["aa", "ab"])
+
+    def test_align_numpy_12(self):
+        """It counts the same cells and trace-back moves as LineAlign."""
+        lines = ["North Carolina", "North Caroli", "Nrth Carolina"]
+        stats = AlignStats()
+        NumpyLineAlign(self.matrix, stats=stats).align(lines)
+        expect = AlignStats()
+        LineAlign(self.matrix, stats=expect).align(lines)
+        self.assertEqual(
+            (stats.calls, stats.merges, stats.cells, stats.traceback),
+            (expect.calls, expect.merges, expect.cells, expect.traceback),
+        )
+
+    def test_align_numpy_13(self):
+        """The Aligner uses the NumPy merge."""
+        lines = ["aab", "baa", "aa", "abba"]
+        aligner = Aligner(self.line)
+        for ln in lines:
+            aligner.add(ln)
+        self.assertEqual(aligner.snapshot(), self.line.align(lines))
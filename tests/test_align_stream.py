@@ -0,0 +1,53 @@
+import json
+import unittest
+
+from line_align.pylib import align_stream
+from line_align.pylib.align_stream import Settings
+
+
+class TestAlignStream(unittest.TestCase):
+    settings = Settings(impl="py")
+
+    def align(self, records, settings=None, **kwargs):
+        results = align_stream.align_stream(
+            records, settings or self.settings, **kwargs
+        )
+        return [json.loads(r) for r in results]
+
+    def test_align_stream_01(self):
+        self.assertEqual(self.align(['["aba", "aa"]']), [{"aligned": ["aba", "a⋄a"]}])
+
+    def test_align_stream_02(self):
+        """It keeps the other keys of an object."""
+        self.assertEqual(
+            self.align(['{"id": 7, "lines": ["aba", "aa"]}']),
+            [{"id": 7, "aligned": ["aba", "a⋄a"]}],
+        )
+
+    def test_align_stream_03(self):
+        """It keeps the input order with many workers."""
+        records = [json.dumps([str(i), str(i) + "0"]) for i in range(50)]
+        expect = self.align(records)
+        self.assertEqual(
+            self.align(records, workers=4, threads=True, chunk_size=3), expect
+        )
+
+    def test_align_stream_04(self):
+        settings = Settings(impl="py", consensus=True, distances=True)
+        self.assertEqual(
+            self.align(["", '["aba", "aa", "aba"]'], settings),
+            [
+                {
+                    "aligned": ["aba", "a⋄a", "aba"],
+                    "consensus": "aba",
+                    "confidence": [1.0, 2 / 3, 1.0],
+                    "distances": [[0, 0, 2], [1, 0, 1], [1, 1, 2]],
+                }
+            ],
+        )
+
+    def test_align_stream_05(self):
+        """Bad records get an error and do not stop the stream."""
+        results = self.align(["[", '{"lines": "ab"}', '["a☃", "a"]', '["ab"]'])
+        self.assertEqual([sorted(r) for r in results[:3]], [["error"]] * 3)
+        self.assertEqual(results[3], {"aligned": ["ab"]})
@@ -1,4 +1,8 @@
+import os
+import tempfile
 import unittest
+from pathlib import Path
+from unittest.mock import patch
 
 import numpy as np
 
@@ -56,3 +60,97 @@ class TestCharSubMatrix(unittest.TestCase):
             ]
         )
         self.assertEqual(char_sub_matrix.get_max_iou(pix1, pix2), 0.2)
+
+    def test_max_ious_01(self):
+        pix = np.array(
+            [
+                [0.0, 1.0, 0.0],
+                [0.0, 1.0, 0.0],
+                [0.0, 1.0, 0.0],
+            ]
+        )
+        others = np.array(
+            [
+                [
+                    [1.0, 1.0, 1.0],
+                    [0.0, 0.0, 0.0],
+                    [0.0, 0.0, 0.0],
+                ],
+                [
+                    [0.0, 0.0, 1.0],
+                    [0.0, 0.0, 1.0],
+                    [0.0, 0.0, 0.0],
+                ],
+                [
+                    [0.0, 0.0, 0.0],
+                    [0.0, 0.0, 0.0],
+                    [0.0, 0.0, 0.0],
+                ],
+            ]
+        )
+        self.assertEqual(
+            char_sub_matrix.max_ious(pix, others).tolist(), [0.2, 2 / 3, 0.0]
+        )
+
+    def test_calc_scores_01(self):
+        glyphs = {
+            "a": np.array([[1.0, 1.0], [0.0, 0.0]]),
+            "b": np.array([[1.0, 0.0], [0.0, 0.0]]),
+            "c": np.array([[0.0, 1.0], [0.0, 0.0]]),
+        }
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_db = Path(temp_dir) / "cache.sqlite"
+            # Pretend that an earlier build was interrupted after scoring "ab"
+            char_sub_matrix.select_checkpoint(cache_db, "build")
+            checkpoint = {("a", "b"): {"score": 0.25, "sub": -2.0}}
+            char_sub_matrix.insert_checkpoint(cache_db, "build", checkpoint.items())
+
+            matrix = {}
+            char_sub_matrix.calc_scores(
+                set(), set("abc"), matrix, glyphs, cache_db=cache_db, build="build"
+            )
+            self.assertEqual(matrix[("a", "b")], {"score": 0.25, "sub": -2.0})
+            self.assertEqual(matrix[("a", "c")], {"score": 0.5, "sub": 0.0})
+            self.assertEqual(matrix[("b", "c")], {"score": 1.0, "sub": 1.0})
+            self.assertEqual(matrix[("c", "c")], {"score": None, "sub": 2.0})
+            self.assertEqual(
+                len(char_sub_matrix.select_checkpoint(cache_db, "build")), 3
+            )
+
+    def test_export_01(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = char_sub_matrix.export(path=Path(temp_dir) / "default.bin")
+            matrix = char_sub_matrix.read(path)
+            expect = char_sub_matrix.build()
+            self.assertEqual(matrix.alphabet, expect.alphabet)
+            np.testing.assert_array_equal(matrix.scores, expect.scores)
+
+    def test_export_02(self):
+        """Other users can read the matrix file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = char_sub_matrix.export(path=Path(temp_dir) / "default.bin")
+            self.assertEqual(path.stat().st_mode & 0o777, 0o644)
+
+    def test_load_01(self):
+        matrix = char_sub_matrix.load()
+        self.assertEqual(matrix.scores.shape, (len(matrix.alphabet),) * 2)
+        self.assertEqual(matrix.to_dict(), char_sub_matrix.get())
+        self.assertIs(char_sub_matrix.load(), matrix)
+
+    def test_load_02(self):
+        """It builds the matrix when the file cannot be read."""
+        with patch.object(char_sub_matrix, "read", side_effect=PermissionError):
+            matrix = char_sub_matrix.load.__wrapped__()
+        self.assertEqual(matrix.to_dict(), char_sub_matrix.get())
+
+    def test_load_03(self):
+        """The matrix file goes in the user's cache directory, not the package."""
+        with (
+            tempfile.TemporaryDirectory() as temp_dir,
+            patch.dict(os.environ, {"XDG_CACHE_HOME": temp_dir}),
+        ):
+            path = char_sub_matrix.matrix_path("default")
+            self.assertTrue(path.is_relative_to(temp_dir))
+            matrix = char_sub_matrix.load.__wrapped__()
+            self.assertTrue(path.exists())
+            self.assertEqual(matrix.to_dict(), char_sub_matrix.get())
@@ -0,0 +1,45 @@
+import random
+import unittest
+
+from line_align.pylib import cluster
+from line_align.pylib.ocr_noise import OcrNoise
+
+
+class TestCluster(unittest.TestCase):
+    def test_cluster_01(self):
+        lines = [
+            "MOJAVE DESERT, PROVIDENCE MTS.: canyon above",
+            "North Carolina",
+            "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above",
+            "North Caroina",
+            "Guilford County",
+            "E MOJAVE DESERT PROVTDENCE MTS. # canyon above",
+        ]
+        self.assertEqual(cluster.cluster(lines), [[0, 2, 5], [1, 3], [4]])
+
+    def test_cluster_02(self):
+        """It finds noisy copies of lines that are mixed together."""
+        noise = OcrNoise(seed=1, sub_rate=0.03, end_rate=0.0)
+        groups = [noise.group(60, 4) for _ in range(50)]
+        lines = [ln for group in groups for ln in group]
+        random.Random(2).shuffle(lines)  # noqa: S311
+        found = cluster.group_lines(lines)
+        self.assertEqual(
+            sorted(sorted(g) for g in found), sorted(sorted(g) for g in groups)
+        )
+
+    def test_cluster_03(self):
+        self.assertEqual(cluster.cluster([]), [])
+
+    def test_cluster_04(self):
+        self.assertEqual(cluster.cluster(["", "a", "", "a"]), [[0, 2], [1, 3]])
+
+    def test_cluster_05(self):
+        lines = ["abcdefgh", "abcdefgx"]
+        self.assertEqual(cluster.cluster(lines, max_dist=0), [[0], [1]])
+        self.assertEqual(cluster.cluster(lines, max_dist=1), [[0, 1]])
+
+    def test_qgram_hashes_01(self):
+        hashes, starts = cluster.qgram_hashes(["ab", "", "ab"], 3)
+        self.assertEqual(starts.tolist(), [0, 4, 6])
+        self.assertEqual(hashes[:4].tolist(), hashes[6:].tolist())
@@ -0,0 +1,70 @@
+import unittest
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import LineAlign
+
+
+class TestConsensus(unittest.TestCase):
+    matrix = char_sub_matrix.get()
+
+    def setUp(self):
+        three_chars = {
+            "aa": 2.0,
+            "ab": 1.0,
+            "ac": -2.0,
+            "bb": 2.0,
+            "bc": -2.0,
+            "cc": 2.0,
+        }
+        self.line = LineAlign(three_chars, -1.0, -1.0)
+
+    def test_consensus_01(self):
+        self.assertEqual(
+            self.line.consensus(["abc", "abc", "abc"]), ("abc", [1.0, 1.0, 1.0])
+        )
+
+    def test_consensus_02(self):
+        self.assertEqual(
+            self.line.consensus(["abc", "abc", "aac"]), ("abc", [1.0, 2 / 3, 1.0])
+        )
+
+    def test_consensus_03(self):
+        """Similar looking characters support each other."""
+        self.assertEqual(self.line.consensus(["a", "b", "c", "c", "a"]), ("a", [0.4]))
+
+    def test_consensus_04(self):
+        """Columns that are at least half gaps are dropped."""
+        self.assertEqual(
+            self.line.consensus(["a⋄c", "abc", "a⋄c", "abc"]), ("ac", [1.0, 1.0])
+        )
+
+    def test_consensus_05(self):
+        self.assertEqual(
+            self.line.consensus(["a⋄c", "abc"], weights=[1.0, 3.0]),
+            ("abc", [1.0, 0.75, 1.0]),
+        )
+
+    def test_consensus_06(self):
+        self.assertEqual(self.line.consensus([]), ("", []))
+
+    def test_consensus_07(self):
+        with self.assertRaises(ValueError):
+            self.line.consensus(["ab", "a"])
+
+    def test_consensus_08(self):
+        with self.assertRaises(ValueError):
+            self.line.consensus(["ab", "ab"], weights=[1.0])
+
+    def test_consensus_09(self):
+        line = LineAlign(self.matrix)
+        aligned = line.align(
+            [
+                "MOJAVE DESERT, PROVIDENCE MTS.: canyon above",
+                "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above",
+                "E MOJAVE DESERT PROVTDENCE MTS. # canyon above",
+                "Be ‘MOJAVE DESERT, PROVIDENCE canyon “above",
+            ]
+        )
+        self.assertEqual(
+            line.consensus(aligned)[0], "E MOJAVE DESERT, PROVIDENCE MTS. canyon above"
+        )
@@ -93,3 +93,30 @@ class TestDistance(unittest.TestCase):
             ),
             3,
         )
+
+    def test_distance_28(self):
+        self.assertEqual(
+            levenshtein(
+                "MOJAVE DESERT, PROVIDENCE MTS.: canyon above, "
+                "North Carolina NORTH CAROLINA Guilford County",
+                "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above "
+                "North Carolina OT CAROLINA Guilford County",
+            ),
+            10,
+        )
+
+    def test_distance_29(self):
+        self.assertEqual(levenshtein("aa", "baab", max_dist=2), 2)
+
+    def test_distance_30(self):
+        self.assertEqual(levenshtein("aa", "baab", max_dist=1), 2)
+
+    def test_distance_31(self):
+        self.assertEqual(levenshtein("aa", "12345aa", max_dist=3), 4)
+
+    def test_distance_32(self):
+        self.assertEqual(levenshtein("aaaa", "bbbb", max_dist=0), 1)
+
+    def test_distance_33(self):
+        with self.assertRaises(ValueError):
+            levenshtein("abc", "xyz", max_dist=-1)
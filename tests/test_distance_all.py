@@ -32,3 +32,16 @@ class TestDistanceAll(unittest.TestCase):
                 Distance(13, 2, 3),
             ],
         )
+
+    def test_distance_all_04(self):
+        self.assertEqual(
+            levenshtein_all(["aa", "bb", "ab"], max_dist=1),
+            [Distance(1, 0, 2), Distance(1, 1, 2)],
+        )
+
+    def test_distance_all_05(self):
+        self.assertEqual(levenshtein_all(["aa", "bb"], max_dist=1), [])
+
+    def test_distance_all_06(self):
+        with self.assertRaises(ValueError):
+            levenshtein_all(["abc", "xyz"], max_dist=-1)
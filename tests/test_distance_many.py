@@ -0,0 +1,48 @@
+import unittest
+
+from line_align.pylib.levenshtein import levenshtein_many
+
+
+class TestDistanceMany(unittest.TestCase):
+    def test_distance_many_01(self):
+        self.assertEqual(
+            levenshtein_many("aa", ["bb", "ab", "aa", "", "baab"]).tolist(),
+            [2, 1, 0, 2, 2],
+        )
+
+    def test_distance_many_02(self):
+        self.assertEqual(levenshtein_many("", ["aa", ""]).tolist(), [2, 0])
+
+    def test_distance_many_03(self):
+        self.assertEqual(levenshtein_many("aa", []).tolist(), [])
+
+    def test_distance_many_04(self):
+        self.assertEqual(
+            levenshtein_many("五五", ["五六", "五五", "aa五"]).tolist(), [1, 0, 2]
+        )
+
+    def test_distance_many_05(self):
+        self.assertEqual(
+            levenshtein_many("aa", ["bb", "ab", "12345aa"], max_dist=1).tolist(),
+            [2, 1, 2],
+        )
+
+    def test_distance_many_06(self):
+        self.assertEqual(
+            levenshtein_many(
+                "MOJAVE DESERT, PROVIDENCE MTS.: canyon above, "
+                "North Carolina NORTH CAROLINA Guilford County",
+                [
+                    (
+                        "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above "
+                        "North Carolina OT CAROLINA Guilford County"
+                    ),
+                    "Commelinaceae Commelina virginica",
+                ],
+            ).tolist()[0],
+            10,
+        )
+
+    def test_distance_many_07(self):
+        with self.assertRaises(ValueError):
+            levenshtein_many("abc", ["xyz", "abc"], max_dist=-1)
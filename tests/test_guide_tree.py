@@ -0,0 +1,19 @@
+import unittest
+
+from line_align.pylib.align import guide_tree
+
+
+class TestGuideTree(unittest.TestCase):
+    def test_guide_tree_01(self):
+        self.assertEqual(guide_tree(["aa", "bb"]), [(0, 1)])
+
+    def test_guide_tree_02(self):
+        self.assertEqual(guide_tree(["aa", "bb", "ab"]), [(0, 2), (1, 3)])
+
+    def test_guide_tree_03(self):
+        self.assertEqual(
+            guide_tree(["aab", "aab", "b", "ab"]), [(0, 1), (2, 3), (4, 5)]
+        )
+
+    def test_guide_tree_04(self):
+        self.assertEqual(guide_tree(["aa"]), [])
@@ -0,0 +1,243 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import AlignStats, LineAlign
+from line_align.pylib.align_numpy import NumpyLineAlign
+from line_align.pylib.levenshtein import levenshtein_all
+from line_align.pylib.ocr_noise import OcrNoise
+
+try:
+    import line_align_py
+except ImportError:
+    line_align_py = None
+
+# The native extension switches to the linear memory trace-back past this many cells
+LINEAR_CELLS = 1 << 22
+
+
+def groups(count, length, size, seed=1):
+    noise = OcrNoise(seed=seed)
+    bases = [noise.line(length) for _ in range(count)]
+    return [[noise.noisy(base) for _ in range(size)] for base in bases]
+
+
+def counts(stats):
+    return stats.calls, stats.merges, stats.cells, stats.traceback
+
+
+@unittest.skipUnless(line_align_py, "The native extension is not built.")
+class TestLineAlignPy(unittest.TestCase):
+    """The native extension must give the same alignments as the Python version."""
+
+    matrix = char_sub_matrix.get()
+
+    def setUp(self):
+        self.addCleanup(line_align_py.set_fill_kernel, line_align_py.fill_kernel())
+
+    def test_fill_kernels_01(self):
+        """Every fill kernel, with or without a band, matches LineAlign.align()."""
+        lines = [
+            *groups(count=12, length=40, size=4),
+            ["a", ""],
+            ["", "ab"],
+            ["ab"],
+            ["MOJAVE DESERT, PROVIDENCE MTS.: canyon above", "canyon above"],
+        ]
+        for gap, skew in [(-3.0, -0.5), (-1.0, -1.0)]:
+            expect = [LineAlign(self.matrix, gap, skew).align(g) for g in lines]
+            for kernel in line_align_py.fill_kernels():
+                line_align_py.set_fill_kernel(kernel)
+                for band in (0, 3):
+                    cpp = line_align_py.LineAlign(self.matrix, gap, skew, band=band)
+                    with self.subTest(gap=gap, kernel=kernel, band=band):
+                        self.assertEqual([cpp.align(g) for g in lines], expect)
+
+    def test_fill_kernels_02(self):
+        """Lines long enough for the linear memory trace-back are exact."""
+        lines = groups(count=1, length=2100, size=2, seed=2)[0]
+        self.assertGreater((len(lines[0]) + 1) * (len(lines[1]) + 1), LINEAR_CELLS)
+        expect = NumpyLineAlign(self.matrix, -3.0, -0.5).align(lines)
+        for kernel in line_align_py.fill_kernels():
+            line_align_py.set_fill_kernel(kernel)
+            for band in (0, 3):
+                cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5, band=band)
+                with self.subTest(kernel=kernel, band=band):
+                    self.assertEqual(cpp.align(lines), expect)
+
+    def test_set_fill_kernel_01(self):
+        with self.assertRaises(ValueError):
+            line_align_py.set_fill_kernel("not a kernel")
+
+    def test_substitution_matrix_01(self):
+        """Characters missing from the alphabet raise, including U+0000."""
+        matrix = line_align_py.SubstitutionMatrix(self.matrix)
+        self.assertEqual(matrix.score("a", "a"), self.matrix["aa"])
+        for char1, char2 in [("\x00", "a"), ("a", "\x00"), ("⋄", "a"), ("a", "⋄")]:
+            with self.subTest(char1=char1, char2=char2), self.assertRaises(ValueError):
+                matrix.score(char1, char2)
+
+    def test_substitution_matrix_02(self):
+        """A matrix built from load() aligns the same as one built from the dict."""
+        loaded = char_sub_matrix.load()
+        dense = line_align_py.SubstitutionMatrix(loaded.alphabet, loaded.scores)
+        self.assertEqual(len(dense), len(loaded.alphabet))
+        self.assertEqual(dense.alphabet, loaded.alphabet)
+        lines = groups(count=10, length=40, size=4, seed=9)
+        expect = line_align_py.LineAlign(self.matrix, -3.0, -0.5)
+        cpp = line_align_py.LineAlign(dense, -3.0, -0.5)
+        self.assertEqual(
+            [cpp.align(g) for g in lines], [expect.align(g) for g in lines]
+        )
+        with self.assertRaises(ValueError):
+            line_align_py.SubstitutionMatrix(loaded.alphabet, loaded.scores[1:])
+
+    def test_strings_01(self):
+        """One, two, and four byte strings, lone surrogates too, go in and come out."""
+        chars = "ab\xe9\u03a9\ud800\U0001f600"
+        subs = {a + b: 2.0 if a == b else -1.0 for a in chars for b in chars if a <= b}
+        lines = ["ab\xe9", "a\u03a9b", "a\ud800\xe9", "b\U0001f600\u03a9a"]
+        cpp = line_align_py.LineAlign(subs, -3.0, -0.5)
+        for i in range(len(lines)):
+            group = lines[: i + 1]
+            with self.subTest(group=group):
+                self.assertEqual(cpp.align(group), LineAlign(subs).align(group))
+        self.assertEqual(cpp.levenshtein("a\U0001f600\ud800", "a\ud800"), 1)
+        self.assertEqual(
+            line_align_py.render("\U0001f600\ud800", [(1, 2)]), "\U0001f600⋄⋄\ud800"
+        )
+
+    def test_as_array_01(self):
+        """The code point arrays have GAP_CODE where align() has a gap."""
+        lines = groups(count=1, length=40, size=5, seed=7)[0]
+        cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5)
+        for method in (cpp.align, cpp.align_tree):
+            aligned = method(lines)
+            array = method(lines, as_array=True)
+            with self.subTest(method=method.__name__):
+                self.assertEqual(array.dtype, np.int32)
+                self.assertEqual(array.shape, (len(lines), len(aligned[0])))
+                self.assertEqual(
+                    array.tolist(),
+                    [
+                        [line_align_py.GAP_CODE if c == "⋄" else ord(c) for c in row]
+                        for row in aligned
+                    ],
+                )
+        self.assertEqual(cpp.align([], as_array=True).shape, (0, 0))
+
+    def test_align_batch_01(self):
+        """The batch is in the same order as the groups, with any number of threads."""
+        lines = [*groups(count=20, length=50, size=4, seed=5), [], ["ab"]]
+        cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5)
+        expect = [cpp.align(g) for g in lines]
+        for threads in (1, 4, 0):
+            with self.subTest(threads=threads):
+                self.assertEqual(cpp.align_batch(lines, threads=threads), expect)
+
+    def test_align_batch_02(self):
+        """An error in any group is raised after the threads are done."""
+        lines = groups(count=20, length=50, size=4, seed=5)
+        lines[13] = ["abc", "a\x00c"]
+        cpp = line_align_py.LineAlign(self.matrix)
+        for threads in (1, 4, 0):
+            with self.subTest(threads=threads), self.assertRaises(ValueError):
+                cpp.align_batch(lines, threads=threads)
+
+    def test_consensus_01(self):
+        """The consensus and its confidences are the same as LineAlign.consensus()."""
+        py = LineAlign(self.matrix, -3.0, -0.5)
+        cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5)
+        alignments = [py.align(g) for g in groups(count=10, length=50, size=4, seed=6)]
+        for weights in (None, [1.0, 0.1, 2.5, 0.7]):
+            expect = [py.consensus(a, weights) for a in alignments]
+            with self.subTest(weights=weights):
+                self.assertEqual(
+                    [cpp.consensus(a, weights) for a in alignments], expect
+                )
+            for threads in (1, 4, 0):
+                with self.subTest(weights=weights, threads=threads):
+                    self.assertEqual(
+                        cpp.consensus_batch(alignments, weights, threads=threads),
+                        expect,
+                    )
+
+    def test_align_stats_01(self):
+        """The work is counted the same way as in the Python version."""
+        lines = groups(count=5, length=30, size=4, seed=10)
+        py_stats, cpp_stats = AlignStats(), line_align_py.AlignStats()
+        py = LineAlign(self.matrix, -3.0, -0.5, stats=py_stats)
+        cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5, stats=cpp_stats)
+        self.assertIs(cpp.stats, cpp_stats)
+        for method, kwargs in [("align", {}), ("align_tree", {"threads": 4})]:
+            for group in lines:
+                getattr(py, method)(group)
+                getattr(cpp, method)(group, **kwargs)
+            with self.subTest(method=method):
+                self.assertEqual(counts(cpp_stats), counts(py_stats))
+            py_stats.reset()
+            cpp_stats.reset()
+            self.assertEqual(counts(cpp_stats), (0, 0, 0, 0))
+            self.assertEqual(cpp_stats.fill_seconds, 0.0)
+
+    def test_align_stats_02(self):
+        """LineAlign objects and threads can share one AlignStats."""
+        lines = groups(count=20, length=30, size=4, seed=11)
+        stats = line_align_py.AlignStats()
+        first = line_align_py.LineAlign(self.matrix, stats=stats)
+        for group in lines:
+            first.align(group)
+        once = counts(stats)
+        self.assertEqual(once[:2], (len(lines), 3 * len(lines)))
+        second = line_align_py.LineAlign(self.matrix, stats=stats)
+        second.align_batch(lines, threads=4)
+        first.align_batch(lines, threads=0)
+        self.assertEqual(counts(stats), tuple(3 * c for c in once))
+
+    def test_levenshtein_all_01(self):
+        """The pairs are in the same (dist, idx1, idx2) order as levenshtein_all()."""
+        lines = [ln for g in groups(count=10, length=30, size=7, seed=8) for ln in g]
+        cpp = line_align_py.LineAlign(self.matrix)
+        for max_dist in (None, 4):
+            expect = levenshtein_all(lines, max_dist)
+            for threads in (1, 4, 0):
+                with self.subTest(max_dist=max_dist, threads=threads):
+                    self.assertEqual(
+                        cpp.levenshtein_all(lines, max_dist, threads), expect
+                    )
+
+    def test_levenshtein_01(self):
+        """A negative max_dist is an error, like in the Python version."""
+        cpp = line_align_py.LineAlign(self.matrix)
+        with self.assertRaises(ValueError):
+            cpp.levenshtein("abc", "xyz", max_dist=-1)
+        with self.assertRaises(ValueError):
+            cpp.levenshtein_all(["abc", "xyz"], max_dist=-1)
+        self.assertEqual(cpp.levenshtein("abc", "xyz", max_dist=0), 1)
+
+    def test_aligner_01(self):
+        """Each snapshot is the same as aligning the lines added so far."""
+        lines = groups(count=1, length=60, size=5, seed=3)[0]
+        cpp = line_align_py.LineAlign(self.matrix, -3.0, -0.5)
+        aligner = line_align_py.Aligner(cpp)
+        for i, ln in enumerate(lines, start=1):
+            aligner.add(ln)
+            self.assertEqual(aligner.snapshot(), cpp.align(lines[:i]))
+        self.assertEqual(aligner.snapshot_gaps(), cpp.align_gaps(lines))
+        self.assertEqual(aligner.lines, lines)
+
+    def test_aligner_02(self):
+        """Threads can share an Aligner."""
+        lines = groups(count=1, length=200, size=40, seed=4)[0]
+        aligner = line_align_py.Aligner(line_align_py.LineAlign(self.matrix))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for ln in lines:
+                executor.submit(aligner.add, ln)
+                executor.submit(aligner.snapshot)
+        added = aligner.lines
+        self.assertEqual(sorted(added), sorted(lines))
+        aligned = aligner.snapshot()
+        self.assertEqual({len(row) for row in aligned}, {len(aligned[0])})
+        self.assertEqual([row.replace("⋄", "") for row in aligned], added)
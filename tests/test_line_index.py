@@ -0,0 +1,89 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from line_align.pylib.levenshtein import levenshtein
+from line_align.pylib.line_index import LineIndex
+from line_align.pylib.ocr_noise import OcrNoise
+
+LINES = [
+    "MOJAVE DESERT, PROVIDENCE MTS.: canyon above",
+    "North Carolina",
+    "Guilford County",
+    "North Dakota",
+    "E. MOJAVE DESERT , PROVIDENCE MTS . : canyon above",
+    "",
+    "Guilford Co.",
+]
+
+
+def brute(query, lines):
+    return sorted((levenshtein(query, ln), i, ln) for i, ln in enumerate(lines))
+
+
+class TestLineIndex(unittest.TestCase):
+    def test_within_01(self):
+        index = LineIndex.build(LINES)
+        self.assertEqual(index.within("North Caroina", 2), [(1, 1, "North Carolina")])
+
+    def test_within_02(self):
+        """A query too short for the count filter still finds its matches."""
+        index = LineIndex.build(LINES)
+        self.assertEqual(index.within("", 0), [(0, 5, "")])
+        self.assertEqual(len(index.within("ab", 14)), 4)
+
+    def test_nearest_01(self):
+        index = LineIndex.build(LINES)
+        self.assertEqual(
+            index.nearest("Guilford Cnty", 2),
+            [(2, 2, "Guilford County"), (3, 6, "Guilford Co.")],
+        )
+
+    def test_nearest_02(self):
+        """It finds lines that share no q-grams with the query."""
+        index = LineIndex.build(LINES)
+        self.assertEqual(index.nearest("zzz", 1), [(3, 5, "")])
+
+    def test_nearest_03(self):
+        self.assertEqual(LineIndex.build([]).nearest("abc", 3), [])
+        self.assertEqual(LineIndex.build([]).within("abc", 3), [])
+
+    def test_nearest_04(self):
+        """It gets the same results as checking every line."""
+        noise = OcrNoise(seed=1)
+        rng = random.Random(2)  # noqa: S311
+        lines = [noise.line(rng.randint(1, 30)) for _ in range(300)]
+        index = LineIndex.build(lines)
+        for _ in range(20):
+            query = noise.noisy(rng.choice(lines))
+            expect = brute(query, lines)
+            self.assertEqual(index.nearest(query, 3), expect[:3])
+            self.assertEqual(
+                index.within(query, 4),
+                [m for m in expect if m[0] <= 4],  # noqa: PLR2004
+            )
+
+    def test_save_01(self):
+        index = LineIndex.build(LINES, q=2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = index.save(Path(temp_dir) / "lines.idx")
+            loaded = LineIndex.load(path)
+            self.assertEqual(loaded.q, 2)
+            self.assertEqual(len(loaded), len(LINES))
+            self.assertEqual(
+                loaded.nearest("North Dakot", 2), index.nearest("North Dakot", 2)
+            )
+
+    def test_save_02(self):
+        """Other users can read the index file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = LineIndex.build(LINES).save(Path(temp_dir) / "lines.idx")
+            self.assertEqual(path.stat().st_mode & 0o777, 0o644)
+
+    def test_load_01(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "lines.idx"
+            path.write_bytes(b"not an index")
+            with self.assertRaises(ValueError):
+                LineIndex.load(path)
@@ -0,0 +1,24 @@
+import unittest
+
+from line_align.pylib.ocr_noise import OcrNoise
+
+
+class TestOcrNoise(unittest.TestCase):
+    def test_group_01(self):
+        """It repeats the same lines for the same seed."""
+        self.assertEqual(OcrNoise(seed=3).group(40, 4), OcrNoise(seed=3).group(40, 4))
+
+    def test_line_01(self):
+        self.assertEqual(len(OcrNoise().line(50)), 50)
+
+    def test_noisy_01(self):
+        """It only swaps in confusable chars."""
+        noise = OcrNoise({"ab": 1.0, "ac": -2.0, "aa": 2.0}, sub_rate=1.0)
+        noise.drop_rate = noise.insert_rate = noise.end_rate = 0.0
+        self.assertEqual(noise.noisy("aac"), "bbc")
+
+    def test_noisy_02(self):
+        """It drops chars from the ends."""
+        noise = OcrNoise({"ab": -2.0}, end_rate=1.0, max_end=1)
+        noise.drop_rate = noise.insert_rate = noise.sub_rate = 0.0
+        self.assertEqual(noise.noisy("abba"), "bb")